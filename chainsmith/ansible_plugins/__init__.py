@@ -0,0 +1,3 @@
+'''
+Ansible plugins that ship with chainsmith
+'''
@@ -0,0 +1,3 @@
+'''
+Ansible lookup plugins that ship with chainsmith
+'''
@@ -0,0 +1,82 @@
+"""
+An Ansible lookup plugin that reads the cert, private key and chain of
+single hosts (or clients) from a ChainSmith CA store.
+All the work is done by chainsmith.store; this only maps Ansible options
+and errors.
+"""
+from os import environ
+
+from chainsmith.exceptions import StoreException, X509ParseException
+from chainsmith.store import store_reader
+
+try:
+    from ansible.errors import AnsibleError
+    from ansible.plugins.lookup import LookupBase
+except ImportError:
+    # Only Ansible loads this plugin, but keep the module importable
+    # without it
+    AnsibleError = Exception
+    LookupBase = object
+
+DOCUMENTATION = """
+name: chainsmith_cert
+author: ChainSmith
+short_description: read the cert, key and chain of hosts from a CA store
+description:
+  - Reads the cert, private key and chain of every term (a host or client
+    name, or an alternate name) from a ChainSmith CA store, without loading
+    the certs and private keys of all hosts.
+  - Every task reads the files of its certs, as Ansible runs every task in
+    a worker process of its own. Within a task, a cert is read once (and
+    again when it is issued again).
+options:
+  _terms:
+    description: The names of the certs.
+    required: true
+  store:
+    description:
+      - The tmpdir of the chainsmith run (or its tls folder).
+      - Defaults to CHAINSMITH_TMPDIR.
+    type: str
+  intermediate:
+    description:
+      - The intermediate that signed the certs.
+      - Required when more than one intermediate has a cert for a name.
+    type: str
+"""
+
+EXAMPLES = """
+- name: Deploy the server cert
+  ansible.builtin.copy:
+    content: "{{ lookup('chainsmith_cert', inventory_hostname,
+                 store='/tmp/certs/postgres', intermediate='server').cert }}"
+    dest: /etc/pki/tls/certs/server.crt
+"""
+
+RETURN = """
+_list:
+  description:
+    - A dict per term with name, intermediate, cert, key, chain, sans,
+      serial and not_after.
+  type: list
+  elements: dict
+"""
+
+
+# pylint: disable=too-few-public-methods
+class LookupModule(LookupBase):
+    """Look up the material of certs in a ChainSmith CA store"""
+
+    def run(self, terms, variables=None, **kwargs):
+        """Return the material of the cert of every term"""
+        self.set_options(var_options=variables, direct=kwargs)
+        store = self.get_option('store') or environ.get('CHAINSMITH_TMPDIR')
+        if not store:
+            raise AnsibleError('chainsmith_cert requires store (or '
+                               'CHAINSMITH_TMPDIR)')
+        try:
+            reader = store_reader(store)
+            return [reader.material(term, self.get_option('intermediate'))
+                    for term in terms]
+        except (OSError, StoreException, X509ParseException) as error:
+            raise AnsibleError(f'chainsmith_cert: {error}') from error
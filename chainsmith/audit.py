@@ -0,0 +1,283 @@
+"""
+This module audits a CA store in-process. Every CA and cert is read once,
+and checked for:
+- a signature by its issuer (RSA PKCS#1 v1.5, verified in python)
+- the issuer name matching the subject of its CA
+- being valid now, and not expiring within a warning period
+- the private key matching the cert
+- the alternate names matching the config (when given)
+- chain bundles matching the CA certs
+Certs are checked in chunks on a process pool, so that auditing a store
+with tens of thousands of certs takes seconds instead of spawning an
+openssl process per cert.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from glob import glob
+import hashlib
+from hmac import compare_digest
+from os import cpu_count
+from os.path import basename, exists, join
+from time import monotonic
+
+from chainsmith.certdb import CA_FILES
+from chainsmith.exceptions import X509ParseException
+from chainsmith.formats import private_key_der
+from chainsmith.x509 import X509Cert, pem_blocks, rsa_private_key_modulus
+
+# Signature algorithms by OID, with the hash and the DER prefix of the
+# DigestInfo that is signed
+SIGNATURE_ALGORITHMS = {
+    '1.2.840.113549.1.1.5': (
+        'sha1', bytes.fromhex('3021300906052b0e03021a05000414')),
+    '1.2.840.113549.1.1.11': (
+        'sha256', bytes.fromhex('3031300d060960864801650304020105000420')),
+    '1.2.840.113549.1.1.12': (
+        'sha384', bytes.fromhex('3041300d060960864801650304020205000430')),
+    '1.2.840.113549.1.1.13': (
+        'sha512', bytes.fromhex('3051300d060960864801650304020305000440')),
+}
+
+# Number of certs that are checked per task on the process pool
+CHUNK_SIZE = 500
+
+ERROR = 'error'
+WARNING = 'warning'
+
+
+def rsa_verify(cert, public_key):
+    """
+    Verify the signature of a cert with the RSA public key of its issuer
+    :return: None when the signature is valid, or else what is wrong
+    """
+    algorithm = SIGNATURE_ALGORITHMS.get(cert.signature_algorithm())
+    if algorithm is None:
+        return f'unsupported signature algorithm {cert.signature_algorithm()}'
+    if public_key is None:
+        return 'the issuer has no RSA key'
+    modulus, exponent = public_key
+    size = (modulus.bit_length() + 7) // 8
+    signature = cert.signature()
+    if len(signature) != size:
+        return 'signature does not match the size of the issuer key'
+    encoded = pow(int.from_bytes(signature, 'big'), exponent,
+                  modulus).to_bytes(size, 'big')
+    hash_name, prefix = algorithm
+    digest_info = prefix + hashlib.new(hash_name, cert.tbs()).digest()
+    expected = (b'\x00\x01' + b'\xff' * (size - len(digest_info) - 3) +
+                b'\x00' + digest_info)
+    if not compare_digest(encoded, expected):
+        return 'signature was not made by the issuer'
+    return None
+
+
+def check_cert(cert, issuer, now, warn_until):
+    """
+    Check signature, issuer name and validity of a cert
+    :param issuer: the X509Cert of the CA that should have signed it
+    :return: a list of (severity, check, message) tuples
+    """
+    issues = []
+    if cert.issuer_der() != issuer.subject_der():
+        issues.append((ERROR, 'chain', 'issuer does not match the subject '
+                                       'of its CA'))
+    problem = rsa_verify(cert, issuer.rsa_public_key())
+    if problem:
+        issues.append((ERROR, 'signature', problem))
+    if cert.not_before() > now:
+        issues.append((ERROR, 'validity', 'not valid before '
+                                          f'{cert.not_before().isoformat()}'))
+    if cert.not_after() <= now:
+        issues.append((ERROR, 'validity', 'expired at '
+                                          f'{cert.not_after().isoformat()}'))
+    elif cert.not_after() <= warn_until:
+        issues.append((WARNING, 'validity', 'expires at '
+                                            f'{cert.not_after().isoformat()}'))
+    return issues
+
+
+def check_key(cert, key_path):
+    """Check that the private key in key_path belongs to a cert"""
+    if not exists(key_path):
+        return [(ERROR, 'key', 'private key is missing')]
+    try:
+        with open(key_path, encoding="utf8") as key_file:
+            modulus = rsa_private_key_modulus(private_key_der(key_file.read()))
+        public_key = cert.rsa_public_key()
+    except (OSError, X509ParseException) as error:
+        return [(ERROR, 'key', f'cannot read private key: {error}')]
+    if public_key is None or modulus != public_key[0]:
+        return [(ERROR, 'key', 'private key does not match the cert')]
+    return []
+
+
+def check_sans(cert, sans):
+    """Check that the alternate names of a cert match the config"""
+    expected = set(sans) if len(sans) > 1 else set()
+    actual = set(cert.subject_alternative_names())
+    if actual == expected:
+        return []
+    return [(ERROR, 'sans', f'alternate names {sorted(actual)} do not match '
+                            f'the config {sorted(expected)}')]
+
+
+def audit_certs(task):
+    """
+    Audit a chunk of certs of one CA. Runs on the process pool.
+    :param task: a tuple (ca cert DER, [(name, cert path, key path,
+                 expected sans or None)], now, warn_until)
+    :return: a list of issues as tuples (name, severity, check, message)
+    """
+    issuer_der, certs, now, warn_until = task
+    issuer = X509Cert(issuer_der)
+    issues = []
+    for name, cert_path, key_path, sans in certs:
+        try:
+            cert = X509Cert.from_file(cert_path)
+        except (OSError, X509ParseException) as error:
+            issues.append((name, ERROR, 'parse', str(error)))
+            continue
+        found = check_cert(cert, issuer, now, warn_until)
+        found += check_key(cert, key_path)
+        if sans is not None:
+            found += check_sans(cert, sans)
+        issues += [(name,) + issue for issue in found]
+    return issues
+
+
+class StoreAudit:
+    """
+    StoreAudit checks all CAs and certs of a CA store, and collects the
+    issues in a report.
+    """
+
+    __capath = ''
+    __expected = None
+    __processes = 1
+    __now = None
+    __warn_until = None
+    __issues = None
+    __counts = None
+
+    def __init__(self, capath, expected=None, processes=None, warn_days=30):
+        """
+        :param capath: the path of the root CA (tmpdir/tls)
+        :param expected: the certs the config asks for, as a dict of
+                         intermediate name to a dict of cert name to SANs
+                         (None to skip checks against the config)
+        :param processes: the number of processes to check certs on
+        :param warn_days: warn for certs that expire within this many days
+        """
+        self.__capath = capath
+        self.__expected = expected
+        self.__processes = processes or cpu_count() or 1
+        self.__now = datetime.now(timezone.utc)
+        self.__warn_until = self.__now + timedelta(days=warn_days)
+        self.__issues = []
+        self.__counts = {'cas': 0, 'certs': 0}
+
+    def issue(self, severity, check, message, ca=None, cert=None):
+        """Add an issue to the report"""
+        # pylint: disable=too-many-arguments
+        self.__issues.append({'ca': ca, 'cert': cert, 'severity': severity,
+                              'check': check, 'message': message})
+
+    def __read_ca(self, path, name, issuer=None):
+        """Read and check the cert of a CA, or return None"""
+        try:
+            cert = X509Cert.from_file(join(path, 'certs', 'cacert.pem'))
+        except (OSError, X509ParseException) as error:
+            self.issue(ERROR, 'parse', str(error), ca=name)
+            return None
+        self.__counts['cas'] += 1
+        for severity, check, message in check_cert(
+                cert, issuer or cert, self.__now, self.__warn_until):
+            self.issue(severity, check, message, ca=name)
+        return cert
+
+    def __check_bundle(self, path, name, chain):
+        """Check that the chain bundle of a CA holds the CA certs"""
+        try:
+            with open(join(path, 'certs', 'ca-chain-bundle.cert.pem'),
+                      encoding="utf8") as bundle:
+                blocks = pem_blocks(bundle.read())
+        except OSError as error:
+            self.issue(ERROR, 'bundle', str(error), ca=name)
+            return
+        if blocks != [cert.der() for cert in chain]:
+            self.issue(ERROR, 'bundle', 'chain bundle does not hold the '
+                                        'current CA certs', ca=name)
+
+    def __cert_tasks(self, int_path, name, intermediate):
+        """Return the tasks to check the certs of an intermediate"""
+        expected = None
+        if self.__expected is not None:
+            expected = dict(self.__expected.get(name, {}))
+        certs = []
+        for cert_path in sorted(glob(join(int_path, 'certs', '*.pem'))):
+            if basename(cert_path) in CA_FILES:
+                continue
+            cert_name = basename(cert_path)[:-4]
+            sans = None
+            if expected is not None:
+                sans = expected.pop(cert_name, None)
+                if sans is None:
+                    self.issue(WARNING, 'config', 'cert is not in the config',
+                               ca=name, cert=cert_name)
+            certs.append((cert_name, cert_path,
+                          join(int_path, 'private', cert_name + '.key.pem'),
+                          sans))
+        for cert_name in expected or {}:
+            self.issue(ERROR, 'config', 'cert from the config is missing',
+                       ca=name, cert=cert_name)
+        self.__counts['certs'] += len(certs)
+        return [(intermediate.der(), certs[i:i + CHUNK_SIZE], self.__now,
+                 self.__warn_until)
+                for i in range(0, len(certs), CHUNK_SIZE)]
+
+    def run(self):
+        """Audit the store, and return the report"""
+        started = monotonic()
+        root = self.__read_ca(self.__capath, 'root')
+        if root is None:
+            return self.report(started)
+        self.__check_bundle(self.__capath, 'root', [root])
+        tasks = []
+        names = []
+        intermediates = set()
+        for int_path in sorted(glob(join(self.__capath, 'int_*'))):
+            name = basename(int_path)[4:]
+            intermediates.add(name)
+            intermediate = self.__read_ca(int_path, name, root)
+            if intermediate is None:
+                continue
+            self.__check_bundle(int_path, name, [intermediate, root])
+            for task in self.__cert_tasks(int_path, name, intermediate):
+                tasks.append(task)
+                names.append(name)
+        for name in sorted(set(self.__expected or {}) - intermediates):
+            self.issue(ERROR, 'config', 'intermediate from the config is '
+                                        'missing', ca=name)
+        self.__check_certs(tasks, names)
+        return self.report(started)
+
+    def __check_certs(self, tasks, names):
+        """Run the cert tasks, on a process pool when there are many"""
+        if self.__processes > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(min(self.__processes,
+                                         len(tasks))) as pool:
+                results = list(pool.map(audit_certs, tasks))
+        else:
+            results = [audit_certs(task) for task in tasks]
+        for name, issues in zip(names, results):
+            for cert, severity, check, message in issues:
+                self.issue(severity, check, message, ca=name, cert=cert)
+
+    def report(self, started):
+        """Return the report, with a summary and all issues"""
+        summary = dict(self.__counts)
+        summary['errors'] = sum(1 for issue in self.__issues
+                                if issue['severity'] == ERROR)
+        summary['warnings'] = len(self.__issues) - summary['errors']
+        summary['seconds'] = round(monotonic() - started, 3)
+        return {'summary': summary, 'issues': self.__issues}
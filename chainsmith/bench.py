@@ -0,0 +1,305 @@
+"""
+This module benchmarks TLS handshakes with certificates generated by
+ChainSmith. It starts a local TLS server on loopback with a server cert,
+and runs many concurrent client handshakes (optionally with client certs)
+against it, to compare key types and chain layouts with real numbers.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from socket import create_server, create_connection
+from tempfile import TemporaryDirectory
+from threading import Lock, Thread
+from time import perf_counter
+import ssl
+import yaml
+
+from chainsmith.x509 import PEM_RE
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+RECV_SIZE = 65536
+
+
+def split_pem(text):
+    """Return a list of all PEM blocks in a string"""
+    return [match.group(0) + '\n' for match in PEM_RE.finditer(text)]
+
+
+def read_yaml(path, key):
+    """Read the certs or private_keys yaml as written by chainsmith"""
+    if not path:
+        raise Exception(f'bench-handshake needs the {key} yaml written to a '
+                        'file, see --help')
+    with open(path, encoding="utf8") as yaml_file:
+        return yaml.load(yaml_file, Loader=Loader)[key]
+
+
+def percentile(values, fraction):
+    """Return a percentile from a sorted list of values"""
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Identity:
+    """
+    Identity holds the material for one side of a handshake:
+    a cert with its chain, its private key and the root to trust.
+    """
+
+    certfile = ''
+    keyfile = ''
+    __cert = ''
+    __key = ''
+    __chain = None
+    __label = ''
+
+    def __init__(self, certs, keys, intermediate, name):
+        try:
+            int_certs = certs[intermediate]
+            if name is None:
+                # The first PEM cert, not a .der entry (or the chain)
+                name = next(key for key, value in int_certs.items()
+                            if key != 'chain' and PEM_RE.match(value))
+            self.__cert = int_certs[name]
+            self.__key = keys[intermediate][name]
+            self.__chain = split_pem(int_certs['chain'])
+        except (KeyError, StopIteration) as key_error:
+            raise Exception('cannot find cert', intermediate, name) \
+                from key_error
+        self.__label = intermediate + '_' + name
+
+    def root(self):
+        """Return the root of the chain, which the peer should trust"""
+        return self.__chain[-1]
+
+    def write(self, tmpdir, trim_chain):
+        """
+        Write cert (with chain) and key to files, so that ssl can load them
+        :param tmpdir: the folder to write the files into
+        :param trim_chain: leave the root out of the chain
+        """
+        chain = self.__chain
+        if trim_chain:
+            # The root is a trust anchor, the peer already has it
+            chain = chain[:-1]
+        self.certfile = join(tmpdir, self.__label + '.pem')
+        self.keyfile = join(tmpdir, self.__label + '.key.pem')
+        with open(self.certfile, 'w', encoding="utf8") as certfile:
+            certfile.write(self.__cert.rstrip('\n') + '\n')
+            certfile.write(''.join(chain))
+        with open(self.keyfile, 'w', encoding="utf8") as keyfile:
+            keyfile.write(self.__key)
+
+
+class HandshakeServer(Thread):
+    """
+    HandshakeServer accepts TLS connections on loopback, completes the
+    handshake, sends one byte of application data and closes the connection.
+    Handshakes that fail on the server are recorded, so that a benchmark
+    cannot count them as successful.
+    """
+
+    __context = None
+    __sock = None
+    __pool = None
+    __errors = None
+    __lock = None
+
+    def __init__(self, identity, client_root, workers):
+        super().__init__(daemon=True)
+        self.__context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.__context.load_cert_chain(identity.certfile, identity.keyfile)
+        # No session tickets, every handshake should be a full handshake
+        self.__context.num_tickets = 0
+        if client_root:
+            self.__context.verify_mode = ssl.CERT_REQUIRED
+            self.__context.load_verify_locations(cadata=client_root)
+        self.__sock = create_server(('127.0.0.1', 0))
+        self.__pool = ThreadPoolExecutor(max_workers=workers)
+        self.__errors = []
+        self.__lock = Lock()
+
+    def address(self):
+        """Return the address the server listens on"""
+        return self.__sock.getsockname()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.__sock.accept()
+            except OSError:
+                return
+            self.__pool.submit(self.handle, conn)
+
+    def handle(self, conn):
+        """
+        Handshake with one client, send it one byte (which it only receives
+        when the server accepted the handshake, also under TLS 1.3 where the
+        client cert is checked after the client finished) and wait for it to
+        close
+        """
+        try:
+            with self.__context.wrap_socket(conn, server_side=True) as tls:
+                tls.sendall(b'\0')
+                tls.recv(1)
+        except (OSError, ssl.SSLError) as error:
+            with self.__lock:
+                self.__errors.append(error)
+        finally:
+            conn.close()
+
+    def errors(self):
+        """Return the errors of all handshakes that failed on the server"""
+        with self.__lock:
+            return list(self.__errors)
+
+    def stop(self):
+        """Stop accepting connections"""
+        self.__sock.close()
+        self.__pool.shutdown(wait=True)
+
+
+# pylint: disable=too-few-public-methods
+class HandshakeClient:
+    """
+    HandshakeClient runs handshakes against a HandshakeServer.
+    It pumps the TLS records through memory BIOs, so that the bytes on the
+    wire can be counted.
+    """
+
+    __context = None
+    __address = None
+
+    def __init__(self, address, server_root, identity):
+        self.__address = address
+        self.__context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        # Certs with a single name have no SAN extension, and python does
+        # not fall back to the CN. The chain itself is still verified.
+        self.__context.check_hostname = False
+        self.__context.load_verify_locations(cadata=server_root)
+        if identity:
+            self.__context.load_cert_chain(identity.certfile,
+                                           identity.keyfile)
+
+    def handshake(self):
+        """
+        Run one full handshake, and read the byte the server sends after it,
+        so that handshakes the server rejects fail here as well
+        :return: a tuple (seconds, bytes sent, bytes received)
+        """
+        counts = [0, 0]
+        incoming = ssl.MemoryBIO()
+        outgoing = ssl.MemoryBIO()
+        start = perf_counter()
+        with create_connection(self.__address) as sock:
+            tls = self.__context.wrap_bio(incoming, outgoing)
+            self.__pump(sock, tls.do_handshake, incoming, outgoing, counts)
+            if not self.__pump(sock, lambda: tls.read(1), incoming, outgoing,
+                               counts):
+                raise ConnectionError('server closed the connection after '
+                                      'the handshake')
+            elapsed = perf_counter() - start
+        return elapsed, counts[0], counts[1]
+
+    @staticmethod
+    def __pump(sock, operation, incoming, outgoing, counts):
+        """
+        Run a TLS operation, moving records between the socket and the
+        memory BIOs until it completes
+        :param counts: a list with the bytes sent and received, to update
+        :return: the result of the operation
+        """
+        while True:
+            try:
+                result = operation()
+                break
+            except ssl.SSLWantReadError as want_read:
+                data = outgoing.read()
+                if data:
+                    sock.sendall(data)
+                    counts[0] += len(data)
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    raise ConnectionError('server closed the connection '
+                                          'during the handshake') \
+                        from want_read
+                incoming.write(data)
+                counts[1] += len(data)
+        data = outgoing.read()
+        if data:
+            sock.sendall(data)
+            counts[0] += len(data)
+        return result
+
+
+def check_server(server):
+    """Raise the errors of handshakes that failed on the server"""
+    errors = server.errors()
+    if errors:
+        raise Exception(f'{len(errors)} handshakes failed on the server, '
+                        f'the first with: {errors[0]}')
+
+
+# pylint: disable=too-many-locals
+def bench_handshake(config):
+    """
+    Benchmark TLS handshakes with certs from the certs and private_keys yaml
+    written by chainsmith, and write the results as yaml to stdout
+    """
+    certs = read_yaml(config.get('certspath'), 'certs')
+    keys = read_yaml(config.get('privatekeyspath'), 'private_keys')
+    handshakes = int(config.get('handshakes') or 1000)
+    clients = int(config.get('clients') or 8)
+    trim_chain = bool(config.get('trim_chain'))
+    server_id = Identity(certs, keys,
+                         config.get('server_intermediate') or 'server',
+                         config.get('server_cert'))
+    client_id = None
+    if not config.get('no_client_cert'):
+        client_id = Identity(certs, keys,
+                             config.get('client_intermediate') or 'client',
+                             config.get('client_cert'))
+    with TemporaryDirectory() as tmpdir:
+        server_id.write(tmpdir, trim_chain)
+        if client_id:
+            client_id.write(tmpdir, trim_chain)
+        server = HandshakeServer(server_id,
+                                 client_id.root() if client_id else None,
+                                 clients)
+        server.start()
+        client = HandshakeClient(server.address(), server_id.root(),
+                                 client_id)
+        try:
+            # One warm up handshake, so that a broken setup fails early
+            client.handshake()
+            check_server(server)
+            start = perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                results = list(pool.map(lambda _: client.handshake(),
+                                        range(handshakes)))
+            duration = perf_counter() - start
+            check_server(server)
+        finally:
+            server.stop()
+    latencies = sorted(result[0] for result in results)
+    report = {
+        'handshakes': handshakes,
+        'clients': clients,
+        'client_cert': client_id is not None,
+        'trimmed_chain': trim_chain,
+        'seconds': round(duration, 3),
+        'handshakes_per_second': round(handshakes / duration, 1),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+        },
+        'bytes_per_handshake': {
+            'sent': sum(result[1] for result in results) // handshakes,
+            'received': sum(result[2] for result in results) // handshakes,
+        },
+    }
+    print(yaml.dump({'bench_handshake': report}, default_flow_style=False,
+                    sort_keys=False), end='')
@@ -0,0 +1,227 @@
+"""
+This module writes an OpenSSL hashed CA directory (the layout c_rehash
+creates, for -CApath / sslrootcert directories): a file per CA cert (and
+CRL), with symlinks named <hash>.<n> for certs and <hash>.r<n> for CRLs,
+where hash is the OpenSSL subject name hash.
+The hash is computed in-process, so no openssl process (or c_rehash) runs
+per file, and the directory is updated in place: links and files are
+replaced at once, and only what chainsmith wrote before is removed.
+"""
+from glob import glob
+import hashlib
+from os import listdir, makedirs, readlink, remove, replace, symlink
+from os.path import basename, exists, islink, join
+import re
+
+from chainsmith.exceptions import X509ParseException
+from chainsmith.x509 import X509Cert, children, crl_issuer, encode, \
+    pem_blocks
+
+TAG_UTF8_STRING = 0x0c
+TAG_SET = 0x31
+
+# The string types that OpenSSL canonicalizes (ASN1_MASK_CANON), with the
+# codec to read them as text
+CANONICAL_CODECS = {
+    0x0c: 'utf8',       # UTF8String
+    0x13: 'latin-1',    # PrintableString
+    0x14: 'latin-1',    # T61String
+    0x16: 'latin-1',    # IA5String
+    0x1a: 'latin-1',    # VisibleString
+    0x1c: 'utf-32-be',  # UniversalString
+    0x1e: 'utf-16-be',  # BMPString
+}
+# The characters that isspace() matches in the C locale
+SPACES = b' \t\n\v\f\r'
+SPACES_RE = re.compile(rb'[ \t\n\v\f\r]+')
+
+LINK_RE = re.compile(r'^[0-9a-f]{8}\.r?[0-9]+$')
+# Files that chainsmith writes, and may remove again: the cert and CRL of
+# every CA, and its extra CRLs (like root.<stem>.crl.pem)
+FILE_RE = re.compile(r'^(root|int_[^/.]+)(\.[^/]+)?\.(cert|crl)\.pem$')
+
+
+def canonical_value(tag, value):
+    """
+    Return the canonical encoding of an attribute value, like OpenSSL does
+    for name hashes: strings as UTF8String, without leading and trailing
+    spaces, with inner spaces collapsed, and ASCII lowercased.
+    Other types are kept as they are.
+    """
+    codec = CANONICAL_CODECS.get(tag)
+    if codec is None:
+        return encode(tag, value)
+    text = value.decode(codec, errors='replace').encode('utf8')
+    text = SPACES_RE.sub(b' ', text.strip(SPACES))
+    return encode(TAG_UTF8_STRING, bytes(
+        byte + 32 if 0x41 <= byte <= 0x5a else byte for byte in text))
+
+
+def canonical_name(name):
+    """
+    Return the canonical encoding of a Name: its RDNs with canonical values,
+    without the outer SEQUENCE
+    :param name: the DER content of the Name
+    """
+    rdns = b''
+    for _, rdn, _ in children(name):
+        attributes = []
+        for _, attribute, _ in children(rdn):
+            parts = children(attribute)
+            oid = parts[0][2]
+            tag, value, _ = parts[1]
+            attributes.append(encode(0x30, oid + canonical_value(tag, value)))
+        # A SET OF is DER encoded with its elements in sorted order
+        rdns += encode(TAG_SET, b''.join(sorted(attributes)))
+    return rdns
+
+
+def name_hash(name):
+    """
+    Return the OpenSSL hash of a Name (as by openssl x509 -hash), being
+    the first four bytes of the SHA-1 of the canonical encoding, read
+    little endian
+    :param name: the DER content of the Name
+    """
+    digest = hashlib.sha1(canonical_name(name)).digest()
+    return f'{int.from_bytes(digest[:4], "little"):08x}'
+
+
+class HashedDir:
+    """
+    HashedDir writes CA certs and CRLs into a hashed CA directory.
+    Hashes that collide get the next free suffix, also when other files
+    (not written by chainsmith) already use a name.
+    """
+
+    __path = ''
+    __files = None
+    __links = None
+
+    def __init__(self, path):
+        """
+        :param path: the directory to write (it is created when needed)
+        """
+        self.__path = path
+        self.__files = {}
+        self.__links = {}
+
+    def add_cert(self, name, pem):
+        """
+        Add a CA cert
+        :param name: the name of the file (e.a. int_server.cert.pem)
+        :param pem: the PEM cert
+        """
+        cert = X509Cert.from_pem(pem)
+        self.__add(name, pem, name_hash(cert.subject_der()), '')
+
+    def add_crl(self, name, pem):
+        """
+        Add a CRL, hashed by the name of its issuer
+        :param name: the name of the file (e.a. root.crl.pem)
+        :param pem: the PEM CRL
+        """
+        blocks = pem_blocks(pem, 'X509 CRL')
+        if not blocks:
+            raise X509ParseException('no CRL found in', name)
+        self.__add(name, pem, name_hash(crl_issuer(blocks[0])), 'r')
+
+    def __add(self, name, pem, hash_value, kind):
+        if not pem.endswith('\n'):
+            pem += '\n'
+        self.__files[name] = pem
+        self.__links.setdefault((hash_value, kind), []).append(name)
+
+    def __foreign_links(self):
+        """Return the links in the directory that chainsmith did not write"""
+        foreign = set()
+        for entry in listdir(self.__path):
+            path = join(self.__path, entry)
+            if LINK_RE.match(entry) and \
+                    not (islink(path) and FILE_RE.match(readlink(path))):
+                foreign.add(entry)
+        return foreign
+
+    def __write_files(self):
+        for name, pem in self.__files.items():
+            path = join(self.__path, name)
+            if exists(path):
+                with open(path, encoding="utf8") as current:
+                    if current.read() == pem:
+                        continue
+            with open(path + '.tmp', 'w', encoding="utf8") as file:
+                file.write(pem)
+            replace(path + '.tmp', path)
+
+    def __assign_links(self):
+        """Return the file every link points to, by link"""
+        taken = self.__foreign_links()
+        linked = {}
+        for (hash_value, kind), names in sorted(self.__links.items()):
+            suffix = 0
+            for name in sorted(names):
+                while f'{hash_value}.{kind}{suffix}' in taken:
+                    suffix += 1
+                link = f'{hash_value}.{kind}{suffix}'
+                taken.add(link)
+                linked[link] = name
+        return linked
+
+    def __write_links(self, linked):
+        for link, name in linked.items():
+            path = join(self.__path, link)
+            if islink(path) and readlink(path) == name:
+                continue
+            # Replace the link at once, so that it is never missing
+            if islink(path + '.tmp'):
+                remove(path + '.tmp')
+            symlink(name, path + '.tmp')
+            replace(path + '.tmp', path)
+
+    def __remove_stale(self, linked):
+        for entry in listdir(self.__path):
+            path = join(self.__path, entry)
+            if LINK_RE.match(entry) and entry not in linked and \
+                    islink(path) and FILE_RE.match(readlink(path)):
+                remove(path)
+            elif FILE_RE.match(entry) and entry not in self.__files:
+                remove(path)
+
+    def write(self):
+        """
+        Write all files and links, and remove the files and links that were
+        written before but are no longer added
+        :return: the names of the links, by file
+        """
+        makedirs(self.__path, exist_ok=True)
+        self.__write_files()
+        linked = self.__assign_links()
+        self.__write_links(linked)
+        self.__remove_stale(linked)
+        links = {}
+        for link, name in sorted(linked.items()):
+            links.setdefault(name, []).append(link)
+        return links
+
+
+def write_hashed_dir(root, path):
+    """
+    Write the certs of a root CA and its intermediates, and the CRLs in
+    their crl folders, into a hashed CA directory
+    :param root: the root TlsCA
+    :param path: the directory to write
+    :return: the names of the links, by file
+    """
+    hashed_dir = HashedDir(path)
+    cas = [('root', root)] + [('int_' + name, root.intermediate(name))
+                              for name in root.intermediates()]
+    for prefix, tls_ca in cas:
+        hashed_dir.add_cert(prefix + '.cert.pem', tls_ca.get_cert())
+        for crl_path in sorted(glob(join(tls_ca.path(), 'crl', '*.pem'))):
+            with open(crl_path, encoding="utf8") as crl:
+                # Every CRL file of a CA gets a file of its own
+                stem = basename(crl_path)[:-len('.pem')]
+                name = prefix + '.crl.pem' if stem == 'crl' else \
+                    f'{prefix}.{stem}.crl.pem'
+                hashed_dir.add_crl(name, crl.read())
+    return hashed_dir.write()
@@ -0,0 +1,299 @@
+"""
+This module builds X.509 certificates and certificate signing requests
+in-process, for CAs whose private key can only be asked to sign (like a
+key in an HSM). The signature itself is made by a signer; this module only
+builds the DER that is signed, and wraps the signature around it.
+Extensions are read from the same sections of the config files that openssl
+would use (v3_ca, v3_intermediate_ca, v3_req), for what ChainSmith writes
+in them: basic constraints, (extended) key usages, alternate names and key
+identifiers.
+"""
+from datetime import datetime, timedelta, timezone
+import hashlib
+from ipaddress import ip_address
+from secrets import randbits
+
+from chainsmith.x509 import OID_NAMES, OID_RSA_ENCRYPTION, children, \
+    encode, pem_encode, read_element
+
+OID_SHA256_WITH_RSA = '1.2.840.113549.1.1.11'
+OID_SUBJECT_KEY_IDENTIFIER = '2.5.29.14'
+OID_KEY_USAGE = '2.5.29.15'
+OID_SUBJECT_ALT_NAME = '2.5.29.17'
+OID_BASIC_CONSTRAINTS = '2.5.29.19'
+OID_AUTHORITY_KEY_IDENTIFIER = '2.5.29.35'
+OID_EXTENDED_KEY_USAGE = '2.5.29.37'
+OID_COUNTRY = '2.5.4.6'
+OID_EMAIL_ADDRESS = '1.2.840.113549.1.9.1'
+
+NAME_OIDS = {name: oid for oid, name in OID_NAMES.items()}
+
+KEY_USAGE_BITS = {
+    'digitalSignature': 0,
+    'nonRepudiation': 1,
+    'keyEncipherment': 2,
+    'dataEncipherment': 3,
+    'keyAgreement': 4,
+    'keyCertSign': 5,
+    'cRLSign': 6,
+    'encipherOnly': 7,
+    'decipherOnly': 8,
+}
+
+EXTENDED_KEY_USAGE_OIDS = {
+    'serverAuth': '1.3.6.1.5.5.7.3.1',
+    'clientAuth': '1.3.6.1.5.5.7.3.2',
+    'codeSigning': '1.3.6.1.5.5.7.3.3',
+    'emailProtection': '1.3.6.1.5.5.7.3.4',
+    'timeStamping': '1.3.6.1.5.5.7.3.8',
+    'OCSPSigning': '1.3.6.1.5.5.7.3.9',
+}
+
+TAG_INTEGER = 0x02
+TAG_BIT_STRING = 0x03
+TAG_OCTET_STRING = 0x04
+TAG_NULL = 0x05
+TAG_OID = 0x06
+TAG_UTF8_STRING = 0x0c
+TAG_PRINTABLE_STRING = 0x13
+TAG_IA5_STRING = 0x16
+TAG_UTC_TIME = 0x17
+TAG_GENERALIZED_TIME = 0x18
+TAG_SEQUENCE = 0x30
+TAG_SET = 0x31
+
+
+def encode_integer(value):
+    """Return the DER encoding of a non negative INTEGER"""
+    return encode(TAG_INTEGER, value.to_bytes(value.bit_length() // 8 + 1,
+                                              'big'))
+
+
+def encode_oid(oid):
+    """Return the DER encoding of an OBJECT IDENTIFIER like '2.5.4.3'"""
+    numbers = [int(number) for number in oid.split('.')]
+    content = bytearray([numbers[0] * 40 + numbers[1]])
+    for number in numbers[2:]:
+        chunk = [number & 0x7f]
+        number >>= 7
+        while number:
+            chunk.append(0x80 | (number & 0x7f))
+            number >>= 7
+        content += bytes(reversed(chunk))
+    return encode(TAG_OID, bytes(content))
+
+
+def encode_bit_string(data, unused=0):
+    """Return the DER encoding of a BIT STRING"""
+    return encode(TAG_BIT_STRING, bytes([unused]) + data)
+
+
+def encode_time(moment):
+    """
+    Return a datetime as UTCTime (until 2049) or GeneralizedTime, as
+    RFC 5280 prescribes
+    """
+    moment = moment.astimezone(timezone.utc)
+    if moment.year < 2050:
+        return encode(TAG_UTC_TIME,
+                      moment.strftime('%y%m%d%H%M%SZ').encode('ascii'))
+    return encode(TAG_GENERALIZED_TIME,
+                  moment.strftime('%Y%m%d%H%M%SZ').encode('ascii'))
+
+
+def encode_name(subject):
+    """
+    Return the DER encoding of a Name
+    :param subject: (key, value) pairs, like the items of a TlsSubject
+    """
+    rdns = b''
+    for key, value in subject:
+        oid = NAME_OIDS.get(key, key)
+        if oid == OID_COUNTRY:
+            tag = TAG_PRINTABLE_STRING
+        elif oid == OID_EMAIL_ADDRESS:
+            tag = TAG_IA5_STRING
+        else:
+            tag = TAG_UTF8_STRING
+        rdns += encode(TAG_SET, encode(TAG_SEQUENCE, encode_oid(oid) +
+                                       encode(tag, value.encode('utf8'))))
+    return encode(TAG_SEQUENCE, rdns)
+
+
+def algorithm_identifier(oid):
+    """Return an AlgorithmIdentifier with NULL parameters"""
+    return encode(TAG_SEQUENCE, encode_oid(oid) + encode(TAG_NULL, b''))
+
+
+def rsa_public_key_info(modulus, exponent):
+    """Return the DER encoded SubjectPublicKeyInfo of an RSA public key"""
+    key = encode(TAG_SEQUENCE, encode_integer(modulus) +
+                 encode_integer(exponent))
+    return encode(TAG_SEQUENCE, algorithm_identifier(OID_RSA_ENCRYPTION) +
+                  encode_bit_string(key))
+
+
+def key_identifier(public_key_info):
+    """
+    Return the key identifier of a public key: the SHA-1 of the
+    subjectPublicKey bits (method 1 of RFC 5280, as openssl does)
+    """
+    _, start, end = read_element(public_key_info)
+    bits = children(public_key_info[start:end])[1][1]
+    return hashlib.sha1(bits[1:]).digest()
+
+
+def extension(oid, value, critical=False):
+    """Return an Extension with a DER encoded value"""
+    content = encode_oid(oid)
+    if critical:
+        content += encode(0x01, b'\xff')
+    return encode(TAG_SEQUENCE, content + encode(TAG_OCTET_STRING, value))
+
+
+def split_values(value):
+    """
+    Split a cnf value like 'critical, CA:true, pathlen:0' into a critical
+    flag and a list of values
+    """
+    values = [part.strip() for part in value.split(',') if part.strip()]
+    critical = 'critical' in values
+    return critical, [part for part in values if part != 'critical']
+
+
+def basic_constraints(value):
+    """Return the basicConstraints extension for a cnf value"""
+    critical, values = split_values(value)
+    content = b''
+    for part in values:
+        key, _, setting = part.partition(':')
+        if key == 'CA' and setting.lower() == 'true':
+            content += encode(0x01, b'\xff')
+        elif key == 'pathlen':
+            content += encode_integer(int(setting))
+    return extension(OID_BASIC_CONSTRAINTS, encode(TAG_SEQUENCE, content),
+                     critical)
+
+
+def key_usage(value):
+    """Return the keyUsage extension for a cnf value"""
+    critical, values = split_values(value)
+    positions = [KEY_USAGE_BITS[usage] for usage in values]
+    # Bit 0 is the most significant bit of the first byte, and DER leaves
+    # out trailing zero bits
+    length = max(positions, default=-1) + 1
+    bits = bytearray((length + 7) // 8)
+    for position in positions:
+        bits[position // 8] |= 0x80 >> (position % 8)
+    return extension(OID_KEY_USAGE,
+                     encode_bit_string(bytes(bits), len(bits) * 8 - length),
+                     critical)
+
+
+def extended_key_usage(value):
+    """Return the extendedKeyUsage extension for a cnf value"""
+    critical, values = split_values(value)
+    return extension(OID_EXTENDED_KEY_USAGE, encode(
+        TAG_SEQUENCE, b''.join(encode_oid(EXTENDED_KEY_USAGE_OIDS[usage])
+                               for usage in values)), critical)
+
+
+def subject_alt_name(names):
+    """
+    Return the subjectAltName extension
+    :param names: (type, value) pairs, with type DNS or IP
+    """
+    content = b''
+    for kind, value in names:
+        if kind == 'IP':
+            content += encode(0x87, ip_address(value).packed)
+        else:
+            content += encode(0x82, value.encode('ascii'))
+    return extension(OID_SUBJECT_ALT_NAME, encode(TAG_SEQUENCE, content))
+
+
+def alt_names(config_file, value):
+    """
+    Return the (type, value) pairs of a subjectAltName cnf value, being a
+    list like 'DNS:name, IP:address' or a reference to a section (@name)
+    """
+    value = value.strip()
+    if value.startswith('@'):
+        chapter = config_file.get_chapter(value[1:])
+        return [(line.name().partition('.')[0], line[1])
+                for line in chapter if line.name()]
+    _, values = split_values(value)
+    return [tuple(part.split(':', 1)) for part in values]
+
+
+def cnf_extensions(config_file, section, public_key_info, issuer_key_info):
+    """
+    Return the DER encoded extensions for a certificate, from a section of
+    an openssl config file.
+    Key identifiers are added like openssl 3 does by default.
+    :param config_file: the ConfigFile holding the section
+    :param public_key_info: the SubjectPublicKeyInfo of the certificate
+    :param issuer_key_info: the SubjectPublicKeyInfo of the issuer
+    """
+    extensions = []
+    for line in config_file.get_chapter(section):
+        key = line.name()
+        if key == 'basicConstraints':
+            extensions.append(basic_constraints(line[1]))
+        elif key == 'keyUsage':
+            extensions.append(key_usage(line[1]))
+        elif key == 'extendedKeyUsage':
+            extensions.append(extended_key_usage(line[1]))
+        elif key == 'subjectAltName':
+            extensions.append(subject_alt_name(alt_names(config_file,
+                                                         line[1])))
+    extensions.append(extension(OID_SUBJECT_KEY_IDENTIFIER, encode(
+        TAG_OCTET_STRING, key_identifier(public_key_info))))
+    extensions.append(extension(OID_AUTHORITY_KEY_IDENTIFIER, encode(
+        TAG_SEQUENCE, encode(0x80, key_identifier(issuer_key_info)))))
+    return encode(TAG_SEQUENCE, b''.join(extensions))
+
+
+def random_serial():
+    """Return a random positive serial of at most 20 bytes"""
+    return randbits(159) | 1 << 158
+
+
+def tbs_certificate(issuer, subject, public_key_info, *, days, extensions):
+    """
+    Return a DER encoded TBSCertificate with a random serial, valid from now
+    on
+    :param issuer: the DER encoded Name of the issuer
+    :param subject: the DER encoded Name of the subject
+    :param extensions: the DER encoded Extensions (see cnf_extensions)
+    """
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    validity = encode(TAG_SEQUENCE, encode_time(now) +
+                      encode_time(now + timedelta(days=days)))
+    return encode(TAG_SEQUENCE,
+                  encode(0xa0, encode_integer(2)) +
+                  encode_integer(random_serial()) +
+                  algorithm_identifier(OID_SHA256_WITH_RSA) +
+                  issuer + validity + subject + public_key_info +
+                  encode(0xa3, extensions))
+
+
+def certificate(tbs, signature):
+    """Return a PEM certificate for a TBSCertificate and its signature"""
+    return pem_encode(encode(TAG_SEQUENCE, tbs +
+                             algorithm_identifier(OID_SHA256_WITH_RSA) +
+                             encode_bit_string(signature)), 'CERTIFICATE')
+
+
+def request_info(subject, public_key_info):
+    """Return a DER encoded CertificationRequestInfo without attributes"""
+    return encode(TAG_SEQUENCE, encode_integer(0) + subject +
+                  public_key_info + encode(0xa0, b''))
+
+
+def request(info, signature):
+    """Return a PEM certificate signing request for a request info"""
+    return pem_encode(encode(TAG_SEQUENCE, info +
+                             algorithm_identifier(OID_SHA256_WITH_RSA) +
+                             encode_bit_string(signature)),
+                      'CERTIFICATE REQUEST')
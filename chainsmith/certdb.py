@@ -0,0 +1,209 @@
+"""
+This module maintains an indexed inventory of everything a CA store has
+issued. The inventory is a SQLite database inside the CA store, indexed on
+CN, SAN, serial, intermediate and notAfter, so that questions like
+"which certs contain SAN X" do not require parsing every PEM in the store.
+"""
+from datetime import datetime
+from glob import glob
+from os.path import basename, join
+import sqlite3
+
+from chainsmith.x509 import X509Cert
+
+DB_FILE = 'certs.db'
+
+# Files in the certs folder of a CA that are not issued certificates
+CA_FILES = ['cacert.pem', 'ca-chain-bundle.cert.pem']
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS certs ('
+    ' id INTEGER PRIMARY KEY,'
+    ' kind TEXT NOT NULL,'
+    ' intermediate TEXT NOT NULL,'
+    ' name TEXT NOT NULL,'
+    ' cn TEXT,'
+    ' serial TEXT NOT NULL,'
+    ' not_after TEXT NOT NULL,'
+    ' path TEXT NOT NULL,'
+    ' UNIQUE (intermediate, name))',
+    'CREATE TABLE IF NOT EXISTS sans ('
+    ' cert_id INTEGER NOT NULL REFERENCES certs(id) ON DELETE CASCADE,'
+    ' san TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS certs_cn ON certs (cn)',
+    'CREATE INDEX IF NOT EXISTS certs_serial ON certs (serial)',
+    'CREATE INDEX IF NOT EXISTS certs_intermediate ON certs (intermediate)',
+    'CREATE INDEX IF NOT EXISTS certs_not_after ON certs (not_after)',
+    'CREATE INDEX IF NOT EXISTS sans_san ON sans (san)',
+    'CREATE INDEX IF NOT EXISTS sans_cert_id ON sans (cert_id)',
+]
+
+
+class CertDB:
+    """
+    CertDB wraps the SQLite inventory of a CA store.
+    The root CA opens it, and intermediates share it with their root.
+    Every CA and certificate is recorded once it has been signed.
+    """
+
+    __path = ''
+    __conn = None
+
+    def __init__(self, path, read_only=False):
+        """
+        :param path: the path of the database file
+        :param read_only: open an existing database for queries only (e.a.
+                          from an Ansible lookup), without creating it
+        """
+        self.__path = path
+        if read_only:
+            self.__conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            return
+        self.__conn = sqlite3.connect(path)
+        self.__conn.execute('PRAGMA foreign_keys = ON')
+        self.__conn.execute('PRAGMA journal_mode = WAL')
+        self.__conn.execute('PRAGMA synchronous = NORMAL')
+        for statement in SCHEMA:
+            self.__conn.execute(statement)
+        self.__conn.commit()
+
+    @classmethod
+    def for_store(cls, capath, read_only=False):
+        """Open the inventory database of the CA store at capath"""
+        return cls(join(capath, DB_FILE), read_only)
+
+    def path(self):
+        """Return the path of the database file"""
+        return self.__path
+
+    def close(self):
+        """Close the database connection"""
+        self.__conn.close()
+
+    def add(self, kind, intermediate, name, cert_path):
+        """
+        Record (or replace) a certificate in the inventory
+        :param kind: root, intermediate or cert
+        :param intermediate: the name of the CA this cert belongs to
+        :param name: the name of the cert (first name in the SAN list)
+        :param cert_path: the path of the PEM file holding the cert
+        :return: the X509Cert that was recorded
+        """
+        cert = self.__add(kind, intermediate, name, cert_path)
+        self.__conn.commit()
+        return cert
+
+    def remove(self, intermediate, name=None):
+        """
+        Remove a certificate (or all certificates of an intermediate) from
+        the inventory, e.a. when it is retired
+        """
+        if name is None:
+            self.__conn.execute('DELETE FROM certs WHERE intermediate = ?',
+                                (intermediate,))
+        else:
+            self.__conn.execute('DELETE FROM certs WHERE intermediate = ? '
+                                'AND name = ?', (intermediate, name))
+        self.__conn.commit()
+
+    def earliest_expiry(self):
+        """
+        Return the earliest notAfter of the certs issued by every CA, as a
+        dict of CA name to datetime
+        """
+        return {intermediate: datetime.fromisoformat(not_after)
+                for intermediate, not_after in self.__conn.execute(
+                    'SELECT intermediate, MIN(not_after) FROM certs '
+                    'GROUP BY intermediate')}
+
+    def __add(self, kind, intermediate, name, cert_path):
+        cert = X509Cert.from_file(cert_path)
+        self.__conn.execute('DELETE FROM certs WHERE intermediate = ? '
+                            'AND name = ?', (intermediate, name))
+        cursor = self.__conn.execute(
+            'INSERT INTO certs (kind, intermediate, name, cn, serial, '
+            'not_after, path) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (kind, intermediate, name, cert.common_name(), cert.serial_hex(),
+             cert.not_after().isoformat(), cert_path))
+        self.__conn.executemany(
+            'INSERT INTO sans (cert_id, san) VALUES (?, ?)',
+            [(cursor.lastrowid, san)
+             for san in cert.subject_alternative_names()])
+        return cert
+
+    def import_store(self, capath):
+        """
+        Index all CAs and certs of an existing CA store in one transaction.
+        This is a one-off for stores that were created before the inventory
+        was maintained.
+        :param capath: the path of the root CA (tmpdir/tls)
+        :return: the number of certificates that were indexed
+        """
+        root_cert = join(capath, 'certs', 'cacert.pem')
+        root_name = X509Cert.from_file(root_cert).common_name()
+        self.__add('root', root_name, root_name, root_cert)
+        count = 1
+        for int_path in sorted(glob(join(capath, 'int_*'))):
+            int_name = basename(int_path)[4:]
+            self.__add('intermediate', root_name, int_name,
+                       join(int_path, 'certs', 'cacert.pem'))
+            count += 1
+            for cert_path in sorted(glob(join(int_path, 'certs', '*.pem'))):
+                if basename(cert_path) in CA_FILES:
+                    continue
+                self.__add('cert', int_name, basename(cert_path)[:-4],
+                           cert_path)
+                count += 1
+        self.__conn.commit()
+        return count
+
+    # pylint: disable=too-many-arguments
+    def query(self, cn=None, san=None, serial=None, intermediate=None,
+              expires_before=None):
+        """
+        Find certificates in the inventory.
+        All filters that are set must match.
+        :param cn: the common name of the cert
+        :param san: a subject alternative name (DNS name or IP)
+        :param serial: the serial as a hex string
+        :param intermediate: the name of the CA that signed the cert
+        :param expires_before: a datetime before which notAfter should be
+        :return: a list of dicts, one per matching certificate
+        """
+        clauses = []
+        params = []
+        if cn:
+            clauses.append('c.cn = ?')
+            params.append(cn)
+        if san:
+            clauses.append('c.id IN (SELECT cert_id FROM sans WHERE san = ?)')
+            params.append(san)
+        if serial:
+            clauses.append('c.serial = ?')
+            params.append(serial.upper().replace(':', '').lstrip('0') or '0')
+        if intermediate:
+            clauses.append('c.intermediate = ?')
+            params.append(intermediate)
+        if expires_before:
+            clauses.append('c.not_after < ?')
+            params.append(expires_before.isoformat())
+        sql = ('SELECT c.id, c.kind, c.intermediate, c.name, c.cn, c.serial, '
+               'c.not_after, c.path FROM certs c')
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY c.not_after'
+        results = []
+        for row in self.__conn.execute(sql, params).fetchall():
+            sans = [san for (san,) in self.__conn.execute(
+                'SELECT san FROM sans WHERE cert_id = ?', (row[0],))]
+            results.append({
+                'kind': row[1],
+                'intermediate': row[2],
+                'name': row[3],
+                'cn': row[4],
+                'serial': row[5],
+                'not_after': row[6],
+                'path': row[7],
+                'sans': sans,
+            })
+        return results
@@ -7,18 +7,41 @@ https://www.golinuxcloud.com/openssl-create-certificate-chain-linux/
 https://www.golinuxcloud.com/openssl-create-client-server-certificate/
 """
 
-from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import json
+from os import replace
+from os.path import join, exists, getmtime
 from socket import gethostbyname
+from subprocess import CalledProcessError
 from sys import stdout, stderr
+import sys
 import tempfile
+from time import monotonic, time
 import yaml
-from chainsmith.tls import TlsCA, TlsSubject
+from chainsmith.audit import StoreAudit
+from chainsmith.bench import bench_handshake
+from chainsmith.capath import write_hashed_dir
+from chainsmith.formats import DEFAULT_ENCODINGS
+from chainsmith.certdb import CertDB, DB_FILE
+from chainsmith.distributed import Coordinator, parse_address, run_worker
+from chainsmith.exceptions import ChainSmithException, \
+    ConfigSchemaException, WatchException
+from chainsmith.hsm import close_pools
+from chainsmith.inventory import load as load_inventory
+from chainsmith.journal import Journal, JOURNAL_FILE, read_journal
+from chainsmith.pipeline import Scheduler
+from chainsmith.schema import validate
+from chainsmith.tls import TlsCA, TlsSubject, DEFAULT_EXTENDED_KEY_USAGES, \
+    DEFAULT_KEY_USAGES
+from chainsmith.watch import FileWatcher
+from chainsmith import metrics
 from chainsmith.config import Config
 
 try:
-    from yaml import CLoader as Loader, CDumper as Dumper
+    from yaml import CDumper as Dumper
 except ImportError:
-    from yaml import Loader, Dumper
+    from yaml import Dumper
 
 DEFAULT_SUBJECT = {
     "C": "NL",
@@ -29,59 +52,110 @@ DEFAULT_SUBJECT = {
     "CN": "chainsmith",
 }
 
+# Number of openssl processes that are run to create a root CA, an
+# intermediate and a certificate, and a rough cost per process.
+# Used to estimate the duration of a run in a plan.
+ROOT_PROCESSES = 5
+INTERMEDIATE_PROCESSES = 6
+CERT_PROCESSES = 6
+KEYGEN_SECONDS = 2.0
+PROCESS_SECONDS = 0.02
+# Inventory hosts that are resolved at the same time
+RESOLVE_THREADS = 32
 
-def hosts_from_inventory(hosts_path):
+
+def intermediate_certs(intermediate_config, errors=None,
+                       resolve=gethostbyname):
+    """
+    Return the SAN lists of all certs to be created for an intermediate.
+    Clients come first, then servers. Servers from the inventory are
+    resolved to add their IP address as alternate name.
+    :param intermediate_config: the config of the intermediate
+    :param errors: if set, resolve errors are added to this list instead of
+                   being raised
+    :param resolve: the function that resolves a host to an IP address
+    :return: a list of SAN lists (the first name being the name of the cert)
     """
-    Read host info from Ansible inventory hosts file
-    :param hosts_path: The file to read hostnames from
-    :return: a list of hosts as found in the Ansible inventory hosts file
+    sans = [[client] for client in intermediate_config.get('clients') or []]
+    servers = dict(intermediate_config.get('servers') or {})
+    for host in inventory_hosts(intermediate_config):
+        try:
+            servers[host] = [resolve(host)]
+        except OSError as os_err:
+            if errors is None:
+                raise
+            errors.append(f'cannot resolve {host}: {os_err}')
+            servers[host] = []
+    sans += [[name] + (alts or []) for name, alts in servers.items()]
+    return sans
+
+
+def inventory_hosts(intermediate_config):
     """
-    if not hosts_path:
+    Return the servers of an intermediate that come from the inventory (and
+    are resolved to add their IP address), leaving out configured servers
+    """
+    extended_key_usages = intermediate_config.get(
+        'extendedKeyUsages', DEFAULT_EXTENDED_KEY_USAGES)
+    hosts_path = intermediate_config.get('hosts')
+    if 'serverAuth' not in extended_key_usages or not hosts_path:
         return []
-    try:
-        with open(hosts_path, encoding="utf8") as hosts_file:
-            groups = yaml.load(hosts_file.read(), Loader=Loader)
-    except Exception as error:
-        raise Exception('could not open', hosts_path) from error
-    hosts = []
-    try:
-        for _, group_info in groups['all']['children'].items():
-            try:
-                hosts += group_info['hosts']
-            except KeyError:
-                continue
-    except KeyError as key_error:
-        raise Exception('missing all>children in ' + hosts_path) from key_error
-    if not hosts:
-        raise Exception('no groups with hosts in all>children in '+hosts_path)
-    return hosts
+    servers = intermediate_config.get('servers') or {}
+    inventory = load_inventory(hosts_path)
+    return [host for host in
+            inventory.hosts(intermediate_config.get('hostGroups'))
+            if host not in servers]
+
+
+def resolve_all(hosts, threads=RESOLVE_THREADS):
+    """
+    Resolve hosts on a bounded pool of threads, as every lookup mostly
+    waits for DNS
+    :return: a function that resolves a host like gethostbyname, from the
+             results (and with gethostbyname for other hosts)
+    """
+    def lookup(host):
+        try:
+            return gethostbyname(host)
+        except OSError as os_err:
+            return os_err
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = dict(zip(hosts, pool.map(lookup, hosts)))
+
+    def resolve(host):
+        result = results[host] if host in results else gethostbyname(host)
+        if isinstance(result, OSError):
+            raise result
+        return result
+    return resolve
 
 
-def add_intermediate(root, intermediate_config, data):
+def add_intermediate(root, intermediate_config, scheduler, cert_sans=None):
     """
-    Create an intermediate, and read back certs
+    Create an intermediate, and schedule creation of its certs
     """
-    intermediate_name = intermediate_config['name']
-    intermediate_ca = root.create_int(intermediate_name,
+    if cert_sans is None:
+        cert_sans = intermediate_certs(intermediate_config)
+    intermediate_ca = root.create_int(intermediate_config['name'],
                                       intermediate_config)
-    try:
-        for client in intermediate_config['clients']:
-            intermediate_ca.create_cert([client])
-    except KeyError:
-        pass
+    for san in cert_sans:
+        intermediate_ca.schedule_cert(san, scheduler)
+    return intermediate_ca
 
-    if 'serverAuth' in intermediate_config.get('extended_key_usages', []):
-        for host in hosts_from_inventory(intermediate_config.get('hosts')):
-            if host in intermediate_config['servers']:
-                continue
-            intermediate_config['servers'][host] = [gethostbyname(host)]
 
-    try:
-        for server_name, alts in intermediate_config['servers'].items():
-            intermediate_ca.create_cert([server_name] + alts)
-    except KeyError:
-        pass
+def root_config(config):
+    """Return the config of the root CA, being its pkcs11 config (if any)"""
+    if config.get('pkcs11'):
+        return {'pkcs11': config['pkcs11']}
+    return {}
+
 
+def read_intermediate(intermediate_ca, data):
+    """
+    Read back certs and private keys of an intermediate
+    """
+    intermediate_name = intermediate_ca.name()
     data['certs'][intermediate_name] = intermediate_ca.get_certs()
     data['private_keys'][intermediate_name] = \
         intermediate_ca.get_private_keys()
@@ -97,9 +171,12 @@ def write_data(config, data):
                               default_style='|')
         path = config.get(key.replace('_', '') + 'path')
         if path:
-            with open(path, 'w', encoding="utf8") as file:
+            # Replace the file at once, so that readers never see a file
+            # that is half written
+            with open(path + '.tmp', 'w', encoding="utf8") as file:
                 file.write('---\n')
                 file.write(yaml_data)
+            replace(path + '.tmp', path)
         else:
             if 'private' in key:
                 redirect = stderr
@@ -108,12 +185,562 @@ def write_data(config, data):
             redirect.write(yaml_data)
 
 
-def from_yaml():
+def write_capath(config, root):
+    """
+    Write all CA certs (and CRLs) as a hashed CA directory, so that clients
+    can look up CAs by subject instead of reading a bundle
+    """
+    write_hashed_dir(root, config.get('capath') or
+                     join(root.path(), 'capath'))
+
+
+def parse_expiry(value):
+    """
+    Parse an expiry filter, being either a date (YYYY-MM-DD) or a number of
+    days from now (e.a. 30d)
+    """
+    if not value:
+        return None
+    if value.endswith('d') and value[:-1].isdigit():
+        return datetime.now(timezone.utc) + timedelta(days=int(value[:-1]))
+    expiry = datetime.fromisoformat(value)
+    if expiry.tzinfo is None:
+        expiry = expiry.replace(tzinfo=timezone.utc)
+    return expiry
+
+
+def query_store(config):
+    """
+    Query the inventory of the CA store in tmpdir and write the matching
+    certificates as yaml to stdout
+    """
+    tmpdir = config.get('tmpdir')
+    if not tmpdir:
+        raise Exception('query requires tmpdir to point to a CA store')
+    capath = join(tmpdir, 'tls')
+    if not exists(join(capath, 'certs', 'cacert.pem')):
+        raise Exception('no CA store in', tmpdir)
+    imported = not exists(join(capath, DB_FILE))
+    database = CertDB.for_store(capath)
+    try:
+        if imported or config.get('import_store'):
+            database.import_store(capath)
+        results = database.query(
+            cn=config.get('cn'), san=config.get('san'),
+            serial=config.get('serial'),
+            intermediate=config.get('intermediate'),
+            expires_before=parse_expiry(config.get('expires_before')))
+    finally:
+        database.close()
+    stdout.write(yaml.dump({'certs': results}, Dumper=Dumper,
+                           default_flow_style=False))
+
+
+def audit_chain(config):
+    """
+    Verify every CA and cert of the CA store in tmpdir, and write a report
+    as yaml (or json) to stdout. Exits with an error when any check failed.
+    """
+    tmpdir = config.get('tmpdir')
+    if not tmpdir:
+        raise Exception('audit requires tmpdir to point to a CA store')
+    capath = join(tmpdir, 'tls')
+    if not exists(join(capath, 'certs', 'cacert.pem')):
+        raise Exception('no CA store in', tmpdir)
+    expected = None
+    errors = []
+    if not config.get('skip_config'):
+        try:
+            validate(config)
+        except ConfigSchemaException as schema_error:
+            stderr.write(str(schema_error) + '\n')
+            sys.exit(1)
+        hosts = set()
+        for intermediate in config['intermediates']:
+            hosts.update(inventory_hosts(dict(
+                intermediate, hosts=intermediate.get('hosts',
+                                                     config.get('hosts')))))
+        desired, errors = desired_chain(config, resolve_all(sorted(hosts)))
+        expected = {name: certs for name, (_, _, certs) in desired.items()}
+    report = StoreAudit(capath, expected, config.get('concurrency'),
+                        config.get('warn_days', 30)).run()
+    for error in errors:
+        report['issues'].append({'ca': None, 'cert': None,
+                                 'severity': 'warning', 'check': 'config',
+                                 'message': error})
+        report['summary']['warnings'] += 1
+    if config.get('format') == 'json':
+        stdout.write(json.dumps(report, indent=2) + '\n')
+    else:
+        stdout.write(yaml.dump(report, Dumper=Dumper,
+                               default_flow_style=False, sort_keys=False))
+    if report['summary']['errors']:
+        sys.exit(1)
+
+
+def stored_chain(config):
+    """
+    Return what the CA store in tmpdir holds, for planning a run on it
+    :return: a tuple with a dict of (kind, CA, name) to the alternate names
+             of every CA and cert in the inventory, and the set of steps
+             that a run skips (only when resuming)
+    """
+    tmpdir = config.get('tmpdir')
+    if not tmpdir or not exists(join(tmpdir, 'tls', DB_FILE)):
+        return {}, set()
+    database = CertDB.for_store(join(tmpdir, 'tls'), read_only=True)
+    try:
+        stored = {(row['kind'], row['intermediate'], row['name']):
+                  set(row['sans']) for row in database.query()}
+    finally:
+        database.close()
+    steps = set()
+    if config.get('resume'):
+        steps = read_journal(join(tmpdir, JOURNAL_FILE))
+    return stored, steps
+
+
+def plan_action(stored, reusable):
+    """
+    Return what a run does with a CA or cert: issue it when the store does
+    not have it, and reuse or replace it when it does
+    """
+    if stored is None:
+        return 'issue'
+    return 'reuse' if reusable else 'replace'
+
+
+# pylint: disable=too-many-locals
+def plan_chain(config):
+    """
+    Resolve the config into the set of CAs and certs that a run would issue,
+    without running any openssl process. CAs and certs that the CA store in
+    tmpdir already holds are replaced, or reused when resuming.
+    :param config: the (validated) config
+    :return: a tuple (plan, errors)
+    """
+    errors = []
+    subject = TlsSubject(config.get('subject', DEFAULT_SUBJECT))
+    concurrency = Scheduler(config.get('concurrency')).concurrency()
+    stored, steps = stored_chain(config)
+    keys = processes = cert_keys = 0
+    root_name = subject.get('CN', 'postgres')
+    root_action = plan_action(stored.get(('root', root_name, root_name)),
+                              'root' in steps)
+    plan = {'root': {'name': root_name, 'action': root_action},
+            'intermediates': []}
+    if root_action != 'reuse':
+        keys += 1
+        processes += ROOT_PROCESSES
+    for intermediate in config['intermediates']:
+        name = intermediate['name']
+        intermediate = dict(intermediate)
+        intermediate['hosts'] = intermediate.get('hosts', config.get('hosts'))
+        # A CA that is created again issues all its certs again
+        int_action = plan_action(
+            stored.get(('intermediate', root_name, name)),
+            root_action == 'reuse' and f'{name}/ca' in steps)
+        int_plan = {'name': name, 'action': int_action, 'certs': []}
+        plan['intermediates'].append(int_plan)
+        if int_action != 'reuse':
+            keys += 1
+            processes += INTERMEDIATE_PROCESSES
+        try:
+            cert_sans = intermediate_certs(intermediate, errors)
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(f'intermediate {name}: {error}')
+            continue
+        planned = set()
+        for san in cert_sans:
+            if san[0] in planned:
+                # A run creates a cert that is listed twice only once
+                continue
+            planned.add(san[0])
+            expected = set(san) if len(san) > 1 else set()
+            stored_sans = stored.get(('cert', name, san[0]))
+            cert_action = plan_action(
+                stored_sans, int_action == 'reuse' and
+                stored_sans == expected and
+                f'{name}/{san[0]}:verify' in steps)
+            int_plan['certs'].append({'name': san[0], 'sans': san,
+                                      'action': cert_action})
+            if cert_action == 'reuse':
+                continue
+            cert_keys += 1
+            processes += CERT_PROCESSES
+            if 'p12' in intermediate.get('encodings', []):
+                processes += 1
+    # CAs are created one by one, certs run in a pipeline of `concurrency`
+    # processes at a time
+    seconds = keys * KEYGEN_SECONDS + (
+        cert_keys * KEYGEN_SECONDS +
+        (processes - keys - cert_keys) * PROCESS_SECONDS) / concurrency
+    plan['cost'] = {
+        'private_keys': keys + cert_keys,
+        'openssl_processes': processes,
+        'concurrency': concurrency,
+        'estimated_seconds': round(seconds, 1),
+    }
+    return plan, errors
+
+
+def print_plan(config):
+    """
+    Validate the config, and print the plan for a run as yaml to stdout.
+    Exits with an error when the plan could not be resolved completely.
+    """
+    plan, errors = plan_chain(config)
+    if errors:
+        plan['errors'] = errors
+    stdout.write(yaml.dump({'plan': plan}, Dumper=Dumper,
+                           default_flow_style=False, sort_keys=False))
+    if errors:
+        sys.exit(1)
+
+
+def export_metrics(config, database, started):
+    """
+    Set the run metrics after a run, and write the metrics file (if set)
+    :param database: the CertDB of the CA store, for the expiry horizon
+    :param started: the monotonic time the run started
+    """
+    metrics.RUN_SECONDS.set(monotonic() - started)
+    metrics.LAST_RUN.set(time())
+    metrics.EARLIEST_NOT_AFTER.clear()
+    for name, not_after in database.earliest_expiry().items():
+        metrics.EARLIEST_NOT_AFTER.set(not_after.timestamp(),
+                                       ca=name)
+    if config.get('metrics_file'):
+        metrics.write_textfile(config['metrics_file'])
+
+
+def serve_metrics(config):
+    """Serve metrics over HTTP when metrics_listen is set"""
+    if not config.get('metrics_listen'):
+        return None
+    return metrics.serve(parse_address(config['metrics_listen']))
+
+
+def desired_chain(config, resolve=gethostbyname):
+    """
+    Return what a config asks for, as a dict of intermediate name to a tuple
+    (key usages, encodings, {cert name: SAN tuple}), and a list of errors
+    for hosts that could not be resolved
+    """
+    desired = {}
+    errors = []
+    for intermediate in config['intermediates']:
+        intermediate['hosts'] = intermediate.get('hosts', config.get('hosts'))
+        certs = {}
+        for san in intermediate_certs(intermediate, errors, resolve):
+            certs.setdefault(san[0], tuple(san))
+        usages = (list(intermediate.get('keyUsages', DEFAULT_KEY_USAGES)),
+                  list(intermediate.get('extendedKeyUsages',
+                                        DEFAULT_EXTENDED_KEY_USAGES)))
+        encodings = tuple(intermediate.get('encodings', DEFAULT_ENCODINGS))
+        desired[intermediate['name']] = (usages, encodings, certs)
+    return desired, errors
+
+
+def watched_paths(config):
+    """Return the config file and all inventories that a config uses"""
+    paths = {config['configfile']}
+    for hosts in [config.get('hosts')] + [
+            intermediate.get('hosts')
+            for intermediate in config.get('intermediates') or []
+            if isinstance(intermediate, dict)]:
+        if isinstance(hosts, str):
+            paths.add(hosts)
+    return paths
+
+
+class IncrementalChain:
+    """
+    IncrementalChain keeps a CA store loaded, and brings it in line with a
+    config by only issuing and retiring the certs that changed since the
+    config it was last brought in line with. What was issued is looked up
+    in the CertRegistry of every intermediate, instead of keeping a copy.
+    """
+
+    __subject = None
+    __root = None
+    __journal = None
+    __logs = None
+    __data = None
+    __resolved = None
+
+    def __init__(self, config):
+        tmpdir = config['tmpdir']
+        self.__subject = TlsSubject(config.get('subject', DEFAULT_SUBJECT))
+        self.__root = TlsCA(join(tmpdir, 'tls'),
+                            self.__subject.get('CN', 'postgres'),
+                            root_config(config), None)
+        # What was issued before (also by earlier runs) is reused
+        self.__journal = Journal(join(tmpdir, JOURNAL_FILE), True)
+        self.__root.set_journal(self.__journal)
+        # pylint: disable=consider-using-with
+        self.__logs = [open(join(tmpdir, 'stdout.log'), 'a', encoding="utf8"),
+                       open(join(tmpdir, 'stderr.log'), 'a', encoding="utf8")]
+        if not config.get('debug'):
+            self.__root.set_debug_output(*self.__logs)
+        self.__root.set_subject(self.__subject)
+        self.__root.create_ca_cert()
+        self.__data = {'certs': {}, 'private_keys': {}}
+        self.__resolved = {}
+
+    def resolve(self, host):
+        """Resolve a host, once for as long as the chain is loaded"""
+        if host not in self.__resolved:
+            self.__resolved[host] = gethostbyname(host)
+        return self.__resolved[host]
+
+    def apply(self, config):
+        """
+        Issue and retire certs so that the CA store matches the config, and
+        write the certs and keys
+        :return: a tuple with the lists of issued and retired certs (certs
+                 that were reused from the store do not count as issued)
+        """
+        started = time()
+        started_run = monotonic()
+        if TlsSubject(config.get('subject', DEFAULT_SUBJECT)) != \
+                self.__subject:
+            raise WatchException('the subject cannot change while '
+                                 'watching, restart with another tmpdir '
+                                 'instead')
+        desired, errors = desired_chain(config, self.resolve)
+        for error in errors:
+            stderr.write(f'warning: {error}\n')
+        scheduler = Scheduler(config.get('concurrency'), self.__journal)
+        if not config.get('debug'):
+            scheduler.set_debug_output(*self.__logs)
+        issued = []
+        retired = [name for name in self.__root.intermediates()
+                   if name not in desired]
+        for name in retired:
+            self.__root.retire(name)
+            self.__drop(name)
+        reread = [intermediate['name']
+                  for intermediate in config['intermediates']
+                  if self.__plan_intermediate(intermediate, desired,
+                                              scheduler, issued, retired)]
+        try:
+            scheduler.run()
+        except Exception:
+            # The registries already hold the scheduled certs, remove them
+            # so that the next apply schedules them again
+            for name, cert in issued:
+                self.__root.intermediate(name).discard(cert)
+            raise
+        finally:
+            self.__journal.commit()
+            # Also after a failed run, so that its failures are exported
+            export_metrics(config, self.__root.db(), started_run)
+        for name in reread:
+            read_intermediate(self.__root.intermediate(name), self.__data)
+        for name, cert in issued:
+            if name not in reread:
+                self.__read_cert(name, cert)
+        write_data(config, self.__data)
+        write_capath(config, self.__root)
+        return [(name, cert) for name, cert in issued
+                if getmtime(self.__root.intermediate(name).cert(cert)
+                            .certfile()) >= started], \
+            retired
+
+    # pylint: disable=too-many-arguments
+    def __plan_intermediate(self, config, desired, scheduler, issued,
+                            retired):
+        """
+        Schedule the changes for one intermediate
+        :return: True if all its certs and keys need to be read again
+        """
+        name = config['name']
+        usages, encodings, certs = desired[name]
+        intermediate = self.__root.intermediate(name)
+        if intermediate is not None and intermediate.usages() != usages:
+            # Other key usages need a new intermediate and certs
+            self.__root.retire(name)
+            self.__drop(name)
+            intermediate = None
+        if intermediate is None:
+            intermediate = self.__root.create_int(name, config)
+        # Intermediates that were read before were brought in line with an
+        # earlier config, which their registry holds
+        known = name in self.__data['certs']
+        if not known:
+            # Certs in the store from an earlier run are reused, unless
+            # their alternate names changed in the mean time
+            stored = {row['name']: set(row['sans']) for row in
+                      intermediate.db().query(intermediate=name)}
+            for cert, sans in certs.items():
+                expected = set(sans) if len(sans) > 1 else set()
+                if stored.get(cert, expected) != expected:
+                    intermediate.retire(cert)
+        elif tuple(intermediate.encodings()) != encodings:
+            # All certs are scheduled again; only the new encodings run
+            intermediate.set_encodings(list(encodings))
+            known = False
+        registry = intermediate.certs()
+        if known:
+            for cert in registry:
+                if cert not in certs:
+                    intermediate.retire(cert)
+                    self.__drop(name, cert)
+                    retired.append(f'{name}/{cert}')
+        for cert, sans in certs.items():
+            if known and cert in registry:
+                if tuple(registry.sans(cert)) == sans:
+                    continue
+                # Other alternate names need a new cert
+                intermediate.retire(cert)
+            intermediate.discard(cert)
+            intermediate.schedule_cert(list(sans), scheduler)
+            issued.append((name, cert))
+        return not known
+
+    def __read_cert(self, name, cert):
+        intermediate = self.__root.intermediate(name)
+        encodings = intermediate.encodings()
+        self.__data['certs'][name].update(
+            intermediate.cert(cert).get_certs(encodings))
+        self.__data['private_keys'][name].update(
+            intermediate.cert(cert).get_private_keys(encodings))
+
+    def __drop(self, name, cert=None):
+        """Remove an intermediate or cert from the certs and keys"""
+        for entries in self.__data.values():
+            if cert is None:
+                entries.pop(name, None)
+                continue
+            for suffix in ['', '.pk8', '.der', '.p12']:
+                entries.get(name, {}).pop(cert + suffix, None)
+
+    def close(self):
+        """Commit the journal, close the logs and PKCS#11 sessions"""
+        self.__journal.close()
+        close_pools()
+        for log in self.__logs:
+            log.close()
+
+
+def reload_config():
+    """
+    Read the config again
+    :return: a tuple (config, valid), with config None when it is invalid
+    """
+    try:
+        config = Config()
+        validate(config)
+    except ConfigSchemaException as schema_error:
+        stderr.write(str(schema_error) + '\n')
+        return None, False
+    except (ChainSmithException, OSError, yaml.YAMLError) as error:
+        stderr.write(f'cannot read config: {error}\n')
+        return None, False
+    return config, True
+
+
+def watch_chain(config):
+    """
+    Entrypoint for chainsmith watch: create the chain, and keep it in line
+    with the config and inventories until interrupted
+    """
+    if not config.get('tmpdir'):
+        raise Exception('watch requires tmpdir to keep the CA store in')
+    try:
+        validate(config)
+    except ConfigSchemaException as schema_error:
+        stderr.write(str(schema_error) + '\n')
+        sys.exit(1)
+    chain = IncrementalChain(config)
+    server = serve_metrics(config)
+    watcher = FileWatcher(float(config.get('interval') or 1.0),
+                          bool(config.get('poll')))
+    # Files are recorded before they are read, so that changes made while
+    # they are read (or applied) are noticed on the next wait
+    watcher.watch(watched_paths(config))
+    new_config, valid = reload_config()
+    config = new_config or config
+    try:
+        while True:
+            if valid:
+                # Inventories that the config (now) uses are recorded
+                # before apply reads them
+                watcher.watch(watched_paths(config))
+                started = monotonic()
+                try:
+                    issued, retired = chain.apply(config)
+                    print(f'# {len(issued)} certs issued, {len(retired)} '
+                          f'retired in {monotonic() - started:.1f}s',
+                          flush=True)
+                except (CalledProcessError, ChainSmithException,
+                        OSError) as error:
+                    stderr.write(f'applying config failed: {error}\n')
+            watcher.wait()
+            new_config, valid = reload_config()
+            config = new_config or config
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        chain.close()
+        if server is not None:
+            server.shutdown()
+
+
+COMMANDS = {
+    'watch': watch_chain,
+    'worker': run_worker,
+    'query': query_store,
+    'audit': audit_chain,
+    'bench-handshake': bench_handshake,
+}
+
+
+def main():
+    """
+    Entrypoint for the chainsmith binary.
+    Runs a command when one is specified, or creates the chain from yaml.
+    """
+    try:
+        config = Config()
+    except ConfigSchemaException as schema_error:
+        stderr.write(str(schema_error) + '\n')
+        sys.exit(1)
+    command = config.get('command')
+    if command in COMMANDS:
+        COMMANDS[command](config)
+        return
+    try:
+        validate(config)
+    except ConfigSchemaException as schema_error:
+        stderr.write(str(schema_error) + '\n')
+        sys.exit(1)
+    if config.get('resume') and not config.get('tmpdir'):
+        stderr.write('--resume requires the tmpdir of the run to resume\n')
+        sys.exit(1)
+    if config.get('plan'):
+        print_plan(config)
+    else:
+        from_yaml(config)
+
+
+def from_yaml(config=None):
     """
     Reads the config and creates the chain
     :return:
     """
-    config = Config()
+    if config is None:
+        config = Config()
+        validate(config)
+    started = monotonic()
+    # Resolve all hosts before generating anything, so that a failing
+    # lookup does not abort a run halfway
+    cert_sans = []
+    for intermediate in config['intermediates']:
+        intermediate['hosts'] = intermediate.get('hosts', config.get('hosts'))
+        cert_sans.append(intermediate_certs(intermediate))
     data = {'certs': {}, 'private_keys': {}}
     subject = TlsSubject(config.get('subject', DEFAULT_SUBJECT))
     tmpdir = config.get('tmpdir', None)
@@ -121,15 +748,49 @@ def from_yaml():
         tmpdir = tempfile.mkdtemp()
         print(f"# More info in in {tmpdir}.")
     root = TlsCA(join(tmpdir, 'tls'), subject.get('CN', 'postgres'),
-                 {}, None)
-    with open(join(tmpdir, 'stdout.log'), 'w', encoding="utf8") as outlog, \
-            open(join(tmpdir, 'stderr.log'), 'w', encoding="utf8") as errlog:
+                 root_config(config), None)
+    # Every completed step is journaled, so that an interrupted run can be
+    # resumed with --resume
+    journal = Journal(join(tmpdir, JOURNAL_FILE), config.get('resume'))
+    root.set_journal(journal)
+    coordinator = server = None
+    if config.get('listen'):
+        server = serve_metrics(config)
+        coordinator = Coordinator(config['listen'], tmpdir,
+                                  config.get('token'))
+        coordinator.start()
+        root.set_coordinator(coordinator)
+        host, port = coordinator.address()
+        print(f'# Waiting for workers on {host}:{port}', flush=True)
+    log_mode = 'a' if config.get('resume') else 'w'
+    with open(join(tmpdir, 'stdout.log'), log_mode,
+              encoding="utf8") as outlog, \
+            open(join(tmpdir, 'stderr.log'), log_mode,
+                 encoding="utf8") as errlog:
         if not config.get('debug'):
             root.set_debug_output(outlog, errlog)
         root.set_subject(subject)
-        root.create_ca_cert()
-        for intermediate in config['intermediates']:
-            intermediate['hosts'] = intermediate.get('hosts',
-                                                     config.get('hosts'))
-            add_intermediate(root, intermediate, data)
+        try:
+            root.create_ca_cert()
+            scheduler = Scheduler(config.get('concurrency'), journal)
+            if not config.get('debug'):
+                scheduler.set_debug_output(outlog, errlog)
+            intermediates = [add_intermediate(root, intermediate, scheduler,
+                                              sans)
+                             for intermediate, sans
+                             in zip(config['intermediates'], cert_sans)]
+            # All certs of all intermediates run as one pipeline
+            scheduler.run()
+        finally:
+            journal.close()
+            close_pools()
+            if coordinator is not None:
+                coordinator.close()
+            # Also after a failed run, so that its failures are exported
+            export_metrics(config, root.db(), started)
+        for intermediate_ca in intermediates:
+            read_intermediate(intermediate_ca, data)
         write_data(config, data)
+        write_capath(config, root)
+        if server is not None:
+            server.shutdown()
@@ -2,17 +2,30 @@
 Use a Config object to manage commandline arguments,
 environment variables and yaml config file.
 """
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from os import environ
-from os.path import expanduser
+from os.path import exists, expanduser
 import yaml
 
+from chainsmith.exceptions import ConfigSchemaException
+
 try:
     from yaml import CLoader as Loader
 except ImportError:
     from yaml import Loader
 
 
+def positive_int(value):
+    """Parse a commandline argument that should be a number of at least 1"""
+    try:
+        number = int(value)
+    except ValueError as value_error:
+        raise ArgumentTypeError(f'{value} is not a number') from value_error
+    if number < 1:
+        raise ArgumentTypeError(f'{value} should be at least 1')
+    return number
+
+
 class Config(dict):
     """
     A Config class will read arguments, and yaml file
@@ -28,6 +41,7 @@ class Config(dict):
         self.get_arguments()
         self.read_configfile()
         self.read_environment()
+        self.read_concurrency()
 
     def get_arguments(self):
         """
@@ -52,12 +66,121 @@ class Config(dict):
         parser.add_argument("-p", "--privatekeyspath", default=None,
                             help='Write the yaml with keys to a file. '
                                  'Leave empty for stderr.')
+        parser.add_argument("--capath", default=None,
+                            help='Write a hashed CA directory (for -CApath) '
+                                 'with all CA certs and CRLs here. Defaults '
+                                 'to tls/capath in tmpdir.')
         parser.add_argument("-t", "--tmpdir",
                             help='Tempdir for generating the certs. '
                                  'Leave empty for mktemp.')
         parser.add_argument("-d", "--debug", action='store_true',
                             help='Print openssl output to stdout and stderr. '
                                  'Print to files in tmpdir when not set.')
+        parser.add_argument("-j", "--concurrency", type=int, default=None,
+                            help='The maximum number of openssl processes '
+                                 'to run at the same time. Defaults to the '
+                                 'number of cpus.')
+        parser.add_argument("--resume", action='store_true',
+                            help='Resume an interrupted run in tmpdir, '
+                                 'reusing all keys and certs that were '
+                                 'completed before. Requires --tmpdir.')
+        parser.add_argument("--plan", action='store_true',
+                            help='Validate the config and print the CAs '
+                                 'and certs that would be issued, without '
+                                 'generating anything.')
+        parser.add_argument("--listen",
+                            help='Run as coordinator: listen on host:port '
+                                 'and have workers create all keys and '
+                                 'csrs for certs.')
+        parser.add_argument("--token",
+                            help='A shared secret between coordinator and '
+                                 'workers. Can also be set with '
+                                 'CHAINSMITH_TOKEN.')
+        parser.add_argument("--metrics-file",
+                            help='Write metrics to this file (for the '
+                                 'Prometheus node_exporter textfile '
+                                 'collector) after every run.')
+        parser.add_argument("--metrics-listen",
+                            help='Serve metrics over HTTP on host:port '
+                                 '(for watch and coordinator mode).')
+        commands = parser.add_subparsers(dest='command',
+                                         help='Run a command on an existing '
+                                              'CA store instead of creating '
+                                              'a chain.')
+        query = commands.add_parser('query',
+                                    help='Find certificates in the '
+                                         'inventory of the CA store in '
+                                         'tmpdir.')
+        query.add_argument("--cn", help='Find certs with this common name')
+        query.add_argument("--san",
+                           help='Find certs with this subject alternative '
+                                'name (DNS name or IP address)')
+        query.add_argument("--serial", help='Find the cert with this serial')
+        query.add_argument("--intermediate",
+                           help='Find certs signed by this intermediate')
+        query.add_argument("--expires-before",
+                           help='Find certs that expire before this date '
+                                '(YYYY-MM-DD), or within a number of days '
+                                '(e.a. 30d)')
+        query.add_argument("--import", dest='import_store',
+                           action='store_true',
+                           help='(Re)index all certificates in the CA store '
+                                'before querying. Use once for stores that '
+                                'were created without an inventory.')
+        audit = commands.add_parser('audit',
+                                    help='Verify all CAs and certs of the '
+                                         'CA store in tmpdir, and report '
+                                         'what is wrong.')
+        audit.add_argument("--format", choices=['yaml', 'json'],
+                           default='yaml', help='The format of the report')
+        audit.add_argument("--warn-days", type=int, default=30,
+                           help='Warn for certs that expire within this '
+                                'many days')
+        audit.add_argument("--skip-config", action='store_true',
+                           help='Do not check that the certs match the '
+                                'config')
+        bench = commands.add_parser('bench-handshake',
+                                    help='Benchmark TLS handshakes on '
+                                         'loopback with the certs and keys '
+                                         'written to --certspath and '
+                                         '--privatekeyspath.')
+        bench.add_argument("--server-intermediate", default='server',
+                           help='The intermediate of the server cert')
+        bench.add_argument("--server-cert",
+                           help='The server cert to use. Defaults to the '
+                                'first cert of the intermediate.')
+        bench.add_argument("--client-intermediate", default='client',
+                           help='The intermediate of the client cert')
+        bench.add_argument("--client-cert",
+                           help='The client cert to use. Defaults to the '
+                                'first cert of the intermediate.')
+        bench.add_argument("--no-client-cert", action='store_true',
+                           help='Run handshakes without client certs')
+        bench.add_argument("--trim-chain", action='store_true',
+                           help='Leave the root out of the chains that are '
+                                'sent during the handshake')
+        bench.add_argument("--handshakes", type=positive_int, default=1000,
+                           help='The number of handshakes to run')
+        bench.add_argument("--clients", type=positive_int, default=8,
+                           help='The number of concurrent clients')
+        watch = commands.add_parser('watch',
+                                    help='Create the chain in tmpdir, and '
+                                         'keep it up to date: issue and '
+                                         'retire certs when the config or '
+                                         'inventory changes.')
+        watch.add_argument("--interval", type=float, default=1.0,
+                           help='Seconds between checks for changes when '
+                                'polling')
+        watch.add_argument("--poll", action='store_true',
+                           help='Poll for changes, also when inotify is '
+                                'available')
+        worker = commands.add_parser('worker',
+                                     help='Create keys and csrs for a '
+                                          'coordinator (chainsmith '
+                                          '--listen), as many at the same '
+                                          'time as --concurrency.')
+        worker.add_argument("--coordinator", required=True,
+                            help='The host:port of the coordinator')
         self.__args = parser.parse_args()
         self.merge(vars(self.__args))
 
@@ -66,10 +189,24 @@ class Config(dict):
         This function reads and returns config data
         """
         # Configuration file look up.
+        if not self.needs_configfile() and not exists(self['configfile']):
+            return
         with open(self['configfile'], encoding="utf8") as configfile:
             self.__yaml = yaml.load(configfile, Loader=Loader)
         self.merge(self.__yaml)
 
+    def needs_configfile(self):
+        """
+        Return whether the command needs the config file: workers get
+        everything they need from the coordinator, and query, audit
+        --skip-config and bench-handshake only read the CA store (or the
+        yaml written from it)
+        """
+        command = self.get('command')
+        if command in ('worker', 'query', 'bench-handshake'):
+            return False
+        return not (command == 'audit' and self.get('skip_config'))
+
     def read_environment(self):
         """
         This function reads config from environment vars
@@ -78,6 +215,25 @@ class Config(dict):
                     for k, v in environ.items()
                     if k.startswith('CHAINSMITH_')})
 
+    def read_concurrency(self):
+        """
+        Convert concurrency to a number once, as the config file and
+        environment hand it over as is (e.a. a string), and check that it is
+        at least 1
+        """
+        value = self.get('concurrency')
+        if value is None or value == '':
+            self['concurrency'] = None
+            return
+        try:
+            concurrency = int(value)
+        except (TypeError, ValueError):
+            concurrency = 0
+        if concurrency < 1:
+            raise ConfigSchemaException(
+                [f"concurrency: '{value}' should be a number of at least 1"])
+        self['concurrency'] = concurrency
+
     def merge(self, other):
         """
         merge the key/values of other dicts with key/values of self
@@ -43,16 +43,21 @@ class ConfigFile(list):
 
     def write(self, file):
         """
-        Write the config to a file
+        Write the config to a file, unless it already holds this config
         :param file: the path of the file to write to
-        :return:
+        :return: True if the file was written (its content changed)
+        :raises OSError: when the file cannot be read or written, so that a
+                         failed write is never taken for a change
         """
         file = path.realpath(path.expanduser(file))
-        try:
-            with open(file, 'w', encoding="utf8") as config_file:
-                config_file.write(self.string())
-        except OSError as os_err:
-            print('Cannot open file:', os_err)
+        content = self.string()
+        if path.exists(file):
+            with open(file, encoding="utf8") as config_file:
+                if config_file.read() == content:
+                    return False
+        with open(file, 'w', encoding="utf8") as config_file:
+            config_file.write(content)
+        return True
 
     def string(self):
         """
@@ -0,0 +1,619 @@
+"""
+This module spreads the key generation (the expensive part of issuing a
+cert) over worker nodes.
+
+The coordinator is a normal chainsmith run with --listen. It keeps all CA
+state and CA keys, and only hands out jobs to create a key and a CSR for a
+subject. Stateless workers (chainsmith worker) connect over TCP, pull jobs,
+and return the CSR with the private key encrypted (CMS) to a transport
+cert of the coordinator, so that private keys never travel in the clear.
+The coordinator signs the CSRs with the CAs as usual, after checking that
+the key it decrypted belongs to the CSR.
+
+The protocol is JSON, one message per line:
+  worker:      {"type": "hello", "worker": ..., "nonce": ...}
+  coordinator: {"type": "welcome", "transport": <PEM cert>, "nonce": ...}
+  worker:      {"type": "get"}
+  coordinator: {"type": "job", "id": ..., "subject": ..., "cnf": ...,
+                "bits": ...} or {"type": "done"}
+  worker:      {"type": "result", "id": ..., "csr": <PEM>, "key": <base64>}
+               or {"type": "error", "id": ..., "message": ...}
+
+The shared token never goes over the wire. Both sides derive a session key
+from the token and both nonces, and every message from the welcome on
+carries a MAC over its content, its direction and its sequence number.
+So only workers that know the token get jobs, and a worker only encrypts
+keys to a transport cert that comes from a coordinator that knows it.
+
+A job is leased to one worker at a time. When the worker disconnects, or
+does not return a result within the lease time, the job is queued again
+for another worker.
+"""
+import asyncio
+from base64 import b64decode, b64encode
+import binascii
+from collections import deque
+import hashlib
+import hmac
+from itertools import count
+import json
+from os import cpu_count, getpid, remove, urandom
+from os.path import exists, join
+import socket
+import sys
+from sys import stderr
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from subprocess import CalledProcessError, PIPE
+from tempfile import TemporaryDirectory
+from threading import Condition, Thread
+from time import monotonic, sleep
+
+from chainsmith.exceptions import DistributedException, X509ParseException
+from chainsmith.formats import private_key_der
+from chainsmith.metrics import run
+from chainsmith.x509 import X509Request, csr_subject, pem_blocks, \
+    rsa_private_key_modulus
+
+KEY_BITS = 4096
+DEFAULT_LEASE_SECONDS = 300
+# A job that fails on this many workers fails the run
+MAX_ATTEMPTS = 3
+# How long a worker keeps trying to reach the coordinator
+CONNECT_SECONDS = 60
+TRANSPORT_KEY = 'transport.key.pem'
+TRANSPORT_CERT = 'transport.cert.pem'
+NONCE_BYTES = 16
+
+
+def parse_address(address, default_host='127.0.0.1'):
+    """
+    Return a (host, port) tuple for an address like host:port or :port
+    """
+    host, _, port = str(address).rpartition(':')
+    try:
+        return host or default_host, int(port)
+    except ValueError as value_error:
+        raise DistributedException(f"invalid address '{address}', "
+                                   "expected host:port") from value_error
+
+
+def send(wfile, message):
+    """Write one message to a stream"""
+    wfile.write((json.dumps(message) + '\n').encode('utf8'))
+    wfile.flush()
+
+
+def receive(rfile):
+    """Read one message from a stream, or return None on end of stream"""
+    line = rfile.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def new_nonce():
+    """Return a random nonce as hex"""
+    return urandom(NONCE_BYTES).hex()
+
+
+def session_key(token, worker_nonce, coordinator_nonce):
+    """Return the key that authenticates the messages of one connection"""
+    return hmac.new(str(token).encode('utf8'),
+                    f'{worker_nonce}:{coordinator_nonce}'.encode('ascii'),
+                    hashlib.sha256).digest()
+
+
+class Channel:
+    """
+    Channel sends and receives the messages of one connection. Once it has
+    a session key, every message carries a MAC over its content, the sender
+    and a sequence number, so that messages cannot be forged, replayed or
+    reflected.
+    """
+
+    __rfile = None
+    __wfile = None
+    __role = ''
+    __peer = ''
+    __key = None
+    __sent = 0
+    __received = 0
+
+    def __init__(self, rfile, wfile, role, peer):
+        """
+        :param role: the name of this side (worker or coordinator)
+        :param peer: the name of the other side
+        """
+        self.__rfile = rfile
+        self.__wfile = wfile
+        self.__role = role
+        self.__peer = peer
+
+    def set_key(self, key):
+        """Authenticate all messages from now on with a session key"""
+        self.__key = key
+
+    def __mac(self, sender, number, message):
+        content = json.dumps(message, sort_keys=True)
+        return hmac.new(self.__key,
+                        f'{sender}:{number}:{content}'.encode('utf8'),
+                        hashlib.sha256).hexdigest()
+
+    def send(self, message):
+        """Send a message (with a MAC, once there is a session key)"""
+        if self.__key is not None:
+            message = dict(message, mac=self.__mac(self.__role, self.__sent,
+                                                   message))
+            self.__sent += 1
+        send(self.__wfile, message)
+
+    def receive(self):
+        """
+        Receive a message, or None on end of stream. Once there is a session
+        key, messages without a valid MAC raise a DistributedException.
+        """
+        message = receive(self.__rfile)
+        if message is None or self.__key is None:
+            return message
+        return self.verify(message)
+
+    def verify(self, message):
+        """Check the MAC of a message, and return it without the MAC"""
+        message = dict(message)
+        mac = str(message.pop('mac', ''))
+        if not hmac.compare_digest(
+                mac, self.__mac(self.__peer, self.__received, message)):
+            if message.get('type') == 'error' and 'message' in message:
+                raise DistributedException(f'{self.__peer} refused: '
+                                           f'{message["message"]}')
+            raise DistributedException(f'message from {self.__peer} is not '
+                                       'authenticated (wrong token?)')
+        self.__received += 1
+        return message
+
+
+def key_matches_csr(key_pem, csr_pem):
+    """Return True if a PEM private key belongs to a PEM CSR"""
+    blocks = pem_blocks(csr_pem, 'CERTIFICATE REQUEST')
+    public_key = X509Request(blocks[0]).rsa_public_key()
+    modulus = rsa_private_key_modulus(private_key_der(key_pem))
+    return public_key is not None and modulus == public_key[0]
+
+
+class Job:
+    """
+    A Job asks a worker for a key and a CSR for one subject.
+    callback is called (from a server thread) with the result as a tuple
+    (csr, encrypted key), or with an exception.
+    """
+
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    def __init__(self, job_id, name, subject, cnf, callback):
+        self.job_id = job_id
+        self.name = name
+        self.subject = subject
+        self.cnf = cnf
+        self.callback = callback
+        self.attempts = 0
+        self.worker = None
+        self.deadline = 0.0
+
+    def message(self):
+        """Return the job message for a worker"""
+        return {'type': 'job', 'id': self.job_id, 'subject': self.subject,
+                'cnf': self.cnf, 'bits': KEY_BITS}
+
+
+class CoordinatorHandler(StreamRequestHandler):
+    """CoordinatorHandler serves the connection with one worker"""
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        worker = f'{self.client_address[0]}:{self.client_address[1]}'
+        channel = Channel(self.rfile, self.wfile, 'coordinator', 'worker')
+        try:
+            hello = channel.receive()
+            if not hello or hello.get('type') != 'hello' or \
+                    not hello.get('nonce'):
+                channel.send({'type': 'error', 'message': 'not authorized'})
+                return
+            nonce = new_nonce()
+            channel.set_key(coordinator.session_key(hello['nonce'], nonce))
+            channel.send({'type': 'welcome', 'nonce': nonce,
+                          'transport': coordinator.transport_cert()})
+            while True:
+                message = channel.receive()
+                if message is None:
+                    return
+                kind = message.get('type')
+                if kind == 'get':
+                    job = coordinator.take(worker)
+                    if job is None:
+                        channel.send({'type': 'done'})
+                        return
+                    channel.send(job.message())
+                elif kind == 'result':
+                    coordinator.finish(worker, message.get('id'),
+                                       message.get('csr'),
+                                       message.get('key'))
+                elif kind == 'error':
+                    coordinator.fail(worker, message.get('id'),
+                                     message.get('message'))
+        except DistributedException as error:
+            stderr.write(f'refused worker {worker}: {error}\n')
+        except (OSError, ValueError):
+            # A broken connection is a lost worker
+            pass
+        finally:
+            coordinator.release(worker)
+
+
+class CoordinatorServer(ThreadingTCPServer):
+    """CoordinatorServer serves every worker in its own thread"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+    coordinator = None
+
+
+class Coordinator:
+    """
+    Coordinator hands out key and CSR jobs to workers, and tracks which
+    worker holds which job.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    __address = None
+    __workdir = ''
+    __token = None
+    __lease = DEFAULT_LEASE_SECONDS
+    __server = None
+    __condition = None
+    __queue = None
+    __leased = None
+    __ids = None
+    __closed = False
+
+    def __init__(self, address, workdir, token,
+                 lease=DEFAULT_LEASE_SECONDS):
+        """
+        :param address: the address to listen on (host:port)
+        :param workdir: the directory to keep the transport key and cert in
+        :param token: a shared secret that workers should know
+        :param lease: the seconds a worker has to return a result
+        """
+        if not token:
+            raise DistributedException('--listen requires a token (--token '
+                                       'or CHAINSMITH_TOKEN), so that only '
+                                       'your workers get keys signed')
+        self.__address = parse_address(address)
+        self.__workdir = workdir
+        self.__token = token
+        self.__lease = lease
+        self.__condition = Condition()
+        self.__queue = deque()
+        self.__leased = {}
+        self.__ids = count(1)
+
+    def start(self):
+        """Create the transport cert (if needed) and start listening"""
+        self.__gen_transport()
+        self.__server = CoordinatorServer(self.__address, CoordinatorHandler)
+        self.__server.coordinator = self
+        Thread(target=self.__server.serve_forever, daemon=True).start()
+
+    def __gen_transport(self):
+        """
+        Create the key and self-signed cert that workers encrypt private
+        keys to. They are kept in workdir, so that a resumed run can still
+        decrypt keys that were returned before.
+        """
+        if exists(join(self.__workdir, TRANSPORT_CERT)):
+            return
+        run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-subj', '/CN=chainsmith transport', '-days', '30', '-keyout',
+             join(self.__workdir, TRANSPORT_KEY), '-out',
+             join(self.__workdir, TRANSPORT_CERT)],
+            check=True, stdout=PIPE, stderr=PIPE)
+
+    def address(self):
+        """Return the (host, port) that the coordinator listens on"""
+        if self.__server is None:
+            return self.__address
+        return self.__server.server_address[:2]
+
+    def transport_cert(self):
+        """Return the PEM of the transport cert"""
+        with open(join(self.__workdir, TRANSPORT_CERT),
+                  encoding="utf8") as cert:
+            return cert.read()
+
+    def session_key(self, worker_nonce, coordinator_nonce):
+        """Return the session key for a connection with a worker"""
+        return session_key(self.__token, worker_nonce, coordinator_nonce)
+
+    def submit(self, name, subject, cnf, callback):
+        """Queue a job to create a key and CSR, and return the Job"""
+        job = Job(next(self.__ids), name, subject, cnf, callback)
+        with self.__condition:
+            self.__queue.append(job)
+            self.__condition.notify()
+        return job
+
+    def cancel(self, job):
+        """Forget a job that is no longer needed"""
+        with self.__condition:
+            self.__leased.pop(job.job_id, None)
+            if job in self.__queue:
+                self.__queue.remove(job)
+
+    def take(self, worker):
+        """
+        Lease the next job to a worker, waiting until there is one.
+        Returns None when the coordinator is closed.
+        """
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    return None
+                self.__expire()
+                if self.__queue:
+                    job = self.__queue.popleft()
+                    job.worker = worker
+                    job.deadline = monotonic() + self.__lease
+                    self.__leased[job.job_id] = job
+                    return job
+                self.__condition.wait(1.0)
+
+    def __expire(self):
+        """Queue jobs again whose lease has expired"""
+        now = monotonic()
+        for job in list(self.__leased.values()):
+            if job.deadline < now:
+                self.__requeue(job)
+
+    def __requeue(self, job):
+        del self.__leased[job.job_id]
+        job.worker = None
+        self.__queue.appendleft(job)
+        self.__condition.notify()
+
+    def release(self, worker):
+        """Queue the jobs of a worker that is gone again"""
+        with self.__condition:
+            for job in list(self.__leased.values()):
+                if job.worker == worker:
+                    self.__requeue(job)
+
+    def __leased_job(self, worker, job_id):
+        """Return a job if it is (still) leased to worker"""
+        job = self.__leased.get(job_id)
+        if job is None or job.worker != worker:
+            # The lease expired, and the job was handed to another worker
+            return None
+        return job
+
+    def finish(self, worker, job_id, csr, key):
+        """
+        Handle a result that a worker returned. The key is decrypted to
+        check that it belongs to the CSR, before the CSR can be signed.
+        """
+        with self.__condition:
+            job = self.__leased_job(worker, job_id)
+            if job is None:
+                return
+            try:
+                blocks = pem_blocks(csr or '', 'CERTIFICATE REQUEST')
+                if not blocks or \
+                        dict(csr_subject(blocks[0])).get('CN') != job.name:
+                    raise X509ParseException(f'the CSR is not for {job.name}')
+                encrypted_key = b64decode(key or '', validate=True)
+            except (X509ParseException, binascii.Error) as error:
+                self.__fail(job, f'invalid result from {worker}: {error}')
+                return
+        # Decrypting runs openssl, so not while holding the lock
+        try:
+            if not key_matches_csr(self.__decrypt_key(encrypted_key), csr):
+                raise X509ParseException('the key does not belong to the '
+                                         'CSR')
+            error = None
+        except (CalledProcessError, X509ParseException) as decrypt_error:
+            error = decrypt_error
+        with self.__condition:
+            if self.__leased_job(worker, job_id) is not job:
+                return
+            if error is not None:
+                self.__fail(job, f'invalid result from {worker}: {error}')
+                return
+            del self.__leased[job.job_id]
+        job.callback((csr, encrypted_key))
+
+    def __decrypt_key(self, encrypted_key):
+        """Return the PEM key that a worker encrypted, without writing it"""
+        return run(self.decrypt_key_args('-', '-'), input=encrypted_key,
+                   check=True, stdout=PIPE, stderr=PIPE).stdout.decode('utf8')
+
+    def fail(self, worker, job_id, message):
+        """Handle an error that a worker returned"""
+        with self.__condition:
+            job = self.__leased_job(worker, job_id)
+            if job is not None:
+                self.__fail(job, f'{worker}: {message}')
+
+    def __fail(self, job, message):
+        job.attempts += 1
+        if job.attempts < MAX_ATTEMPTS:
+            self.__requeue(job)
+            return
+        del self.__leased[job.job_id]
+        job.callback(DistributedException(
+            f'creating a key for {job.name} failed {job.attempts} times, '
+            f'last error: {message}'))
+
+    async def request_csr(self, name, subject, cnf_file, csr_file,
+                          encrypted_key_file):
+        """
+        Have a worker create a key and CSR, and write the CSR and the
+        encrypted key to file. Waits without blocking the event loop.
+        """
+        # pylint: disable=too-many-arguments
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def callback(result):
+            loop.call_soon_threadsafe(self.__resolve, future, result)
+
+        with open(cnf_file, encoding="utf8") as cnf:
+            job = self.submit(name, subject, cnf.read(), callback)
+        try:
+            csr, encrypted_key = await future
+        except asyncio.CancelledError:
+            self.cancel(job)
+            raise
+        with open(csr_file, 'w', encoding="utf8") as csr_out:
+            csr_out.write(csr)
+        with open(encrypted_key_file, 'wb') as key_out:
+            key_out.write(encrypted_key)
+
+    @staticmethod
+    def __resolve(future, result):
+        if future.done():
+            return
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def decrypt_key_args(self, encrypted_key_file, key_file):
+        """Return the openssl command that decrypts a key from a worker"""
+        return ['openssl', 'cms', '-decrypt', '-inform', 'DER', '-in',
+                encrypted_key_file, '-recip',
+                join(self.__workdir, TRANSPORT_CERT), '-inkey',
+                join(self.__workdir, TRANSPORT_KEY), '-out', key_file]
+
+    def close(self):
+        """Tell all workers that there is no more work, and stop"""
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+
+
+def issue(job, workdir, transport_file):
+    """
+    Create a key and CSR for a job on a worker
+    :return: the result message for the coordinator
+    """
+    key_file = join(workdir, f'{job["id"]}.key.pem')
+    cnf_file = join(workdir, f'{job["id"]}.cnf')
+    csr_file = join(workdir, f'{job["id"]}.csr')
+    with open(cnf_file, 'w', encoding="utf8") as cnf:
+        cnf.write(job['cnf'])
+    try:
+        run(['openssl', 'genrsa', '-out', key_file,
+             str(job.get('bits', KEY_BITS))],
+            check=True, stdout=PIPE, stderr=PIPE)
+        run(['openssl', 'req', '-new', '-subj', job['subject'], '-key',
+             key_file, '-out', csr_file, '-config', cnf_file],
+            check=True, stdout=PIPE, stderr=PIPE)
+        encrypted = run(['openssl', 'cms', '-encrypt', '-binary', '-aes256',
+                         '-outform', 'DER', '-in', key_file, '-recip',
+                         transport_file],
+                        check=True, stdout=PIPE, stderr=PIPE).stdout
+        with open(csr_file, encoding="utf8") as csr:
+            return {'type': 'result', 'id': job['id'], 'csr': csr.read(),
+                    'key': b64encode(encrypted).decode('ascii')}
+    finally:
+        for path in [key_file, cnf_file, csr_file]:
+            if exists(path):
+                remove(path)
+
+
+def connect(address):
+    """Connect to the coordinator, retrying while it is not up yet"""
+    deadline = monotonic() + CONNECT_SECONDS
+    while True:
+        try:
+            return socket.create_connection(address)
+        except OSError as os_err:
+            if monotonic() > deadline:
+                raise DistributedException(
+                    f'cannot connect to coordinator at {address[0]}:'
+                    f'{address[1]}') from os_err
+            sleep(1)
+
+
+def greet(channel, token, name):
+    """
+    Say hello to the coordinator, and key the channel
+    :return: the transport cert of the coordinator
+    """
+    nonce = new_nonce()
+    channel.send({'type': 'hello', 'worker': name, 'nonce': nonce})
+    welcome = channel.receive()
+    if not welcome or welcome.get('type') != 'welcome':
+        message = (welcome or {}).get('message')
+        raise DistributedException(f'coordinator refused worker: {message}')
+    channel.set_key(session_key(token, nonce, welcome.get('nonce')))
+    # Only encrypt keys to a transport cert that comes from a coordinator
+    # that knows the token
+    return channel.verify(welcome)['transport']
+
+
+def work(address, token, name):
+    """
+    Run jobs from the coordinator on one connection until it is done
+    :return: the number of jobs that were done
+    """
+    done = 0
+    with connect(address) as sock, sock.makefile('rb') as rfile, \
+            sock.makefile('wb') as wfile, TemporaryDirectory() as workdir:
+        channel = Channel(rfile, wfile, 'worker', 'coordinator')
+        transport_file = join(workdir, TRANSPORT_CERT)
+        with open(transport_file, 'w', encoding="utf8") as transport:
+            transport.write(greet(channel, token, name))
+        while True:
+            channel.send({'type': 'get'})
+            job = channel.receive()
+            if not job or job.get('type') != 'job':
+                return done
+            try:
+                channel.send(issue(job, workdir, transport_file))
+                done += 1
+            except (CalledProcessError, OSError) as error:
+                channel.send({'type': 'error', 'id': job['id'],
+                              'message': str(error)})
+
+
+def run_worker(config):
+    """
+    Entrypoint for chainsmith worker: run jobs of a coordinator on as many
+    connections as the concurrency, until the coordinator is done
+    """
+    if not config.get('token'):
+        raise DistributedException('worker requires the token of the '
+                                   'coordinator (--token or '
+                                   'CHAINSMITH_TOKEN)')
+    address = parse_address(config.get('coordinator'), 'localhost')
+    concurrency = config.get('concurrency') or cpu_count() or 1
+    name = f'{socket.gethostname()}:{getpid()}'
+    results = [0] * concurrency
+    errors = []
+
+    def target(i):
+        try:
+            results[i] = work(address, config.get('token'), name)
+        except (DistributedException, OSError, ValueError) as error:
+            errors.append(error)
+
+    threads = [Thread(target=target, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f'# {name} created {sum(results)} keys')
+    if errors:
+        stderr.write(f'worker failed: {errors[0]}\n')
+        sys.exit(1)
@@ -3,8 +3,72 @@ The exceptions that could be raised by the tls module
 """
 
 
-class TlsPwdAlreadySetException(Exception):
+class ChainSmithException(Exception):
+    """
+    The base of all exceptions of chainsmith, so that long running modes
+    (like watch) can report them and carry on.
+    """
+
+
+class TlsPwdAlreadySetException(ChainSmithException):
     """
     This exception will be raised the gen_pem_password method runs for
     a second time.
     """
+
+
+class X509ParseException(ChainSmithException):
+    """
+    This exception will be raised when a certificate cannot be parsed by the
+    x509 module.
+    """
+
+
+class ConfigSchemaException(ChainSmithException):
+    """
+    This exception will be raised when the config does not match the schema
+    of chainsmith.yml. It holds a list of all errors that were found.
+    """
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+    def __str__(self):
+        return 'invalid config:\n' + '\n'.join(
+            '- ' + error for error in self.errors)
+
+
+class InventoryException(ChainSmithException):
+    """
+    This exception will be raised when an Ansible inventory cannot be read,
+    or does not have the requested groups.
+    """
+
+
+class DistributedException(ChainSmithException):
+    """
+    This exception will be raised when a coordinator or worker cannot
+    communicate, or a job failed on the workers too often.
+    """
+
+
+class Pkcs11Exception(ChainSmithException):
+    """
+    This exception will be raised when a CA key on a PKCS#11 token cannot be
+    used, or python-pkcs11 is not installed.
+    """
+
+
+class StoreException(ChainSmithException):
+    """
+    This exception will be raised when a cert cannot be found in a CA store,
+    or the name matches certs of more than one intermediate.
+    """
+
+
+class WatchException(ChainSmithException):
+    """
+    This exception will be raised when a config changes in a way that watch
+    cannot apply to the CA store it keeps, like another subject.
+    """
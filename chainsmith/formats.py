@@ -0,0 +1,52 @@
+"""
+This module converts private keys and certificates between the encodings
+that can be written to the output: PEM, PKCS#8 PEM, DER and PKCS#12.
+PEM, PKCS#8 and DER conversions run in-process. Only PKCS#12 (which holds
+an encrypted bag with key, cert and chain) needs an openssl process.
+"""
+from base64 import encodebytes
+
+from chainsmith.exceptions import X509ParseException
+from chainsmith.x509 import encode, pem_blocks, pem_encode
+
+ENCODINGS = ['pem', 'pk8', 'der', 'p12']
+
+DEFAULT_ENCODINGS = ['pem']
+
+# AlgorithmIdentifier for rsaEncryption (1.2.840.113549.1.1.1) with NULL
+# parameters
+RSA_ALGORITHM = bytes.fromhex('300d06092a864886f70d0101010500')
+
+
+def private_key_der(pem):
+    """
+    Return the PKCS#8 DER encoding of a PEM private key.
+    openssl 3 writes PKCS#8 (PRIVATE KEY) and older versions write PKCS#1
+    (RSA PRIVATE KEY), which is wrapped into a PrivateKeyInfo.
+    """
+    blocks = pem_blocks(pem, 'PRIVATE KEY')
+    if blocks:
+        return blocks[0]
+    blocks = pem_blocks(pem, 'RSA PRIVATE KEY')
+    if blocks:
+        return encode(0x30, encode(0x02, b'\x00') + RSA_ALGORITHM +
+                      encode(0x04, blocks[0]))
+    raise X509ParseException('no unencrypted private key found in PEM data')
+
+
+def private_key_pk8(pem):
+    """Return a PEM private key as PKCS#8 PEM"""
+    return pem_encode(private_key_der(pem), 'PRIVATE KEY')
+
+
+def cert_der(pem):
+    """Return the DER encoding of a PEM certificate"""
+    blocks = pem_blocks(pem)
+    if not blocks:
+        raise X509ParseException('no certificate found in PEM data')
+    return blocks[0]
+
+
+def binary(data):
+    """Return binary data as base64 text, so that it can go into yaml"""
+    return encodebytes(data).decode('ascii')
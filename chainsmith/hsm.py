@@ -0,0 +1,203 @@
+"""
+This module signs with CA keys that are kept on a PKCS#11 token (an HSM, or
+SoftHSM for testing), with python-pkcs11 (an optional dependency).
+A token is logged into once, and a pool of sessions is kept open, so that
+many certs are signed concurrently without a login per signature.
+PKCS#11 logins are per token (not per session), so only the first session
+of a pool logs in, and it is closed last (closing it logs all out).
+"""
+from contextlib import contextmanager
+from queue import Empty, Queue
+from threading import Lock
+from time import monotonic
+
+from chainsmith.exceptions import Pkcs11Exception
+from chainsmith.metrics import timed
+
+try:
+    import pkcs11
+    from pkcs11 import Attribute, KeyType, Mechanism, MechanismFlag, \
+        ObjectClass
+    from pkcs11.exceptions import NoSuchKey, PKCS11Error
+except ImportError:
+    pkcs11 = None
+
+DEFAULT_SESSIONS = 4
+KEY_BITS = 4096
+
+# Pools by (library, token), shared by all CAs with keys on the same token
+_POOLS = {}
+_LOCK = Lock()
+
+
+def read_pin(config):
+    """Return the user PIN from the pkcs11 config (pin, or pinFile)"""
+    if config.get('pinFile'):
+        with open(config['pinFile'], encoding="utf8") as pin_file:
+            return pin_file.read().strip()
+    return config.get('pin')
+
+
+class SessionPool:
+    """
+    SessionPool keeps up to `size` sessions with a token open, and lends
+    them out one thread at a time.
+    """
+
+    __token = None
+    __pin = None
+    __size = DEFAULT_SESSIONS
+    __sessions = None
+    __idle = None
+    __keys = None
+    __lock = None
+
+    def __init__(self, library, token, pin, size=DEFAULT_SESSIONS):
+        """
+        :param library: the path of the PKCS#11 module (.so)
+        :param token: the label of the token
+        :param pin: the user PIN
+        :param size: the maximum number of sessions
+        """
+        if pkcs11 is None:
+            raise Pkcs11Exception('signing with PKCS#11 requires '
+                                  'python-pkcs11 (pip install '
+                                  'python-pkcs11)')
+        try:
+            self.__token = pkcs11.lib(library).get_token(token_label=token)
+        except PKCS11Error as error:
+            raise Pkcs11Exception(f'cannot open token {token} with '
+                                  f'{library}: {error!r}') from error
+        self.__pin = pin
+        self.__size = max(1, size)
+        self.__sessions = []
+        self.__idle = Queue()
+        self.__keys = {}
+        self.__lock = Lock()
+
+    @contextmanager
+    def session(self):
+        """Lend a logged in session (blocks when all are in use)"""
+        session = self.__acquire()
+        try:
+            yield session
+        finally:
+            self.__idle.put(session)
+
+    def __acquire(self):
+        try:
+            return self.__idle.get_nowait()
+        except Empty:
+            pass
+        with self.__lock:
+            if len(self.__sessions) < self.__size:
+                # Only the first session logs in, the others share the
+                # login
+                pin = None if self.__sessions else self.__pin
+                try:
+                    session = self.__token.open(rw=True, user_pin=pin)
+                except PKCS11Error as error:
+                    raise Pkcs11Exception(f'cannot open a session with '
+                                          f'{self.__token}: '
+                                          f'{error!r}') from error
+                self.__sessions.append(session)
+                return session
+        return self.__idle.get()
+
+    def key(self, session, object_class, label):
+        """
+        Return a key of a session by label (objects are bound to a
+        session, so they are looked up once per session)
+        """
+        cache_key = (id(session), object_class, label)
+        if cache_key not in self.__keys:
+            self.__keys[cache_key] = session.get_key(
+                object_class=object_class, key_type=KeyType.RSA, label=label)
+        return self.__keys[cache_key]
+
+    def close(self):
+        """Close all sessions, the logged in session last"""
+        with self.__lock:
+            for session in reversed(self.__sessions):
+                session.close()
+            self.__sessions = []
+            self.__idle = Queue()
+            self.__keys = {}
+
+
+def session_pool(config):
+    """Return the (shared) SessionPool for the token in a pkcs11 config"""
+    pool_key = (config['library'], config['token'])
+    with _LOCK:
+        if pool_key not in _POOLS:
+            _POOLS[pool_key] = SessionPool(
+                config['library'], config['token'], read_pin(config),
+                config.get('sessions', DEFAULT_SESSIONS))
+        return _POOLS[pool_key]
+
+
+def close_pools():
+    """Close the sessions of all tokens"""
+    with _LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+        _POOLS.clear()
+
+
+class Pkcs11Signer:
+    """
+    Pkcs11Signer signs for one CA, with an RSA key pair on a token. The key
+    pair is found by label, and generated on the token (not extractable)
+    when it does not exist yet.
+    """
+
+    __pool = None
+    __label = ''
+
+    def __init__(self, config, name):
+        """
+        :param config: the pkcs11 config (library, token, pin or pinFile,
+                       label and sessions)
+        :param name: the name of the CA, which is the default label
+        """
+        self.__pool = session_pool(config)
+        self.__label = config.get('label', name)
+
+    def label(self):
+        """Return the label of the key pair on the token"""
+        return self.__label
+
+    def public_key(self):
+        """
+        Return the public key as a tuple (modulus, exponent), generating the
+        key pair when it is not on the token yet
+        """
+        with self.__pool.session() as session:
+            try:
+                key = self.__pool.key(session, ObjectClass.PUBLIC_KEY,
+                                      self.__label)
+            except NoSuchKey:
+                key, _ = session.generate_keypair(
+                    KeyType.RSA, KEY_BITS, label=self.__label, store=True,
+                    capabilities=MechanismFlag.SIGN | MechanismFlag.VERIFY,
+                    private_template={Attribute.SENSITIVE: True,
+                                      Attribute.EXTRACTABLE: False})
+            except PKCS11Error as error:
+                raise Pkcs11Exception(f'cannot read key {self.__label}: '
+                                      f'{error!r}') from error
+            return (int.from_bytes(key[Attribute.MODULUS], 'big'),
+                    int.from_bytes(key[Attribute.PUBLIC_EXPONENT], 'big'))
+
+    def sign(self, data):
+        """Return the sha256WithRSAEncryption signature of data"""
+        started = monotonic()
+        with self.__pool.session() as session:
+            try:
+                key = self.__pool.key(session, ObjectClass.PRIVATE_KEY,
+                                      self.__label)
+                signature = key.sign(data, mechanism=Mechanism.SHA256_RSA_PKCS)
+            except PKCS11Error as error:
+                raise Pkcs11Exception(f'cannot sign with key {self.__label}: '
+                                      f'{error!r}') from error
+        timed('pkcs11_sign', started)
+        return signature
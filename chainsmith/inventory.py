@@ -0,0 +1,288 @@
+"""
+This module reads Ansible inventories (YAML and INI), to find the hosts
+that need a server certificate.
+
+Every distinct inventory file is parsed once per run (and again only when
+it changes on disk). Groups are kept as unexpanded host patterns and child
+groups; hosts are produced lazily by walking the (nested) groups and
+expanding ranges like db[01:50] with generators.
+"""
+from os import stat
+from os.path import realpath
+import re
+import yaml
+
+from chainsmith.exceptions import InventoryException
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+RANGE_RE = re.compile(r'^(.*?)\[([0-9a-zA-Z]*):([0-9a-zA-Z]+)(?::([0-9]+))?\]'
+                      r'(.*)$')
+
+# Inventories that were parsed, by real path, with the mtime and size
+# they had when they were parsed
+_CACHE = {}
+
+
+def range_values(beg, end, step):
+    """
+    Return the values of an Ansible host range as a generator
+    :param beg: the first value ('' means 0)
+    :param end: the last value (inclusive)
+    :param step: the stride
+    """
+    if beg.isalpha() or end.isalpha():
+        if not (len(beg) == len(end) == 1 and beg.isalpha()):
+            raise InventoryException(f'invalid range [{beg}:{end}]')
+        return (chr(i) for i in range(ord(beg), ord(end) + 1, step))
+    if not end.isdigit() or (beg and not beg.isdigit()):
+        raise InventoryException(f'invalid range [{beg}:{end}]')
+    width = 0
+    if len(beg) > 1 and beg[0] == '0':
+        if len(beg) != len(end):
+            raise InventoryException(f'range [{beg}:{end}] should have '
+                                     'equal widths when zero padded')
+        width = len(beg)
+    return (str(i).zfill(width)
+            for i in range(int(beg or 0), int(end) + 1, step))
+
+
+def expand_host(pattern):
+    """
+    Expand a host pattern with (possibly multiple) ranges into hosts
+    :param pattern: a hostname like db[01:50].example.com
+    :return: a generator of hostnames
+    """
+    match = RANGE_RE.match(pattern)
+    if not match:
+        yield pattern
+        return
+    head, beg, end, step, tail = match.groups()
+    for value in range_values(beg, end, int(step or 1)):
+        yield from expand_host(head + value + tail)
+
+
+def load(path):
+    """
+    Return the Inventory for a file, parsing it only when it was not parsed
+    before or when it changed since.
+    """
+    real_path = realpath(path)
+    try:
+        stats = stat(real_path)
+    except OSError as os_err:
+        raise InventoryException('could not open', path) from os_err
+    version = (stats.st_mtime_ns, stats.st_size)
+    cached = _CACHE.get(real_path)
+    if cached and cached[0] == version:
+        return cached[1]
+    inventory = Inventory(real_path)
+    _CACHE[real_path] = (version, inventory)
+    return inventory
+
+
+class Inventory:
+    """
+    Inventory holds the groups of an Ansible inventory file.
+    Every group has host patterns and child groups, and all groups are
+    (direct or indirect) children of the group 'all'.
+    """
+
+    __path = ''
+    __hosts = None
+    __children = None
+
+    def __init__(self, path):
+        self.__path = path
+        self.__hosts = {}
+        self.__children = {}
+        self.__group('all')
+        try:
+            with open(path, encoding="utf8") as inventory_file:
+                if self.__is_ini(inventory_file):
+                    self.__read_ini(inventory_file)
+                else:
+                    self.__read_yaml(inventory_file)
+        except (OSError, yaml.YAMLError) as error:
+            raise InventoryException('could not read', path) from error
+
+    def __is_ini(self, inventory_file):
+        """
+        Detect an INI inventory by extension, or else by peeking at the
+        first meaningful line
+        """
+        if self.__path.endswith(('.yml', '.yaml', '.json')):
+            return False
+        if self.__path.endswith('.ini'):
+            return True
+        is_ini = False
+        for line in inventory_file:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            is_ini = line.startswith('[') or (':' not in line and
+                                              line != '---')
+            break
+        inventory_file.seek(0)
+        return is_ini
+
+    def __group(self, name, parent='all'):
+        if name not in self.__hosts:
+            self.__hosts[name] = []
+            self.__children[name] = []
+        if name != 'all' and parent and \
+                name not in self.__children[parent]:
+            self.__children[parent].append(name)
+
+    def __read_yaml(self, inventory_file):
+        """
+        Read a YAML inventory as a stream of parser events, so that host
+        vars are skipped instead of being constructed into objects.
+        """
+        events = yaml.parse(inventory_file, Loader=Loader)
+        for event in events:
+            if isinstance(event, yaml.MappingStartEvent):
+                self.__read_yaml_groups(events, 'all')
+            elif isinstance(event, (yaml.SequenceStartEvent,
+                                    yaml.ScalarEvent)):
+                raise InventoryException('invalid inventory', self.__path)
+
+    def __read_yaml_groups(self, events, parent):
+        """Read a mapping of group names to groups"""
+        for event in events:
+            if isinstance(event, yaml.MappingEndEvent):
+                return
+            name = self.__scalar(event)
+            self.__group(name, parent)
+            event = next(events)
+            if isinstance(event, yaml.MappingStartEvent):
+                self.__read_yaml_group(events, name)
+            elif not isinstance(event, yaml.ScalarEvent):
+                raise InventoryException(f'invalid group {name} in',
+                                         self.__path)
+
+    def __read_yaml_group(self, events, name):
+        """Read the hosts and children of a group, and skip its vars"""
+        for event in events:
+            if isinstance(event, yaml.MappingEndEvent):
+                return
+            key = self.__scalar(event)
+            event = next(events)
+            if key == 'hosts' and isinstance(event, yaml.MappingStartEvent):
+                self.__read_yaml_hosts(events, name, True)
+            elif key == 'hosts' and isinstance(event,
+                                               yaml.SequenceStartEvent):
+                self.__read_yaml_hosts(events, name, False)
+            elif key == 'children' and isinstance(event,
+                                                  yaml.MappingStartEvent):
+                self.__read_yaml_groups(events, name)
+            else:
+                self.__skip(event, events)
+
+    def __read_yaml_hosts(self, events, name, with_vars):
+        """
+        Read the hosts of a group, being a mapping of hosts to host vars,
+        or a list of hosts
+        """
+        hosts = self.__hosts[name]
+        for event in events:
+            if isinstance(event, (yaml.MappingEndEvent,
+                                  yaml.SequenceEndEvent)):
+                return
+            hosts.append(self.__scalar(event))
+            if with_vars:
+                self.__skip(next(events), events)
+
+    def __scalar(self, event):
+        if not isinstance(event, yaml.ScalarEvent):
+            raise InventoryException('expected a name at line',
+                                     event.start_mark.line + 1, 'of',
+                                     self.__path)
+        return event.value
+
+    @staticmethod
+    def __skip(event, events):
+        """Skip a value (and everything nested in it)"""
+        depth = 0
+        while True:
+            if isinstance(event, (yaml.MappingStartEvent,
+                                  yaml.SequenceStartEvent)):
+                depth += 1
+            elif isinstance(event, (yaml.MappingEndEvent,
+                                    yaml.SequenceEndEvent)):
+                depth -= 1
+            if depth == 0:
+                return
+            event = next(events)
+
+    def __read_ini(self, inventory_file):
+        name, kind = 'ungrouped', 'hosts'
+        self.__group(name)
+        for line in inventory_file:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line[0] == '[' and line[-1] == ']':
+                name, _, kind = line[1:-1].strip().partition(':')
+                kind = kind or 'hosts'
+                self.__group(name)
+            elif kind == 'hosts':
+                self.__hosts[name].append(line.split()[0])
+            elif kind == 'children':
+                self.__group(line.split()[0], name)
+            # [group:vars] sections hold no hosts
+
+    def path(self):
+        """Return the path of the inventory file"""
+        return self.__path
+
+    def groups(self):
+        """Return the names of all groups"""
+        return list(self.__hosts)
+
+    def has_hosts(self, group):
+        """Return True if a group (or one of its children) has hosts"""
+        seen_groups = set()
+        stack = [group]
+        while stack:
+            group = stack.pop()
+            if group in seen_groups:
+                continue
+            seen_groups.add(group)
+            if self.__hosts[group]:
+                return True
+            stack.extend(self.__children[group])
+        return False
+
+    def hosts(self, groups=None):
+        """
+        Return all hosts in some groups (and their children) as a generator.
+        Every host is returned once.
+        :param groups: the groups to return hosts for (default: all)
+        :raises InventoryException: when a group is unknown or has no hosts
+        """
+        groups = groups or ['all']
+        for group in groups:
+            if group not in self.__hosts:
+                raise InventoryException(f'group {group} not found in',
+                                         self.__path)
+            if not self.has_hosts(group):
+                raise InventoryException(f'no hosts in group {group} of',
+                                         self.__path)
+        seen_groups = set()
+        seen_hosts = set()
+        stack = list(reversed(groups))
+        while stack:
+            group = stack.pop()
+            if group in seen_groups:
+                continue
+            seen_groups.add(group)
+            for pattern in self.__hosts[group]:
+                for host in expand_host(str(pattern)):
+                    if host not in seen_hosts:
+                        seen_hosts.add(host)
+                        yield host
+            stack.extend(reversed(self.__children[group]))
@@ -0,0 +1,115 @@
+"""
+This module keeps an append-only journal of the steps that completed in a
+run (root, intermediates, and the key, csr and signature of every cert),
+so that an interrupted run can be resumed with only the unfinished work.
+
+When a CA is created again, everything that was issued by it before is
+forgotten, so that it is issued again with the new CA.
+
+Records are group-committed: they are flushed and fsynced once every
+`commit_records` records or `commit_interval` seconds (and on close),
+instead of once per record. A crash can lose the last (uncommitted)
+records, which only means those steps run again on resume.
+"""
+import json
+from os import fsync
+from os.path import exists
+from time import monotonic
+
+JOURNAL_FILE = 'journal.log'
+
+
+def read_journal(path):
+    """
+    Return the set of steps recorded in a journal file.
+    A truncated last record (from a crash while writing) is ignored.
+    """
+    steps = set()
+    if not exists(path):
+        return steps
+    with open(path, encoding="utf8") as journal_file:
+        for line in journal_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'step' in record:
+                steps.add(record['step'])
+            elif 'forget' in record:
+                steps = forget_steps(steps, record['forget'])
+    return steps
+
+
+def forget_steps(steps, prefix):
+    """Return the steps that do not start with prefix"""
+    return {step for step in steps if not step.startswith(prefix)}
+
+
+class Journal:
+    """
+    Journal records completed steps in a file, and answers whether a step
+    was completed before. Without resume, an existing journal is replaced.
+    """
+
+    __path = ''
+    __file = None
+    __done = None
+    __pending = 0
+    __last_commit = 0.0
+    __commit_records = 0
+    __commit_interval = 0.0
+
+    def __init__(self, path, resume=False, commit_records=100,
+                 commit_interval=1.0):
+        self.__path = path
+        self.__done = read_journal(path) if resume else set()
+        # pylint: disable=consider-using-with
+        self.__file = open(path, 'a' if resume else 'w', encoding="utf8")
+        self.__commit_records = commit_records
+        self.__commit_interval = commit_interval
+        self.__last_commit = monotonic()
+
+    def path(self):
+        """Return the path of the journal file"""
+        return self.__path
+
+    def done(self, step):
+        """Return True if a step was recorded as completed"""
+        return step in self.__done
+
+    def record(self, step, commit=False):
+        """
+        Record a step as completed
+        :param step: the unique name of the step
+        :param commit: commit right away, instead of with the next group
+        """
+        self.__done.add(step)
+        self.__write({'step': step}, commit)
+
+    def forget(self, prefix):
+        """
+        Forget all steps starting with prefix, so that they run again
+        :param prefix: the prefix of the steps to forget ('' for all)
+        """
+        self.__done = forget_steps(self.__done, prefix)
+        self.__write({'forget': prefix}, True)
+
+    def __write(self, record, commit):
+        self.__file.write(json.dumps(record) + '\n')
+        self.__pending += 1
+        if commit or self.__pending >= self.__commit_records or \
+                monotonic() - self.__last_commit >= self.__commit_interval:
+            self.commit()
+
+    def commit(self):
+        """Make all records so far durable with one fsync"""
+        if self.__pending:
+            self.__file.flush()
+            fsync(self.__file.fileno())
+            self.__pending = 0
+        self.__last_commit = monotonic()
+
+    def close(self):
+        """Commit outstanding records and close the journal"""
+        self.commit()
+        self.__file.close()
@@ -0,0 +1,229 @@
+"""
+This module keeps metrics about runs (issued and reused certs, openssl
+processes and their latency, run duration and the expiry horizon), and
+exports them in the Prometheus text format: as a file for the textfile
+collector of node_exporter after every run, and over HTTP for long running
+modes (watch and coordinator).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import replace
+from os.path import basename
+import subprocess
+from threading import Lock, Thread
+from time import monotonic
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+# All metrics, in the order they are exported
+REGISTRY = []
+_LOCK = Lock()
+
+
+def format_labels(names, values, extra=None):
+    """Return the label set of a sample, like {a="1",b="2"}"""
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                .replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"'
+                          for name, value in escaped) + '}'
+
+
+def format_value(value):
+    """Return a sample value as Prometheus expects it"""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Metric is a counter or gauge with optional labels.
+    Every combination of label values is a separate sample.
+    """
+
+    __name = ''
+    __help = ''
+    __kind = ''
+    __labels = ()
+    __values = None
+
+    def __init__(self, kind, name, help_text, labels=()):
+        self.__kind = kind
+        self.__name = name
+        self.__help = help_text
+        self.__labels = tuple(labels)
+        self.__values = {}
+        REGISTRY.append(self)
+
+    def __key(self, labels):
+        return tuple(str(labels[name]) for name in self.__labels)
+
+    def inc(self, amount=1, **labels):
+        """Add to the sample for some label values"""
+        key = self.__key(labels)
+        with _LOCK:
+            self.__values[key] = self.__values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        """Set the sample for some label values (for gauges)"""
+        with _LOCK:
+            self.__values[self.__key(labels)] = value
+
+    def clear(self):
+        """Remove all samples, e.a. for gauges that are set again in full"""
+        with _LOCK:
+            self.__values.clear()
+
+    def value(self, **labels):
+        """Return the sample for some label values"""
+        return self.__values.get(self.__key(labels), 0)
+
+    def render(self):
+        """Return the metric in the Prometheus text format"""
+        lines = [f'# HELP {self.__name} {self.__help}',
+                 f'# TYPE {self.__name} {self.__kind}']
+        for key, value in sorted(self.__values.items()):
+            lines.append(self.__name + format_labels(self.__labels, key) +
+                         ' ' + format_value(value))
+        return '\n'.join(lines) + '\n'
+
+
+class Histogram:
+    """Histogram counts observations in cumulative buckets"""
+
+    __name = ''
+    __help = ''
+    __labels = ()
+    __buckets = DEFAULT_BUCKETS
+    __values = None
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.__name = name
+        self.__help = help_text
+        self.__labels = tuple(labels)
+        self.__buckets = tuple(buckets) + (float('inf'),)
+        self.__values = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        """Count one observation"""
+        key = tuple(str(labels[name]) for name in self.__labels)
+        with _LOCK:
+            counts, total = self.__values.get(
+                key, ([0] * len(self.__buckets), 0.0))
+            for i, bound in enumerate(self.__buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.__values[key] = (counts, total + value)
+
+    def render(self):
+        """Return the metric in the Prometheus text format"""
+        lines = [f'# HELP {self.__name} {self.__help}',
+                 f'# TYPE {self.__name} histogram']
+        for key, (counts, total) in sorted(self.__values.items()):
+            for bound, bucket_count in zip(self.__buckets, counts):
+                labels = format_labels(self.__labels, key,
+                                       [('le', format_value(bound))])
+                lines.append(f'{self.__name}_bucket{labels} {bucket_count}')
+            labels = format_labels(self.__labels, key)
+            lines.append(f'{self.__name}_sum{labels} {format_value(total)}')
+            lines.append(f'{self.__name}_count{labels} {counts[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+CERTS = Metric('counter', 'chainsmith_certs_total',
+               'Certs per intermediate that were issued, or reused from an '
+               'earlier run', ['intermediate', 'result'])
+PROCESSES = Metric('counter', 'chainsmith_openssl_processes_total',
+                   'openssl processes that were run, by command',
+                   ['command'])
+FAILURES = Metric('counter', 'chainsmith_openssl_failures_total',
+                  'openssl processes that failed, by command', ['command'])
+STEP_SECONDS = Histogram('chainsmith_step_duration_seconds',
+                         'Duration of the steps to create a cert (key, csr, '
+                         'sign, verify, ...)', ['step'])
+RUN_SECONDS = Metric('gauge', 'chainsmith_run_duration_seconds',
+                     'Duration of the last run')
+LAST_RUN = Metric('gauge', 'chainsmith_last_run_timestamp_seconds',
+                  'Time the last run finished')
+EARLIEST_NOT_AFTER = Metric('gauge',
+                            'chainsmith_earliest_not_after_timestamp_seconds',
+                            'The earliest notAfter of the certs issued by '
+                            'a CA', ['ca'])
+
+
+def command_label(args):
+    """Return the command of a process, being the openssl subcommand"""
+    if basename(args[0]) == 'openssl' and len(args) > 1:
+        return args[1]
+    return basename(args[0])
+
+
+def run(args, **kwargs):
+    """subprocess.run that counts openssl processes and their failures"""
+    command = command_label(args)
+    PROCESSES.inc(command=command)
+    try:
+        # pylint: disable=subprocess-run-check
+        result = subprocess.run(args, **kwargs)
+    except subprocess.CalledProcessError:
+        FAILURES.inc(command=command)
+        raise
+    if result.returncode:
+        FAILURES.inc(command=command)
+    return result
+
+
+def timed(step, started):
+    """Observe the duration of a step that started at monotonic started"""
+    STEP_SECONDS.observe(monotonic() - started, step=step)
+
+
+def render():
+    """Return all metrics in the Prometheus text format"""
+    with _LOCK:
+        return ''.join(metric.render() for metric in REGISTRY)
+
+
+def write_textfile(path):
+    """
+    Write all metrics to a file for the node_exporter textfile collector.
+    The file is replaced at once, so it is never scraped half written.
+    """
+    with open(path + '.tmp', 'w', encoding="utf8") as textfile:
+        textfile.write(render())
+    replace(path + '.tmp', path)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """MetricsHandler serves the metrics on /metrics"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Return the metrics"""
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=W0622
+        """Scrapes are not logged"""
+
+
+def serve(address):
+    """
+    Serve the metrics over HTTP in a background thread
+    :param address: a (host, port) tuple
+    :return: the server, to shut it down
+    """
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,196 @@
+"""
+This module runs the work for many certificates as a dependency graph of
+small steps on an asyncio subprocess scheduler.
+Every step (an openssl command, or a python callable) starts as soon as
+the steps it depends on are done, so that signing one cert overlaps with
+key generation, format conversions and verification of others.
+The number of concurrent openssl processes is limited globally.
+"""
+import asyncio
+import inspect
+from os import cpu_count
+from os.path import getsize
+from subprocess import CalledProcessError, PIPE
+from sys import stdout, stderr
+from time import monotonic
+
+from chainsmith.metrics import FAILURES, PROCESSES, command_label, timed
+
+
+class Step:  # pylint: disable=too-many-instance-attributes
+    """
+    A Step is one node in the dependency graph. It either runs a command
+    (args) or calls a python function (func, which may return an awaitable),
+    after all its dependencies are done. Steps with the same lock never run
+    at the same time.
+    outputs are the files a command creates, and ran tells if the command
+    actually ran (or was skipped when resuming).
+    """
+
+    # pylint: disable=too-few-public-methods,too-many-arguments
+    def __init__(self, name, args=None, *, func=None, deps=None, cwd=None,
+                 lock=None, outputs=None):
+        self.name = name
+        self.args = args
+        self.func = func
+        self.deps = list(deps or [])
+        self.cwd = cwd
+        self.lock = lock
+        self.outputs = list(outputs or [])
+        self.ran = False
+
+    def outputs_exist(self):
+        """Return True if all output files exist and are not empty"""
+        try:
+            return all(getsize(output) > 0 for output in self.outputs)
+        except OSError:
+            return False
+
+
+class Scheduler:
+    """
+    Scheduler collects Steps, and runs them all in one event loop with at
+    most `concurrency` commands running at the same time.
+    With a journal, every command (and every function with outputs) that
+    completes is recorded, and those that were recorded before (and whose
+    outputs still exist) are skipped.
+    The duration of every command is observed in the step duration metric,
+    with the part of the step name after the last ':' as step label.
+    """
+
+    __steps = None
+    __concurrency = 1
+    __journal = None
+    __stdout = stdout
+    __stderr = stderr
+
+    def __init__(self, concurrency=None, journal=None):
+        self.__steps = []
+        self.__concurrency = concurrency or cpu_count() or 1
+        self.__journal = journal
+
+    def set_debug_output(self, out, err):
+        """Set the stdout and stderr to log to"""
+        self.__stdout = out
+        self.__stderr = err
+
+    def concurrency(self):
+        """Return the maximum number of concurrent commands"""
+        return self.__concurrency
+
+    # pylint: disable=too-many-arguments
+    def add(self, name, args=None, *, func=None, deps=None, cwd=None,
+            lock=None, outputs=None):
+        """
+        Add a step to the graph.
+        :param name: a unique name for the step, used in logging
+        :param args: the command to run
+        :param func: the python callable to run (when args is not set).
+                     When it returns an awaitable, that is awaited without
+                     holding a concurrency slot. A function without outputs
+                     always runs, and returns True when it changed an input
+                     of later steps (which are then not skipped).
+        :param deps: the steps that should be done before this one starts
+        :param cwd: the working directory for the command
+        :param lock: steps with the same lock never run concurrently
+        :param outputs: the files the command creates. When resuming, a
+                        journaled step is only skipped when these exist.
+        :return: the new Step, to be used as dependency for other steps
+        """
+        step = Step(name, args, func=func, deps=deps, cwd=cwd, lock=lock,
+                    outputs=outputs)
+        self.__steps.append(step)
+        return step
+
+    def run(self):
+        """
+        Run all steps that were added, and clear the graph.
+        Raises the first error, after cancelling all steps that are still
+        pending.
+        """
+        steps, self.__steps = self.__steps, []
+        if steps:
+            asyncio.run(self.__run(steps))
+
+    async def __run(self, steps):
+        semaphore = asyncio.Semaphore(self.__concurrency)
+        locks = {step.lock: asyncio.Lock() for step in steps if step.lock}
+        tasks = {}
+        for step in steps:
+            tasks[step] = asyncio.ensure_future(
+                self.__run_step(step, tasks, semaphore, locks))
+        done, pending = await asyncio.wait(
+            tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+
+    async def __run_step(self, step, tasks, semaphore, locks):
+        for dep in step.deps:
+            await tasks[dep]
+        if step.lock:
+            async with locks[step.lock]:
+                await self.__execute(step, semaphore)
+        else:
+            await self.__execute(step, semaphore)
+
+    def __can_skip(self, step):
+        """
+        A step can be skipped when it completed in an earlier run, its
+        outputs still exist, and none of its inputs were created again
+        """
+        if self.__journal is None or not self.__journal.done(step.name):
+            return False
+        if any(dep.ran for dep in step.deps):
+            return False
+        return step.outputs_exist()
+
+    async def __execute(self, step, semaphore):
+        if step.args is None and not step.outputs:
+            step.ran = bool(await self.__call(step))
+            return
+        if self.__can_skip(step):
+            return
+        if step.args is None:
+            await self.__call(step)
+        else:
+            await self.__run_command(step, semaphore)
+        step.ran = True
+        if self.__journal is not None:
+            self.__journal.record(step.name)
+
+    @staticmethod
+    async def __call(step):
+        result = step.func()
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def __run_command(self, step, semaphore):
+        async with semaphore:
+            started = monotonic()
+            PROCESSES.inc(command=command_label(step.args))
+            proc = await asyncio.create_subprocess_exec(
+                *step.args, cwd=step.cwd, stdout=PIPE, stderr=PIPE)
+            try:
+                out, err = await proc.communicate()
+            except asyncio.CancelledError:
+                # Another step failed, do not leave this one running
+                proc.kill()
+                await proc.wait()
+                raise
+            timed(step.name.rpartition(':')[2], started)
+        # Output is written per command, so that concurrent commands do not
+        # end up interleaved in the logs
+        command = ' '.join(step.args)
+        self.__stdout.write(command + ':\n')
+        self.__stdout.write('=' * len(command) + '=\n')
+        self.__stdout.write(out.decode('utf8', errors='replace'))
+        self.__stderr.write(err.decode('utf8', errors='replace'))
+        if proc.returncode:
+            FAILURES.inc(command=command_label(step.args))
+            raise CalledProcessError(proc.returncode, step.args, out, err)
@@ -0,0 +1,91 @@
+"""
+This module keeps the certs that an intermediate issued in a compact,
+column oriented registry, instead of one object per cert.
+A long running process (like watch) keeps tens or hundreds of thousands of
+certs loaded, and a TlsCert object per cert (paths, subject, alternate
+names, ...) adds up to kilobytes each. The registry keeps only what cannot
+be derived (name and alternate names) in arrays, and TlsCert objects are
+only created when a cert is actually worked on. Serial and notAfter are in
+the inventory (certs.db).
+"""
+from array import array
+
+SAN_SEPARATOR = b'\n'
+# Retired rows are only compacted away once they make up half the rows
+COMPACT_MINIMUM = 1024
+
+
+class CertRegistry:
+    """
+    CertRegistry holds the certs of a CA in columns:
+    - the row of every cert, by name
+    - the alternate names of all certs as one blob, with an offset per row
+    Rows are only appended. Retired rows are left in place until they are
+    compacted, so that retiring a cert does not move all others.
+    """
+
+    __rows = None
+    __san_data = None
+    __san_offsets = None
+    __garbage = 0
+
+    def __init__(self):
+        self.__clear()
+
+    def __clear(self):
+        self.__rows = {}
+        self.__san_data = bytearray()
+        self.__san_offsets = array('Q', [0])
+        self.__garbage = 0
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __contains__(self, name):
+        return name in self.__rows
+
+    def __iter__(self):
+        return iter(list(self.__rows))
+
+    def add(self, san):
+        """
+        Add a cert (replacing a cert with the same name)
+        :param san: the SAN list, the first name being the name of the cert
+        """
+        name = san[0]
+        self.remove(name)
+        self.__rows[name] = len(self.__san_offsets) - 1
+        self.__san_data += SAN_SEPARATOR.join(
+            alt_name.encode('utf8') for alt_name in san[1:])
+        self.__san_offsets.append(len(self.__san_data))
+
+    def sans(self, name):
+        """Return the SAN list of a cert (the first name being its name)"""
+        row = self.__rows[name]
+        data = self.__san_data[self.__san_offsets[row]:
+                               self.__san_offsets[row + 1]]
+        if not data:
+            return [name]
+        return [name] + [alt_name.decode('utf8')
+                         for alt_name in data.split(SAN_SEPARATOR)]
+
+    def remove(self, name):
+        """Remove a cert (if it is registered)"""
+        if self.__rows.pop(name, None) is None:
+            return
+        self.__garbage += 1
+        if self.__garbage >= COMPACT_MINIMUM and \
+                self.__garbage > len(self.__rows):
+            self.__compact()
+
+    def __compact(self):
+        """Rebuild the columns with only the rows that are still in use"""
+        rows = self.__rows
+        san_data = self.__san_data
+        san_offsets = self.__san_offsets
+        self.__clear()
+        for name, row in rows.items():
+            self.__rows[name] = len(self.__san_offsets) - 1
+            self.__san_data += san_data[san_offsets[row]:
+                                        san_offsets[row + 1]]
+            self.__san_offsets.append(len(self.__san_data))
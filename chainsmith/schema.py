@@ -0,0 +1,281 @@
+"""
+This module validates a chainsmith config before anything is generated.
+All problems are collected and reported at once, so that a bad config fails
+in milliseconds instead of halfway through a run of key generation.
+"""
+from difflib import get_close_matches
+from os.path import exists
+
+from chainsmith.exceptions import ConfigSchemaException, InventoryException
+from chainsmith.formats import ENCODINGS
+from chainsmith import inventory
+
+SUBJECT_KEYS = ['C', 'ST', 'L', 'O', 'OU', 'CN', 'emailAddress']
+
+KEY_USAGES = [
+    'critical',
+    'digitalSignature',
+    'nonRepudiation',
+    'keyEncipherment',
+    'dataEncipherment',
+    'keyAgreement',
+    'keyCertSign',
+    'cRLSign',
+    'encipherOnly',
+    'decipherOnly',
+]
+
+EXTENDED_KEY_USAGES = [
+    'critical',
+    'serverAuth',
+    'clientAuth',
+    'codeSigning',
+    'emailProtection',
+    'timeStamping',
+    'OCSPSigning',
+]
+
+# Intermediate keys that hold a list of values from a fixed set
+ALLOWED_VALUES = {
+    'keyUsages': KEY_USAGES,
+    'extendedKeyUsages': EXTENDED_KEY_USAGES,
+    'encodings': ENCODINGS,
+}
+
+INTERMEDIATE_KEYS = [
+    'name',
+    'clients',
+    'servers',
+    'hosts',
+    'hostGroups',
+    'keyUsages',
+    'extendedKeyUsages',
+    'encodings',
+    'pkcs11',
+]
+
+PKCS11_KEYS = [
+    'library',
+    'token',
+    'pin',
+    'pinFile',
+    'label',
+    'sessions',
+]
+
+
+def close_match(key, known):
+    """
+    Return the known key that was most probably meant, or None.
+    Matches differences in case and underscores (extended_key_usages for
+    extendedKeyUsages) as well as typos.
+    """
+    normalized = key.replace('_', '').replace('-', '').lower()
+    for candidate in known:
+        if candidate.lower() == normalized:
+            return candidate
+    matches = get_close_matches(key, known, n=1)
+    if matches:
+        return matches[0]
+    return None
+
+
+class ConfigValidator:
+    """
+    ConfigValidator checks a Config (or any dict with the same layout)
+    against the schema of chainsmith.yml, and collects all errors.
+    """
+
+    __errors = None
+
+    def __init__(self):
+        self.__errors = []
+
+    def error(self, path, message):
+        """Register an error for an item in the config"""
+        self.__errors.append(f'{path}: {message}')
+
+    def errors(self):
+        """Return all errors found so far"""
+        return list(self.__errors)
+
+    def check_str(self, path, value):
+        """Check that value is a non empty string"""
+        if not isinstance(value, str) or not value:
+            self.error(path, 'should be a non empty string')
+            return False
+        return True
+
+    def check_name(self, path, value):
+        """Check that value can be used as part of a file name"""
+        if self.check_str(path, value) and ('/' in value or
+                                            value.startswith('.')):
+            self.error(path, f"'{value}' cannot be used as a file name")
+
+    def check_list(self, path, value, allowed=None):
+        """Check that value is a list of strings, optionally from allowed"""
+        if not isinstance(value, list):
+            self.error(path, 'should be a list')
+            return
+        for i, item in enumerate(value):
+            if not self.check_str(f'{path}[{i}]', item):
+                continue
+            if allowed and item not in allowed:
+                suggestion = close_match(item, allowed)
+                hint = f", did you mean '{suggestion}'" if suggestion else ''
+                self.error(f'{path}[{i}]', f"unknown value '{item}'{hint}")
+
+    def check_subject(self, path, subject):
+        """Check the subject of the chain"""
+        if not isinstance(subject, dict):
+            self.error(path, 'should be a mapping')
+            return
+        for key, value in subject.items():
+            if key not in SUBJECT_KEYS:
+                suggestion = close_match(key, SUBJECT_KEYS)
+                hint = f", did you mean '{suggestion}'" if suggestion else ''
+                self.error(f'{path}.{key}', f'unknown subject field{hint}')
+            self.check_str(f'{path}.{key}', value)
+
+    def check_hosts(self, path, hosts):
+        """Check that an ansible inventory file exists"""
+        if self.check_str(path, hosts) and not exists(hosts):
+            self.error(path, f"inventory file '{hosts}' does not exist")
+
+    def check_groups(self, path, hosts, groups):
+        """Check that groups exist in an ansible inventory file, with hosts"""
+        self.check_list(path, groups)
+        if not isinstance(groups, list) or not isinstance(hosts, str) or \
+                not exists(hosts):
+            return
+        try:
+            hosts_inventory = inventory.load(hosts)
+        except InventoryException as inventory_error:
+            self.error(path, str(inventory_error))
+            return
+        known = hosts_inventory.groups()
+        for i, group in enumerate(groups):
+            if group not in known:
+                suggestion = close_match(str(group), known)
+                hint = f", did you mean '{suggestion}'" if suggestion else ''
+                self.error(f'{path}[{i}]',
+                           f"group '{group}' not found in {hosts}{hint}")
+            elif not hosts_inventory.has_hosts(group):
+                self.error(f'{path}[{i}]',
+                           f"group '{group}' has no hosts in {hosts}")
+
+    def check_servers(self, path, servers):
+        """Check the servers of an intermediate"""
+        if not isinstance(servers, dict):
+            self.error(path, 'should be a mapping of hostname to a list of '
+                             'alternate names')
+            return
+        for name, alts in servers.items():
+            self.check_name(f'{path}.{name}', name)
+            if alts is not None:
+                self.check_list(f'{path}.{name}', alts)
+
+    def check_inventory(self, path, intermediate, hosts):
+        """Check the inventory and host groups of an intermediate"""
+        if intermediate.get('hosts') is not None:
+            self.check_hosts(f'{path}.hosts', intermediate['hosts'])
+        if 'hostGroups' in intermediate:
+            self.check_groups(f'{path}.hostGroups',
+                              intermediate.get('hosts', hosts),
+                              intermediate['hostGroups'])
+
+    def check_pkcs11(self, path, config):
+        """Check the config of a CA key on a PKCS#11 token"""
+        if not isinstance(config, dict):
+            self.error(path, 'should be a mapping')
+            return
+        for key in config:
+            if key not in PKCS11_KEYS:
+                suggestion = close_match(key, PKCS11_KEYS)
+                hint = f", did you mean '{suggestion}'" if suggestion else ''
+                self.error(f'{path}.{key}', f'unknown key{hint}')
+        for key in ['library', 'token']:
+            if key not in config:
+                self.error(path, f"missing required key '{key}'")
+            else:
+                self.check_str(f'{path}.{key}', config[key])
+        if isinstance(config.get('library'), str) and \
+                not exists(config['library']):
+            self.error(f'{path}.library',
+                       f"PKCS#11 module '{config['library']}' does not exist")
+        if 'pin' not in config and 'pinFile' not in config:
+            self.error(path, "missing required key 'pin' or 'pinFile'")
+        for key in ['pin', 'pinFile', 'label']:
+            if key in config:
+                self.check_str(f'{path}.{key}', config[key])
+        sessions = config.get('sessions', 1)
+        if not isinstance(sessions, int) or sessions < 1:
+            self.error(f'{path}.sessions', 'should be a positive number')
+
+    def check_intermediate(self, path, intermediate, hosts=None):
+        """
+        Check the config of one intermediate
+        :param hosts: the global inventory, which is used when the
+                      intermediate has none
+        """
+        if not isinstance(intermediate, dict):
+            self.error(path, 'should be a mapping')
+            return
+        for key in intermediate:
+            if key not in INTERMEDIATE_KEYS:
+                suggestion = close_match(key, INTERMEDIATE_KEYS)
+                hint = f", did you mean '{suggestion}'" if suggestion else ''
+                self.error(f'{path}.{key}', f'unknown key{hint}')
+        if 'name' not in intermediate:
+            self.error(path, "missing required key 'name'")
+        else:
+            self.check_name(f'{path}.name', intermediate['name'])
+        if 'clients' in intermediate:
+            self.check_list(f'{path}.clients', intermediate['clients'])
+            if isinstance(intermediate['clients'], list):
+                for i, client in enumerate(intermediate['clients']):
+                    self.check_name(f'{path}.clients[{i}]', client)
+        if 'servers' in intermediate:
+            self.check_servers(f'{path}.servers', intermediate['servers'])
+        self.check_inventory(path, intermediate, hosts)
+        if 'pkcs11' in intermediate:
+            self.check_pkcs11(f'{path}.pkcs11', intermediate['pkcs11'])
+        for key, allowed in ALLOWED_VALUES.items():
+            if key in intermediate:
+                self.check_list(f'{path}.{key}', intermediate[key], allowed)
+
+    def check_config(self, config):
+        """Check a complete config"""
+        if 'subject' in config:
+            self.check_subject('subject', config['subject'])
+        if config.get('hosts') is not None:
+            self.check_hosts('hosts', config['hosts'])
+        if config.get('pkcs11') is not None:
+            self.check_pkcs11('pkcs11', config['pkcs11'])
+        intermediates = config.get('intermediates')
+        if not isinstance(intermediates, list) or not intermediates:
+            self.error('intermediates', 'should be a non empty list')
+            return
+        names = set()
+        for i, intermediate in enumerate(intermediates):
+            self.check_intermediate(f'intermediates[{i}]', intermediate,
+                                    config.get('hosts'))
+            if not isinstance(intermediate, dict):
+                continue
+            name = intermediate.get('name')
+            if isinstance(name, str) and name in names:
+                self.error(f'intermediates[{i}].name',
+                           f"duplicate intermediate '{name}'")
+            names.add(name)
+
+
+def validate(config):
+    """
+    Validate a config and raise a ConfigSchemaException listing all errors
+    :param config: the Config to validate
+    """
+    validator = ConfigValidator()
+    validator.check_config(config)
+    errors = validator.errors()
+    if errors:
+        raise ConfigSchemaException(errors)
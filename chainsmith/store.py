@@ -0,0 +1,137 @@
+"""
+This module reads the material of single certs (cert, private key and
+chain) from a CA store, for deployment tools like the Ansible lookup plugin
+that ships with chainsmith.
+Deploying to a few hosts then reads a few files, instead of the certs and
+private keys yaml of all hosts. Certs are found with the inventory
+(certs.db) when the store has one, and by path otherwise. What was read is
+cached per process (an Ansible task runs in a worker process of its own),
+and read again when a cert was issued again.
+"""
+from glob import glob
+from os import stat
+from os.path import basename, dirname, exists, join
+import sqlite3
+
+from chainsmith.certdb import CertDB, DB_FILE
+from chainsmith.exceptions import StoreException
+from chainsmith.x509 import X509Cert
+
+# StoreReaders by CA store, and material by cert path, for as long as the
+# process runs (e.a. the Ansible worker of one task)
+_READERS = {}
+_MATERIAL = {}
+
+
+def read_file(path):
+    """Return the content of a text file"""
+    with open(path, encoding="utf8") as file:
+        return file.read()
+
+
+class StoreReader:
+    """
+    StoreReader finds certs in a CA store by name (or alternate name), and
+    reads their material.
+    """
+
+    __capath = ''
+    __db = None
+
+    def __init__(self, path):
+        """
+        :param path: the tmpdir of a chainsmith run, or its tls folder
+        """
+        if exists(join(path, 'tls', 'certs', 'cacert.pem')):
+            path = join(path, 'tls')
+        if not exists(join(path, 'certs', 'cacert.pem')):
+            raise StoreException(f'no CA store in {path}')
+        self.__capath = path
+        if exists(join(path, DB_FILE)):
+            self.__db = CertDB.for_store(path, read_only=True)
+
+    def close(self):
+        """Close the inventory (if it was opened)"""
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    def __query(self, name, intermediate):
+        """Return the paths of the certs named name (or with it as SAN)"""
+        try:
+            for filters in [{'cn': name}, {'san': name}]:
+                # The inventory holds paths as they were when the cert was
+                # issued, which need not be valid where the store is now
+                paths = [join(self.__capath, 'int_' + result['intermediate'],
+                              'certs', result['name'] + '.pem')
+                         for result in self.__db.query(
+                             intermediate=intermediate, **filters)
+                         if result['kind'] == 'cert']
+                if paths:
+                    return paths
+        except sqlite3.Error as error:
+            raise StoreException(f'cannot query the inventory of '
+                                 f'{self.__capath}: {error}') from error
+        return []
+
+    def __glob(self, name, intermediate):
+        """Return the paths of the certs named name, without inventory"""
+        return sorted(glob(join(self.__capath, 'int_' + (intermediate or '*'),
+                                'certs', name + '.pem')))
+
+    def find(self, name, intermediate=None):
+        """
+        Return the path of the cert for name
+        :param name: the name of the cert (or one of its alternate names)
+        :param intermediate: the intermediate that signed it, which is
+                             required when more than one has a cert for name
+        """
+        if self.__db is not None:
+            paths = self.__query(name, intermediate)
+        else:
+            paths = self.__glob(name, intermediate)
+        if not paths:
+            raise StoreException(f'no cert for {name} in {self.__capath}')
+        if len(paths) > 1:
+            intermediates = sorted(basename(dirname(dirname(path)))[4:]
+                                   for path in paths)
+            raise StoreException(f'{name} has certs of more than one '
+                                 f'intermediate ({", ".join(intermediates)})'
+                                 f', choose one with intermediate')
+        return paths[0]
+
+    def material(self, name, intermediate=None):
+        """
+        Return a dict with the name, intermediate, cert, private key, chain,
+        alternate names, serial and notAfter of the cert for name
+        """
+        cert_path = self.find(name, intermediate)
+        modified = stat(cert_path).st_mtime_ns
+        cached = _MATERIAL.get(cert_path)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+        int_path = dirname(dirname(cert_path))
+        cert_name = basename(cert_path)[:-len('.pem')]
+        cert_pem = read_file(cert_path)
+        cert = X509Cert.from_pem(cert_pem)
+        material = {
+            'name': cert_name,
+            'intermediate': basename(int_path)[4:],
+            'cert': cert_pem,
+            'key': read_file(join(int_path, 'private',
+                                  cert_name + '.key.pem')),
+            'chain': read_file(join(int_path, 'certs',
+                                    'ca-chain-bundle.cert.pem')),
+            'sans': cert.subject_alternative_names(),
+            'serial': cert.serial_hex(),
+            'not_after': cert.not_after().isoformat(),
+        }
+        _MATERIAL[cert_path] = (modified, material)
+        return material
+
+
+def store_reader(path):
+    """Return the (shared) StoreReader for a CA store"""
+    if path not in _READERS:
+        _READERS[path] = StoreReader(path)
+    return _READERS[path]
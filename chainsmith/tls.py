@@ -3,16 +3,30 @@ This module handles Tls objects, which could be
 - a TLS root ca or TLS intermediate (and private keys)
 - a certificate (and private keys)
 """
+# pylint: disable=too-many-lines
+import asyncio
+from functools import partial
 from ipaddress import ip_address
-from os import makedirs
+from os import makedirs, replace
 from os.path import join, realpath, expanduser, exists
 from string import digits, ascii_uppercase
 from sys import stdout, stderr
 from random import choice
 from tempfile import NamedTemporaryFile
-from subprocess import run
-
+from time import monotonic
+
+from chainsmith.audit import rsa_verify
+from chainsmith.certbuilder import TAG_SEQUENCE, certificate, \
+    cnf_extensions, encode_name, request, request_info, \
+    rsa_public_key_info, tbs_certificate
+from chainsmith.certdb import CertDB
+from chainsmith.hsm import Pkcs11Signer
+from chainsmith.metrics import CERTS, run, timed
 from chainsmith.exceptions import TlsPwdAlreadySetException
+from chainsmith.formats import DEFAULT_ENCODINGS, binary, cert_der, \
+    private_key_der, private_key_pk8
+from chainsmith.registry import CertRegistry
+from chainsmith.x509 import X509Cert, X509Request, encode
 from chainsmith.config_file import ConfigFile, ConfigLine, ConfigChapter
 
 
@@ -82,6 +96,11 @@ class TlsSubject(dict):
         return chapter
 
 
+# Days that a root, an intermediate and a cert are valid
+CA_DAYS = 3650
+INTERMEDIATE_DAYS = 2650
+CERT_DAYS = 365
+
 DEFAULT_KEY_USAGES = [
     'critical',
     'dataEncipherment',
@@ -98,7 +117,7 @@ DEFAULT_EXTENDED_KEY_USAGES = [
 
 
 # pylint: disable=too-many-public-methods
-class TlsCA(dict):
+class TlsCA:
     """
     TlsCA represents a certificate authority, either root or intermediate.
     It just is a placeholder for the folder, directories, config files, etc.
@@ -106,6 +125,10 @@ class TlsCA(dict):
     private keys, etc. if __parent is None, it is a root certificate, if not,
     it is an intermediate certificate. The class can be used to set up a
     CA store, and use it to sign requests for lower certificates.
+    A root keeps its intermediates, an intermediate keeps the certs it
+    issued in a CertRegistry (TlsCert objects are created on demand).
+    With a pkcs11 config, the key of the CA is kept on a PKCS#11 token, and
+    certs are built and signed in-process instead of with openssl.
     """
 
     # pylint: disable=too-many-instance-attributes
@@ -113,6 +136,7 @@ class TlsCA(dict):
     __name = ''
     __key_usages = []
     __extended_key_usages = []
+    __encodings = []
     __config_file = ''
     __pem_file = ''
     __password_file = ''
@@ -120,26 +144,36 @@ class TlsCA(dict):
     __chain_file = ''
     __subject = None
     __parent = None
+    __db = None
+    __journal = None
+    __coordinator = None
+    __intermediates = None
+    __certs = None
+    __signer = None
     __stdout = stdout
     __stderr = stderr
 
     def __init__(self, capath, name, config, parent):
-        super().__init__()
         self.__capath = capath
         self.__name = name
         self.__key_usages = config.get('keyUsages', DEFAULT_KEY_USAGES)
         self.__extended_key_usages = config.get(
             'extendedKeyUsages', DEFAULT_EXTENDED_KEY_USAGES)
+        self.__encodings = config.get('encodings', DEFAULT_ENCODINGS)
         self.__config_file = join(capath, 'config', 'ca.cnf')
         self.__pem_file = join(capath, 'private', 'cakey.pem')
         self.__password_file = join(capath, 'private', 'capass.enc')
         self.__cert_file = join(capath, 'certs', 'cacert.pem')
         self.__chain_file = join(capath, 'certs', 'ca-chain-bundle.cert.pem')
+        self.__intermediates = {}
+        self.__certs = CertRegistry()
+        if config.get('pkcs11'):
+            self.__signer = Pkcs11Signer(config['pkcs11'], name)
         try:
             if parent is not None:
                 self.set_subject(parent.subject())
                 self.__parent = parent
-            for folder in ['.', 'config', 'certs', 'csr',
+            for folder in ['.', 'config', 'certs', 'crl', 'csr',
                            'newcerts', 'private']:
                 path = realpath(expanduser(join(capath, folder)))
                 if not exists(path):
@@ -148,10 +182,22 @@ class TlsCA(dict):
             if not exists(serial_file):
                 with open(serial_file, 'w', encoding="utf8") as serial:
                     serial.write('01')
+            # So that openssl ca -gencrl can write CRLs into crl/, which
+            # are linked into the hashed CA directory
+            crlnumber_file = join(capath, 'crlnumber')
+            if not exists(crlnumber_file):
+                with open(crlnumber_file, 'w', encoding="utf8") as crlnumber:
+                    crlnumber.write('01')
             index_file = join(capath, 'index.txt')
             if not exists(index_file):
                 with open(index_file, 'w', encoding="utf8"):
                     pass
+            if parent is None:
+                self.__db = CertDB.for_store(capath)
+            else:
+                self.__db = parent.db()
+                self.__journal = parent.journal()
+                self.__coordinator = parent.coordinator()
         except OSError as os_err:
             print("Cannot open file:", os_err)
 
@@ -169,6 +215,10 @@ class TlsCA(dict):
         self.__stdout = out
         self.__stderr = err
 
+    def debug_output(self):
+        """Return the stdout and stderr to log to"""
+        return self.__stdout, self.__stderr
+
     def log_command(self, command):
         """log a command that is about to be run"""
         self.__stdout.write(command+':\n')
@@ -178,6 +228,21 @@ class TlsCA(dict):
         """Log a line"""
         self.__stdout.write(line+'\n')
 
+    def __run(self, args, step, in_capath=True):
+        """
+        Log and run an openssl command for this CA, and observe its duration
+        in the step duration metric
+        :param step: the name of the step in the metric
+        :param in_capath: run in the CA path (or in the current folder)
+        """
+        self.log_command(' '.join(args))
+        started = monotonic()
+        try:
+            run(args, cwd=self.__capath if in_capath else None, check=True,
+                stdout=self.__stdout, stderr=self.__stderr)
+        finally:
+            timed(step, started)
+
     def gen_pem_password(self, password=None):
         """Generate a random pem password"""
         if exists(self.__password_file):
@@ -198,9 +263,7 @@ class TlsCA(dict):
                 args = ['openssl', 'enc', '-aes256', '-salt', '-in',
                         tmp_file.name, '-out', self.__password_file, '-pass',
                         'file:'+tmp_file.name]
-                self.log_command(' '.join(args))
-                run(args, check=True, stdout=self.__stdout,
-                    stderr=self.__stderr)
+                self.__run(args, 'ca_password', in_capath=False)
         except OSError as os_err:
             print("Cannot open file:", os_err)
 
@@ -219,8 +282,69 @@ class TlsCA(dict):
         """Return the path to the configfile"""
         return self.__config_file
 
+    def chainfile(self):
+        """Return the path to the file with the chain of this CA"""
+        return self.__chain_file
+
+    def encodings(self):
+        """Return the encodings in which certs and keys are written"""
+        return self.__encodings
+
+    def usages(self):
+        """
+        Return the key usages and extended key usages of the certs that
+        this CA signs
+        """
+        return list(self.__key_usages), list(self.__extended_key_usages)
+
+    def set_encodings(self, encodings):
+        """Change the encodings in which certs and keys are written"""
+        self.__encodings = encodings
+
+    def db(self):
+        """Return the inventory database of the CA store"""
+        return self.__db
+
+    def set_journal(self, journal):
+        """
+        Set a Journal to record completed CAs in, and to skip CAs that
+        were completed before (when resuming)
+        """
+        self.__journal = journal
+
+    def journal(self):
+        """Return the journal of the CA store (or None)"""
+        return self.__journal
+
+    def set_coordinator(self, coordinator):
+        """
+        Set a distributed Coordinator, to have the keys and csrs of certs
+        created by workers
+        """
+        self.__coordinator = coordinator
+
+    def coordinator(self):
+        """Return the distributed Coordinator (or None)"""
+        return self.__coordinator
+
+    def signer(self):
+        """Return the Pkcs11Signer with the key of this CA (or None)"""
+        return self.__signer
+
+    def journal_key(self):
+        """Return the name of the step for this CA in the journal"""
+        if self.__parent is None:
+            return 'root'
+        # Within the prefix of the certs of this intermediate, so that
+        # forgetting an intermediate forgets its certs as well
+        return self.name() + '/ca'
+
     def gen_ca_cnf(self):
-        """Generate a ca.cnf from openssl.cnf with many changes"""
+        """
+        Generate a ca.cnf from openssl.cnf with many changes
+        :return: True if the config changed (e.a. other key usages), so that
+                 the CA and its certs are created again when resuming
+        """
         if self.__parent is not None:
             config_file = ConfigFile(self.__parent.configfile())
             config_file.set_key('CA_default', 'policy', 'policy_anything')
@@ -266,6 +390,9 @@ class TlsCA(dict):
                                 'critical,CA:true')
 
         config_file.set_key('CA_default', 'dir', self.__capath)
+        # Allow signing an intermediate again, e.g. when resuming a run that
+        # was interrupted after signing
+        config_file.set_key('CA_default', 'unique_subject', 'no')
         # lifetime of ca is 10 years
         config_file.set_key('CA_default', 'default_days', '3650')
 
@@ -302,7 +429,7 @@ class TlsCA(dict):
                             ', '.join(self.__extended_key_usages))
 
         self.log('writing config to ' + self.__config_file)
-        config_file.write(self.__config_file)
+        return config_file.write(self.__config_file)
 
     def gen_ca_pem(self):
         """Generate a private key for the ca"""
@@ -317,9 +444,7 @@ class TlsCA(dict):
         args = ['openssl', 'genrsa', '-des3', '-passout',
                 'file:' + self.__password_file, '-out', self.__pem_file,
                 '4096']
-        self.log_command(' '.join(args))
-        run(args, cwd=self.__capath, check=True, stdout=self.__stdout,
-            stderr=self.__stderr)
+        self.__run(args, 'ca_key')
         self.verify_pem()
 
     def verify_pem(self):
@@ -328,75 +453,164 @@ class TlsCA(dict):
         args = ['openssl', 'rsa', '-noout', '-text', '-in',
                 self.__pem_file, '-passin',
                 'file:' + self.__password_file]
-        self.log_command(' '.join(args))
-        run(args, cwd=self.__capath, check=True, stdout=self.__stdout,
-            stderr=self.__stderr)
+        self.__run(args, 'ca_verify_key')
 
     def create_ca_cert(self):
-        """Create the cert for this CA"""
-        self.gen_ca_cnf()
+        """
+        Create the cert for this CA. The ca.cnf is always generated, so that
+        a CA that was created before is created again when its config
+        changed.
+        """
+        changed = self.gen_ca_cnf()
+        if self.__journal is not None and not changed and \
+                self.__journal.done(self.journal_key()) and \
+                exists(self.__cert_file):
+            self.log(f'{self.name()} was created before, resuming')
+            return
+        if self.__journal is not None:
+            # Everything issued by an earlier version of this CA (and by
+            # intermediates of an earlier root) needs to be issued again
+            self.__journal.forget('' if self.__parent is None
+                                  else self.name() + '/')
+        if self.__signer is not None:
+            self.__create_signer_ca_cert()
+        else:
+            self.__create_pem_ca_cert()
+        self.verify_ca_cer()
+        self.write_chain()
+        if self.__parent is None:
+            self.__db.add('root', self.name(), self.name(), self.__cert_file)
+        else:
+            self.__db.add('intermediate', self.__parent.name(), self.name(),
+                          self.__cert_file)
+        if self.__journal is not None:
+            self.__journal.record(self.journal_key(), commit=True)
+
+    def __create_pem_ca_cert(self):
+        """
+        Create a key in a password protected PEM file, and the cert (root)
+        or a csr that the parent signs (intermediate) with openssl
+        """
         self.gen_ca_pem()
         self.log("Running openssl req for "+self.name())
         if self.__parent is None:
             self.log(self.__subject.string())
-            args = ['openssl', 'req', '-new', '-x509', '-days', '3650',
+            args = ['openssl', 'req', '-new', '-x509', '-days', str(CA_DAYS),
                     '-subj', self.__subject.string(), '-passin',
                     'file:' + self.__password_file, '-config',
                     self.__config_file, '-extensions', 'v3_ca', '-key',
                     self.__pem_file, '-out', self.__cert_file]
-            self.log_command(' '.join(args))
-            run(args, cwd=self.__capath, check=True, stdout=self.__stdout,
-                stderr=self.__stderr)
+            self.__run(args, 'ca_cert')
         else:
             csr_path = join(self.__capath, 'csr', 'intermediate.csr.pem')
             args = ['openssl', 'req', '-new', '-sha256', '-subj',
                     self.__subject.string(), '-config', self.__config_file,
                     '-passin', 'file:' + self.__password_file,
                     '-key', self.__pem_file, '-out', csr_path]
-            self.log_command(' '.join(args))
-            run(args, cwd=self.__capath, check=True, stdout=self.__stdout,
-                stderr=self.__stderr)
+            self.__run(args, 'ca_csr')
             self.__parent.sign_intermediate_csr(csr_path, self.__cert_file)
-        self.verify_ca_cer()
-        self.write_chain()
+
+    def __create_signer_ca_cert(self):
+        """
+        Find (or generate) the key on the token, and build the cert (root)
+        or a csr that the parent signs (intermediate) in-process
+        """
+        self.log(f'Using PKCS#11 key {self.__signer.label()} for '
+                 f'{self.name()}')
+        public_key_info = rsa_public_key_info(*self.__signer.public_key())
+        subject = encode_name(self.__subject.items())
+        if self.__parent is None:
+            extensions = cnf_extensions(ConfigFile(self.__config_file),
+                                        'v3_ca', public_key_info,
+                                        public_key_info)
+            tbs = tbs_certificate(subject, subject, public_key_info,
+                                  days=CA_DAYS, extensions=extensions)
+            with open(self.__cert_file, 'w', encoding="utf8") as cert:
+                cert.write(certificate(tbs, self.__signer.sign(tbs)))
+        else:
+            csr_path = join(self.__capath, 'csr', 'intermediate.csr.pem')
+            info = request_info(subject, public_key_info)
+            with open(csr_path, 'w', encoding="utf8") as csr:
+                csr.write(request(info, self.__signer.sign(info)))
+            self.__parent.sign_intermediate_csr(csr_path, self.__cert_file)
+
+    # pylint: disable=too-many-arguments
+    def __sign_request(self, csr_path, cert_path, config_file, section,
+                       days):
+        """
+        Build a cert for a csr in-process, with the extensions from a
+        section of an openssl config file, and sign it on the token
+        """
+        self.log(f'Signing {csr_path} with PKCS#11 key '
+                 f'{self.__signer.label()}')
+        csr = X509Request.from_file(csr_path)
+        problem = rsa_verify(csr, csr.rsa_public_key())
+        if problem:
+            raise Exception(f'{csr_path}: {problem}')
+        issuer = X509Cert.from_file(self.__cert_file)
+        extensions = cnf_extensions(config_file, section,
+                                    csr.public_key_info(),
+                                    issuer.public_key_info())
+        tbs = tbs_certificate(encode(TAG_SEQUENCE, issuer.subject_der()),
+                              encode(TAG_SEQUENCE, csr.subject_der()),
+                              csr.public_key_info(), days=days,
+                              extensions=extensions)
+        with open(cert_path + '.tmp', 'w', encoding="utf8") as cert:
+            cert.write(certificate(tbs, self.__signer.sign(tbs)))
+        replace(cert_path + '.tmp', cert_path)
 
     def sign_intermediate_csr(self, csr, cert):
         """Sign a csr for a child intermediate of this CA"""
+        if self.__signer is not None:
+            self.__sign_request(csr, cert, ConfigFile(self.__config_file),
+                                'v3_intermediate_ca', INTERMEDIATE_DAYS)
+            return
         self.log("Running openssl ca for "+self.name())
         args = ['openssl', 'ca', '-config', self.__config_file,
-                '-extensions', 'v3_intermediate_ca', '-days', '2650',
+                '-extensions', 'v3_intermediate_ca', '-days',
+                str(INTERMEDIATE_DAYS),
                 '-notext', '-batch', '-passin',
                 'file:' + self.__password_file, '-in', csr, '-out', cert]
-        self.log_command(' '.join(args))
-        run(args, cwd=self.__capath, check=True, stdout=self.__stdout,
-            stderr=self.__stderr)
+        self.__run(args, 'ca_sign')
 
-    def sign_cert_csr(self, ext_conf, csr_path, cert_path):
-        """Sign a csr for a child cert of this CA"""
+    def sign_cert_csr_args(self, ext_conf, csr_path, cert_path):
+        """Return the openssl command that signs a csr for a child cert"""
         # openssl x509 -req -days 3650 -in tls/int_server/csr/server1.csr
         # -signkey tls/int_server/private/cakey.pem
         # -out tls/int_server/certs/server1.pem
         # -extfile tls/int_server/config/req_server1.cnf -extensions v3_req
         # -passin file:/host/tls/int_server/private/capass.enc
-        self.log("Running openssl x509 req for "+self.name())
-        args = ['openssl', 'x509', '-req', '-in', csr_path, '-passin',
+        return ['openssl', 'x509', '-req', '-in', csr_path, '-passin',
                 'file:' + self.__password_file, '-CA',
                 self.__chain_file, '-CAkey', self.__pem_file, '-out',
-                cert_path, '-CAcreateserial', '-days', '365',
+                cert_path, '-CAcreateserial', '-days', str(CERT_DAYS),
                 '-sha256', '-extfile', ext_conf, '-extensions',
                 'v3_req']
-        self.log_command(' '.join(args))
-        run(args, cwd=self.__capath, check=True, stdout=self.__stdout,
-            stderr=self.__stderr)
+
+    def sign_cert_csr(self, ext_conf, csr_path, cert_path):
+        """Sign a csr for a child cert of this CA"""
+        if self.__signer is not None:
+            self.__sign_request(csr_path, cert_path, ConfigFile(ext_conf),
+                                'v3_req', CERT_DAYS)
+            return
+        self.log("Running openssl x509 req for "+self.name())
+        args = self.sign_cert_csr_args(ext_conf, csr_path, cert_path)
+        self.__run(args, 'sign')
+
+    async def sign_cert_csr_in_thread(self, ext_conf, csr_path, cert_path):
+        """
+        Sign a csr for a child cert on a thread, so that a pipeline signs
+        many certs with a PKCS#11 key at once (over the pooled sessions)
+        """
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.sign_cert_csr, ext_conf, csr_path, cert_path)
 
     def verify_ca_cer(self):
         """Verify that the certificate for this intermediate is valid"""
         self.log("Running openssl x509 for "+self.name())
         args = ['openssl', 'x509', '-noout', '-text', '-in',
                 'certs/cacert.pem']
-        self.log_command(' '.join(args))
-        run(args, cwd=self.__capath, check=True, stdout=self.__stdout,
-            stderr=self.__stderr)
+        self.__run(args, 'ca_verify')
 
     def get_cert(self):
         """Return the cert of this CA as a string"""
@@ -417,8 +631,8 @@ class TlsCA(dict):
     def get_certs(self):
         """Return a dict containing all certs as strings"""
         certs = {'chain': self.get_chain()}
-        for name, cert in self.items():
-            certs[name] = cert.get_cert()
+        for name in self.__certs:
+            certs.update(self.cert(name).get_certs(self.__encodings))
         return certs
 
     def get_private_key(self):
@@ -428,9 +642,13 @@ class TlsCA(dict):
 
     def get_private_keys(self):
         """Return a dict containing all private keys as strings"""
-        private_keys = {self.name(): self.get_private_key()}
-        for name, cert in self.items():
-            private_keys[name] = cert.get_private_key()
+        # The key of a CA on a PKCS#11 token never leaves the token
+        private_keys = {}
+        if self.__signer is None:
+            private_keys[self.name()] = self.get_private_key()
+        for name in self.__certs:
+            private_keys.update(
+                self.cert(name).get_private_keys(self.__encodings))
         return private_keys
 
     def write_chain(self):
@@ -449,16 +667,43 @@ class TlsCA(dict):
         if self.__parent is not None:
             raise Exception("Creating an intermediate on an intermediate "
                             "is currently not a feature...")
-        if name in self:
-            return self[name]
+        if name in self.__intermediates:
+            return self.__intermediates[name]
         int_path = join(self.__capath, 'int_' + name)
         int_ca = TlsCA(int_path, name, config, self)
         int_ca.set_debug_output(self.__stdout, self.__stderr)
         int_ca.create_ca_cert()
-        # For a root CA, all intermediates are stored in the object
-        self[name] = int_ca
+        self.__intermediates[name] = int_ca
         return int_ca
 
+    def intermediate(self, name):
+        """Return an intermediate of this (root) CA, or None"""
+        return self.__intermediates.get(name)
+
+    def intermediates(self):
+        """Return the names of the intermediates of this (root) CA"""
+        return list(self.__intermediates)
+
+    def certs(self):
+        """Return the CertRegistry with the certs of this intermediate"""
+        return self.__certs
+
+    def cert(self, name):
+        """
+        Return a TlsCert for a cert of this intermediate, or None.
+        The object is created from the registry on every call.
+        """
+        if name not in self.__certs:
+            return None
+        return TlsCert(self.__certs.sans(name), self)
+
+    def discard(self, name):
+        """
+        Remove a cert from this intermediate (but not from the inventory or
+        the journal), so that it is scheduled again
+        """
+        self.__certs.remove(name)
+
     def create_cert(self, san):
         """Create a root cert as a child of his intermediate"""
         if not san:
@@ -467,103 +712,177 @@ class TlsCA(dict):
         if self.__parent is None:
             raise Exception("Creating a certificate signed by a root CA is "
                             "currently not a feature...")
-        if name in self:
-            return self[name]
-        # For an intermediate CA, all certs are stored in the object itself
-        cert = TlsCert(san, self.__subject.clone(), self)
-        cert.set_debug_output(self.__stdout, self.__stderr)
+        if name in self.__certs:
+            return self.cert(name)
+        cert = TlsCert(san, self)
         cert.gen_pem()
         cert.gen_cnf()
         cert.gen_cert()
+        self.__certs.add(san)
+        self.__register(cert)
+        return cert
+
+    def retire(self, name):
+        """
+        Retire a cert (or for a root CA, an intermediate and all its certs).
+        It is removed from this CA and from the inventory, and forgotten by
+        the journal so that it is issued again when it comes back. The
+        files stay in the CA store.
+        """
+        self.__db.remove(self.name(), name)
+        if self.__parent is None:
+            self.__intermediates.pop(name, None)
+            self.__db.remove(name)
+            prefix = name + '/'
+        else:
+            self.__certs.remove(name)
+            prefix = f'{self.name()}/{name}:'
+        if self.__journal is not None:
+            self.__journal.forget(prefix)
 
-        self[name] = cert
+    def schedule_cert(self, san, scheduler):
+        """
+        Like create_cert, but add the steps to create the cert to a
+        pipeline Scheduler instead of running them. The cert is ready once
+        the scheduler has run.
+        """
+        if not san:
+            return None
+        name = san[0]
+        if self.__parent is None:
+            raise Exception("Creating a certificate signed by a root CA is "
+                            "currently not a feature...")
+        if name in self.__certs:
+            return self.cert(name)
+        cert = TlsCert(san, self)
+        verified = cert.schedule(scheduler)
+        scheduler.add(f'{self.name()}/{name}:register',
+                      func=partial(self.__register, cert), deps=[verified])
+        # Once the scheduler ran, only the registry row remains
+        self.__certs.add(san)
         return cert
 
+    def __register(self, cert):
+        """
+        Record a cert that was created in the inventory and metrics
+        """
+        self.__db.add('cert', self.name(), cert.name(), cert.certfile())
+        CERTS.inc(intermediate=self.name(),
+                  result='issued' if cert.issued() else 'reused')
+
 
 class TlsCert:
     """
     TlsCert represents a certificate to be handed out.
     This could be a client certificate or a server certificate.
     It works together with its parent (intermediate) for signing the csr.
+    TlsCerts only live while a cert is worked on (see CertRegistry), so they
+    only hold the name, alternate names and parent, and derive paths,
+    subject and log output from those.
     """
 
-    # pylint: disable=too-many-instance-attributes
-    __name = ""
-    __parent = None
-    __pem_file = ""
-    __pk8_file = ""
-    __der_file = ""
-    __subject_alternate_names = None
-    __csr_path = ""
-    __cert_file = ""
-    __subject = ""
-    __config_file = ""
-    __stdout = stdout
-    __stderr = stderr
+    __slots__ = ('__name', '__parent', '__subject_alternate_names',
+                 '__sign_step')
 
-    def __init__(self, san, subject, parent):
+    def __init__(self, san, parent):
         if not san:
             raise Exception('cannot create TlsCert without at least '
                             'one name in SAN list')
-        self.__name = name = san[0]
+        self.__name = san[0]
         self.__parent = parent
         self.__subject_alternate_names = san
-        self.__subject = subject
-        self.__subject['CN'] = name
+        self.__sign_step = None
 
-        path = parent.path()
-        self.__pem_file = join(path, 'private', name + '.key.pem')
-        self.__pk8_file = join(path, 'private', name + '.key.pk8')
-        self.__der_file = join(path, 'private', name + '.key.der')
-        self.__csr_path = join(path, 'csr', name + '.csr')
-        self.__cert_file = join(path, 'certs', name + '.pem')
-        self.__config_file = join(path, 'config', 'req_' + name + '.cnf')
+    def __path(self, folder, filename):
+        """Return the path of a file of this cert in the intermediate"""
+        return join(self.__parent.path(), folder, filename)
 
-    def set_debug_output(self, out, err):
-        """Set the stdout and stderr to log to"""
-        self.__stdout = out
-        self.__stderr = err
+    def __pem_file(self):
+        return self.__path('private', self.__name + '.key.pem')
+
+    def __encrypted_pem_file(self):
+        return self.__path('private', self.__name + '.key.cms')
+
+    def __p12_file(self):
+        return self.__path('private', self.__name + '.p12')
+
+    def __csr_path(self):
+        return self.__path('csr', self.__name + '.csr')
+
+    def __config_file(self):
+        return self.__path('config', 'req_' + self.__name + '.cnf')
+
+    def __subject(self):
+        """Return the subject, being the subject of the parent with our CN"""
+        subject = self.__parent.subject()
+        subject['CN'] = self.__name
+        return subject
+
+    def __run(self, args, step):
+        """
+        Log and run a command, with the log output of the parent, and
+        observe its duration as step (like the steps of a Scheduler)
+        """
+        self.log_command(' '.join(args))
+        out, err = self.__parent.debug_output()
+        started = monotonic()
+        try:
+            run(args, check=True, stdout=out, stderr=err)
+        finally:
+            timed(step, started)
 
     def log_command(self, command):
         """log a command that is about to be run"""
-        self.__stdout.write(command+':\n')
-        self.__stdout.write('='*len(command)+'=\n')
+        self.__parent.log_command(command)
 
     def log(self, line):
         """Log a line"""
-        self.__stdout.write(line+'\n')
+        self.__parent.log(line)
 
     def name(self):
         """Return the name of this cert"""
         return self.__name
 
+    def certfile(self):
+        """Return the path to the certificate file"""
+        return self.__path('certs', self.__name + '.pem')
+
+    def issued(self):
+        """
+        Return False if the scheduled cert was reused from an earlier run
+        instead of being signed
+        """
+        return self.__sign_step is None or self.__sign_step.ran
+
+    def gen_pem_args(self):
+        """Return the openssl command that generates the private key"""
+        return ['openssl', 'genrsa', '-out', self.__pem_file(), '4096']
+
+    def verify_pem_args(self):
+        """Return the openssl command that verifies the private key"""
+        return ['openssl', 'rsa', '-noout', '-text', '-in', self.__pem_file()]
+
     def gen_pem(self):
         """Generate a private key for this certificate"""
-        args = ['openssl', 'genrsa', '-out', self.__pem_file, '4096']
-        self.log_command(' '.join(args))
-        run(args, check=True, stdout=self.__stdout, stderr=self.__stderr)
-        args = ['openssl', 'pkcs8', '-topk8', '-inform', 'PEM', '-inform',
-                'PEM', '-in', self.__pem_file, '-out', self.__pk8_file,
-                '-nocrypt']
-        run(args, check=True, stdout=self.__stdout, stderr=self.__stderr)
-        args = ['openssl', 'pkcs8', '-topk8', '-inform', 'PEM', '-outform',
-                'DER', '-in', self.__pem_file, '-out', self.__der_file,
-                '-nocrypt']
-        run(args, check=True, stdout=self.__stdout, stderr=self.__stderr)
+        args = self.gen_pem_args()
+        self.__run(args, 'key')
         self.verify_pem()
 
     def verify_pem(self):
         """Verify the private key for this certificate"""
-        args = ['openssl', 'rsa', '-noout', '-text', '-in', self.__pem_file]
-        self.log_command(' '.join(args))
-        run(args, check=True, stdout=self.__stdout, stderr=self.__stderr)
+        args = self.verify_pem_args()
+        self.__run(args, 'verify_key')
 
     def gen_cnf(self):
-        """Generate a config file for this certificate"""
+        """
+        Generate a config file for this certificate
+        :return: True if the config changed (e.a. other alternate names), so
+                 that the csr and cert are created again when resuming
+        """
         config_file = ConfigFile(self.__parent.configfile())
         config_file.set_key('req', 'req_extensions', 'v3_req')
         # Generic config for both CA and intermediates
-        config_file.set_chapter(self.__subject.chapter())
+        config_file.set_chapter(self.__subject().chapter())
 
         if len(self.__subject_alternate_names) > 1:
             config_file.set_key('v3_req', 'subjectAltName', '@alt_names')
@@ -578,49 +897,138 @@ class TlsCert:
                     config_file.set_key('alt_names', 'DNS.'+str(dns_counter),
                                         alt_name)
                     dns_counter += 1
-        self.log('writing config to '+self.__config_file)
-        config_file.write(self.__config_file)
+        self.log('writing config to '+self.__config_file())
+        return config_file.write(self.__config_file())
 
-    def create_csr(self):
-        """Create a certificate signing request from the config file"""
+    def create_csr_args(self):
+        """Return the openssl command that creates the csr"""
         # openssl req -new -out company_san.csr -newkey rsa:4096 -nodes -sha256
         # -keyout company_san.key.temp -config req.conf
         # # Convert key to PKCS#1
         # openssl rsa -in san.key.temp -out san.key
         # # Add csr in a readable format
         # openssl req -text -noout -verify -in san.csr > san.csr.txt
-        args = ['openssl', 'req', '-new', '-subj', self.__subject.string(),
-                '-key', self.__pem_file, '-out', self.__csr_path, '-config',
-                self.__config_file]
-        self.log_command(' '.join(args))
-        run(args, check=True, stdout=self.__stdout, stderr=self.__stderr)
+        return ['openssl', 'req', '-new', '-subj', self.__subject().string(),
+                '-key', self.__pem_file(), '-out', self.__csr_path(),
+                '-config', self.__config_file()]
+
+    def verify_csr_args(self):
+        """Return the openssl command that verifies the csr"""
+        return ['openssl', 'req', '-noout', '-text', '-in', self.__csr_path()]
+
+    def create_csr(self):
+        """Create a certificate signing request from the config file"""
+        args = self.create_csr_args()
+        self.__run(args, 'csr')
         self.verify_csr()
 
     def verify_csr(self):
         """
         Verify the Certificate Signing Request that was created for this cert
         """
-        args = ['openssl', 'req', '-noout', '-text', '-in', self.__csr_path]
-        self.log_command(' '.join(args))
-        run(args, check=True, stdout=self.__stdout, stderr=self.__stderr)
+        args = self.verify_csr_args()
+        self.__run(args, 'verify_csr')
 
     def gen_cert(self):
         """Create a CSR and have it signed to become a certificate"""
         self.create_csr()
-        self.__parent.sign_cert_csr(self.__config_file, self.__csr_path,
-                                    self.__cert_file)
+        self.__parent.sign_cert_csr(self.__config_file(), self.__csr_path(),
+                                    self.certfile())
         self.verify_cert()
+        if 'p12' in self.__parent.encodings():
+            self.gen_p12()
+
+    def verify_cert_args(self):
+        """Return the openssl command that verifies the certificate"""
+        return ['openssl', 'x509', '-noout', '-text', '-in', self.certfile()]
 
     def verify_cert(self):
         """Verify the certificate"""
-        args = ['openssl', 'x509', '-noout', '-text', '-in', self.__cert_file]
-        self.log_command(' '.join(args))
-        run(args, check=True, stdout=self.__stdout, stderr=self.__stderr)
+        args = self.verify_cert_args()
+        self.__run(args, 'verify')
+
+    def p12_args(self):
+        """
+        Return the openssl command that bundles key, cert and chain as
+        PKCS#12 (with an empty password)
+        """
+        return ['openssl', 'pkcs12', '-export', '-in', self.certfile(),
+                '-inkey', self.__pem_file(), '-certfile',
+                self.__parent.chainfile(), '-name', self.__name, '-out',
+                self.__p12_file(), '-passout', 'pass:']
+
+    def gen_p12(self):
+        """Bundle key, cert and chain as PKCS#12"""
+        args = self.p12_args()
+        self.__run(args, 'p12')
+
+    def schedule(self, scheduler):
+        """
+        Add the steps to create this certificate to a pipeline Scheduler:
+        key -> csr -> sign -> verify (-> p12)
+        With a distributed coordinator, a worker creates the key and csr,
+        and the key (which is returned encrypted) is decrypted locally.
+        PKCS#8 and DER encodings are converted in-process when the output
+        is read, only PKCS#12 needs an extra openssl step.
+        Signing is locked per CA, because openssl x509 -CAcreateserial
+        updates the serial file of the CA. CAs with a key on a PKCS#11
+        token sign in-process instead, without a lock.
+        :return: the last step, to be used as dependency for other steps
+        """
+        prefix = f'{self.__parent.name()}/{self.__name}:'
+        cnf = scheduler.add(prefix + 'cnf', func=self.gen_cnf)
+        coordinator = self.__parent.coordinator()
+        if coordinator is None:
+            key = scheduler.add(prefix + 'key', self.gen_pem_args(),
+                                outputs=[self.__pem_file()])
+            csr = scheduler.add(prefix + 'csr', self.create_csr_args(),
+                                deps=[key, cnf], outputs=[self.__csr_path()])
+        else:
+            csr = scheduler.add(prefix + 'remote',
+                                func=partial(coordinator.request_csr,
+                                             self.__name,
+                                             self.__subject().string(),
+                                             self.__config_file(),
+                                             self.__csr_path(),
+                                             self.__encrypted_pem_file()),
+                                deps=[cnf],
+                                outputs=[self.__csr_path(),
+                                         self.__encrypted_pem_file()])
+            key = scheduler.add(prefix + 'decrypt_key',
+                                coordinator.decrypt_key_args(
+                                    self.__encrypted_pem_file(),
+                                    self.__pem_file()),
+                                deps=[csr], outputs=[self.__pem_file()])
+        scheduler.add(prefix + 'verify_key', self.verify_pem_args(),
+                      deps=[key])
+        scheduler.add(prefix + 'verify_csr', self.verify_csr_args(),
+                      deps=[csr])
+        if self.__parent.signer() is None:
+            self.__sign_step = scheduler.add(
+                prefix + 'sign', self.__parent.sign_cert_csr_args(
+                    self.__config_file(), self.__csr_path(),
+                    self.certfile()),
+                deps=[csr, key], cwd=self.__parent.path(),
+                lock=self.__parent.path(), outputs=[self.certfile()])
+        else:
+            # No serial file to protect, so certs are signed concurrently
+            self.__sign_step = scheduler.add(
+                prefix + 'sign',
+                func=partial(self.__parent.sign_cert_csr_in_thread,
+                             self.__config_file(), self.__csr_path(),
+                             self.certfile()),
+                deps=[csr, key], outputs=[self.certfile()])
+        verify = scheduler.add(prefix + 'verify', self.verify_cert_args(),
+                               deps=[self.__sign_step])
+        if 'p12' in self.__parent.encodings():
+            return scheduler.add(prefix + 'p12', self.p12_args(),
+                                 deps=[verify], outputs=[self.__p12_file()])
+        return verify
 
     def get_cert(self):
         """Return the certificate as a string"""
         try:
-            with open(self.__cert_file, encoding="utf8") as crt:
+            with open(self.certfile(), encoding="utf8") as crt:
                 return crt.read()
         except OSError as os_err:
             print("Cannot open file:", os_err)
@@ -629,8 +1037,44 @@ class TlsCert:
     def get_private_key(self):
         """Return the private key for this cert as a string"""
         try:
-            with open(self.__pem_file, encoding="utf8") as pem:
+            with open(self.__pem_file(), encoding="utf8") as pem:
                 return pem.read()
         except OSError as os_err:
             print("Cannot open file:", os_err)
         return None
+
+    def get_certs(self, encodings):
+        """
+        Return a dict with the certificate in the requested encodings.
+        PEM is stored as name, DER (base64) as name.der
+        """
+        cert = self.get_cert()
+        if cert is None:
+            return {}
+        certs = {}
+        if 'pem' in encodings:
+            certs[self.__name] = cert
+        if 'der' in encodings:
+            certs[self.__name + '.der'] = binary(cert_der(cert))
+        return certs
+
+    def get_private_keys(self, encodings):
+        """
+        Return a dict with the private key in the requested encodings.
+        PEM is stored as name, PKCS#8 PEM as name.pk8, PKCS#8 DER (base64)
+        as name.der and PKCS#12 with cert and chain (base64) as name.p12
+        """
+        key = self.get_private_key()
+        if key is None:
+            return {}
+        keys = {}
+        if 'pem' in encodings:
+            keys[self.__name] = key
+        if 'pk8' in encodings:
+            keys[self.__name + '.pk8'] = private_key_pk8(key)
+        if 'der' in encodings:
+            keys[self.__name + '.der'] = binary(private_key_der(key))
+        if 'p12' in encodings:
+            with open(self.__p12_file(), 'rb') as p12_file:
+                keys[self.__name + '.p12'] = binary(p12_file.read())
+        return keys
@@ -0,0 +1,133 @@
+"""
+This module watches files (the config and Ansible inventories) for
+changes. On Linux it sleeps on inotify (through ctypes), elsewhere or when
+inotify is not available it polls. Either way a change is only reported
+when the size, mtime or inode of a file actually changed, so that editors
+that replace files, and events for other files in the same directory, are
+handled the same.
+"""
+import ctypes
+import ctypes.util
+from os import close, read, stat
+from os.path import abspath, dirname
+from select import select
+from time import sleep
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+# Time to wait after a change, so that a file that is written in parts (or
+# multiple files that are saved at once) are handled as one change
+SETTLE_SECONDS = 0.2
+
+
+def signature(path):
+    """Return what identifies the version of a file (None if missing)"""
+    try:
+        stats = stat(path)
+    except OSError:
+        return None
+    return stats.st_ino, stats.st_size, stats.st_mtime_ns
+
+
+def inotify_init():
+    """Return an inotify file descriptor and libc, or (None, None)"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None, None
+    if fd < 0:
+        return None, None
+    return fd, libc
+
+
+class FileWatcher:
+    """
+    FileWatcher waits for changes of a set of files.
+    Directories are watched instead of files, so that files that are
+    replaced (as most editors and Ansible do) are still followed.
+    """
+
+    __signatures = None
+    __directories = None
+    __fd = None
+    __libc = None
+    __interval = 1.0
+
+    def __init__(self, interval=1.0, poll=False):
+        """
+        :param interval: the seconds between checks when polling
+        :param poll: poll, even when inotify is available
+        """
+        self.__signatures = {}
+        self.__directories = set()
+        self.__interval = interval
+        if not poll:
+            self.__fd, self.__libc = inotify_init()
+
+    def uses_inotify(self):
+        """Return True if changes are detected with inotify"""
+        return self.__fd is not None
+
+    def watch(self, paths):
+        """
+        Set the files to watch, and record the version of files that were
+        not watched yet. Files that were watched before keep their
+        version, so that changes in between calls are not lost. Call this
+        before reading the files, so that changes made while they are read
+        are noticed.
+        """
+        paths = {abspath(path) for path in paths}
+        self.__signatures = {path: self.__signatures.get(path,
+                                                         signature(path))
+                             for path in paths}
+        if self.__fd is None:
+            return
+        for directory in {dirname(path) for path in paths}:
+            if directory in self.__directories:
+                continue
+            if self.__libc.inotify_add_watch(self.__fd, directory.encode(),
+                                             WATCH_MASK) >= 0:
+                self.__directories.add(directory)
+
+    def wait(self):
+        """Block until watched files changed, and return their paths"""
+        while True:
+            if self.__fd is None:
+                sleep(self.__interval)
+            else:
+                select([self.__fd], [], [])
+                sleep(SETTLE_SECONDS)
+                self.__drain()
+            changed = [path for path, version in self.__signatures.items()
+                       if signature(path) != version]
+            if changed:
+                sleep(SETTLE_SECONDS)
+                for path in self.__signatures:
+                    self.__signatures[path] = signature(path)
+                return changed
+
+    def __drain(self):
+        """Read all pending inotify events (their contents are not used)"""
+        try:
+            while read(self.__fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        """Stop watching"""
+        if self.__fd is not None:
+            close(self.__fd)
+            self.__fd = None
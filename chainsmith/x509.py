@@ -0,0 +1,416 @@
+"""
+This module holds a minimal DER / X.509 reader.
+It reads just enough of a certificate (serial, names, validity, subject
+alternative names, public key and signature) to inspect and audit a CA
+store without running an openssl process for every file, of a certificate
+signing request to sign it in-process, and the issuer of a CRL.
+"""
+from base64 import b64decode, b64encode
+from datetime import datetime, timezone
+from ipaddress import ip_address
+import re
+
+from chainsmith.exceptions import X509ParseException
+
+TAG_UTC_TIME = 0x17
+TAG_GENERALIZED_TIME = 0x18
+
+OID_SUBJECT_ALT_NAME = '2.5.29.17'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+
+OID_NAMES = {
+    '2.5.4.3': 'CN',
+    '2.5.4.6': 'C',
+    '2.5.4.7': 'L',
+    '2.5.4.8': 'ST',
+    '2.5.4.10': 'O',
+    '2.5.4.11': 'OU',
+    '1.2.840.113549.1.9.1': 'emailAddress',
+}
+
+PEM_RE = re.compile(r'-----BEGIN ([A-Z0-9 ]+)-----\s*(.*?)\s*-----END \1-----',
+                    re.S)
+
+
+def pem_blocks(text, label='CERTIFICATE'):
+    """
+    Return the DER contents of all PEM blocks with a specific label
+    :param text: the PEM text to read (could hold multiple blocks)
+    :param label: the label of the blocks to return (e.a. CERTIFICATE)
+    :return: a list of bytes objects
+    """
+    return [b64decode(''.join(body.split()))
+            for block_label, body in PEM_RE.findall(text)
+            if block_label == label]
+
+
+def pem_encode(der, label):
+    """Return a PEM block for DER data, wrapped at 64 characters"""
+    body = b64encode(der).decode('ascii')
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return '\n'.join([f'-----BEGIN {label}-----'] + lines +
+                     [f'-----END {label}-----', ''])
+
+
+def encode(tag, content):
+    """Return the DER encoding of an element with tag and content"""
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(length_bytes)]) + length_bytes + content
+
+
+def read_element(data, offset=0):
+    """
+    Read one DER element from data
+    :param data: the DER data
+    :param offset: the position where the element starts
+    :return: a tuple (tag, content start, content end)
+    """
+    try:
+        tag = data[offset]
+        length = data[offset + 1]
+        start = offset + 2
+        if length & 0x80:
+            num_bytes = length & 0x7f
+            length = int.from_bytes(data[start:start + num_bytes], 'big')
+            start += num_bytes
+    except IndexError as index_error:
+        raise X509ParseException('truncated DER element') from index_error
+    end = start + length
+    if end > len(data):
+        raise X509ParseException('DER element runs past end of data')
+    return tag, start, end
+
+
+def children(data):
+    """
+    Split the content of a constructed DER element into its children
+    :param data: the content bytes of the constructed element
+    :return: a list of (tag, content, raw) tuples
+    """
+    elements = []
+    offset = 0
+    while offset < len(data):
+        tag, start, end = read_element(data, offset)
+        elements.append((tag, data[start:end], data[offset:end]))
+        offset = end
+    return elements
+
+
+def decode_oid(data):
+    """Return the dotted string representation of an encoded OID"""
+    if not data:
+        raise X509ParseException('empty OID')
+    parts = [min(data[0] // 40, 2)]
+    parts.append(data[0] - 40 * parts[0])
+    value = 0
+    for byte in data[1:]:
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            parts.append(value)
+            value = 0
+    return '.'.join(str(part) for part in parts)
+
+
+def decode_time(tag, data):
+    """Return a timezone aware datetime for a UTCTime or GeneralizedTime"""
+    text = data.decode('ascii')
+    if tag == TAG_UTC_TIME:
+        fmt = '%y%m%d%H%M%SZ'
+    elif tag == TAG_GENERALIZED_TIME:
+        fmt = '%Y%m%d%H%M%SZ'
+    else:
+        raise X509ParseException('unexpected time tag', tag)
+    return datetime.strptime(text, fmt).replace(tzinfo=timezone.utc)
+
+
+def decode_name(data):
+    """
+    Return a list of (key, value) pairs for a DER encoded Name
+    :param data: the content of the Name SEQUENCE
+    :return: list of (key, value) pairs, key as short name (CN) where known
+    """
+    pairs = []
+    for _, rdn, _ in children(data):
+        for _, attribute, _ in children(rdn):
+            parts = children(attribute)
+            oid = decode_oid(parts[0][1])
+            value = parts[1][1]
+            pairs.append((OID_NAMES.get(oid, oid),
+                          value.decode('utf8', errors='replace')))
+    return pairs
+
+
+def rsa_private_key_modulus(der):
+    """
+    Return the modulus of a PKCS#8 DER encoded RSA private key, or None for
+    other key types
+    """
+    try:
+        _, start, end = read_element(der)
+        parts = children(der[start:end])
+        # PrivateKeyInfo: version, algorithm, key (OCTET STRING)
+        if decode_oid(children(parts[1][1])[0][1]) != OID_RSA_ENCRYPTION:
+            return None
+        _, key_start, key_end = read_element(parts[2][1])
+        # RSAPrivateKey: version, modulus, public exponent, ...
+        numbers = children(parts[2][1][key_start:key_end])
+        return int.from_bytes(numbers[1][1], 'big')
+    except (IndexError, ValueError) as error:
+        raise X509ParseException('cannot parse private key') from error
+
+
+def rsa_public_numbers(public_key_info):
+    """
+    Return the RSA public key in the content of a DER encoded
+    SubjectPublicKeyInfo as a tuple (modulus, exponent), or None for other
+    key types
+    """
+    try:
+        parts = children(public_key_info)
+        if decode_oid(children(parts[0][1])[0][1]) != OID_RSA_ENCRYPTION:
+            return None
+        # BIT STRING, the first byte holds the number of unused bits
+        key = children(parts[1][1][1:])
+        numbers = children(key[0][1])
+        return (int.from_bytes(numbers[0][1], 'big'),
+                int.from_bytes(numbers[1][1], 'big'))
+    except (IndexError, ValueError) as error:
+        raise X509ParseException('cannot parse public key') from error
+
+
+def crl_issuer(der):
+    """Return the DER content of the issuer of a DER encoded CRL"""
+    try:
+        _, start, end = read_element(der)
+        _, tbs, _ = children(der[start:end])[0]
+        fields = children(tbs)
+        if fields[0][0] == 0x02:
+            # optional version, skip it
+            fields = fields[1:]
+        return fields[1][1]
+    except (IndexError, ValueError) as error:
+        raise X509ParseException('cannot parse CRL') from error
+
+
+def csr_subject(der):
+    """
+    Return the subject of a DER encoded certificate signing request as a
+    list of (key, value) pairs
+    """
+    return decode_name(X509Request(der).subject_der())
+
+
+class X509Request:
+    """
+    X509Request is a read-only view of a DER encoded PKCS#10 certificate
+    signing request. It has the same accessors as X509Cert for what both
+    hold, so that signatures of both are verified the same way.
+    """
+
+    __info = b''
+    __subject = b''
+    __public_key = b''
+    __public_key_info = b''
+    __signature_algorithm = ''
+    __signature = b''
+
+    def __init__(self, der):
+        try:
+            _, start, end = read_element(der)
+            request = children(der[start:end])
+            _, info_content, self.__info = request[0]
+            # CertificationRequestInfo: version, subject, key, attributes
+            fields = children(info_content)
+            self.__subject = fields[1][1]
+            _, self.__public_key, self.__public_key_info = fields[2]
+            self.__signature_algorithm = decode_oid(
+                children(request[1][1])[0][1])
+            self.__signature = request[2][1][1:]
+        except (IndexError, ValueError) as error:
+            raise X509ParseException('cannot parse certificate signing '
+                                     'request') from error
+
+    @classmethod
+    def from_file(cls, path):
+        """Return a X509Request for the first request in a PEM file"""
+        with open(path, encoding="utf8") as pem:
+            blocks = pem_blocks(pem.read(), 'CERTIFICATE REQUEST')
+        if not blocks:
+            raise X509ParseException('no certificate request found in',
+                                     path)
+        return cls(blocks[0])
+
+    def tbs(self):
+        """Return the DER encoded CertificationRequestInfo (that is signed)"""
+        return self.__info
+
+    def subject_der(self):
+        """Return the DER content of the subject"""
+        return self.__subject
+
+    def public_key_info(self):
+        """Return the DER encoded SubjectPublicKeyInfo"""
+        return self.__public_key_info
+
+    def signature_algorithm(self):
+        """Return the OID of the signature algorithm"""
+        return self.__signature_algorithm
+
+    def signature(self):
+        """Return the signature of the CertificationRequestInfo"""
+        return self.__signature
+
+    def rsa_public_key(self):
+        """
+        Return the RSA public key as a tuple (modulus, exponent), or None
+        for other key types
+        """
+        return rsa_public_numbers(self.__public_key)
+
+
+class X509Cert:
+    """
+    X509Cert is a read-only view of a DER encoded X.509 certificate.
+    It only decodes the fields ChainSmith needs to index and inspect
+    certificates.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    __der = b''
+    __tbs = b''
+    __serial = 0
+    __issuer = b''
+    __subject = b''
+    __not_before = None
+    __not_after = None
+    __sans = None
+    __public_key = b''
+    __public_key_info = b''
+    __signature_algorithm = ''
+    __signature = b''
+
+    def __init__(self, der):
+        self.__der = der
+        try:
+            _, start, end = read_element(der)
+            cert = children(der[start:end])
+            _, tbs_content, self.__tbs = cert[0]
+            fields = children(tbs_content)
+            if fields[0][0] == 0xa0:
+                # explicit version tag, skip it
+                fields = fields[1:]
+            self.__serial = int.from_bytes(fields[0][1], 'big')
+            self.__issuer = fields[2][1]
+            validity = children(fields[3][1])
+            self.__not_before = decode_time(validity[0][0], validity[0][1])
+            self.__not_after = decode_time(validity[1][0], validity[1][1])
+            self.__subject = fields[4][1]
+            _, self.__public_key, self.__public_key_info = fields[5]
+            self.__signature_algorithm = decode_oid(
+                children(cert[1][1])[0][1])
+            # BIT STRING, the first byte holds the number of unused bits
+            self.__signature = cert[2][1][1:]
+            self.__sans = []
+            for tag, content, _ in fields[6:]:
+                if tag == 0xa3:
+                    self.__read_extensions(children(content)[0][1])
+        except (IndexError, ValueError) as error:
+            raise X509ParseException('cannot parse certificate') from error
+
+    def __read_extensions(self, data):
+        for _, extension, _ in children(data):
+            parts = children(extension)
+            if decode_oid(parts[0][1]) != OID_SUBJECT_ALT_NAME:
+                continue
+            for tag, value, _ in children(children(parts[-1][1])[0][1]):
+                if tag == 0x82:
+                    self.__sans.append(value.decode('ascii'))
+                elif tag == 0x87:
+                    self.__sans.append(str(ip_address(value)))
+
+    @classmethod
+    def from_pem(cls, text):
+        """Return a X509Cert for the first certificate in a PEM string"""
+        blocks = pem_blocks(text)
+        if not blocks:
+            raise X509ParseException('no certificate found in PEM data')
+        return cls(blocks[0])
+
+    @classmethod
+    def from_file(cls, path):
+        """Return a X509Cert for the first certificate in a PEM file"""
+        with open(path, encoding="utf8") as pem:
+            return cls.from_pem(pem.read())
+
+    def der(self):
+        """Return the DER encoding of this certificate"""
+        return self.__der
+
+    def tbs(self):
+        """Return the DER encoded TBSCertificate of this certificate"""
+        return self.__tbs
+
+    def serial(self):
+        """Return the serial number of this certificate as an int"""
+        return self.__serial
+
+    def serial_hex(self):
+        """Return the serial number as an uppercase hex string"""
+        return f'{self.__serial:X}'
+
+    def subject(self):
+        """Return the subject as a list of (key, value) pairs"""
+        return decode_name(self.__subject)
+
+    def issuer(self):
+        """Return the issuer as a list of (key, value) pairs"""
+        return decode_name(self.__issuer)
+
+    def common_name(self):
+        """Return the CN of the subject, or None if it has none"""
+        for key, value in self.subject():
+            if key == 'CN':
+                return value
+        return None
+
+    def not_before(self):
+        """Return the start of the validity period"""
+        return self.__not_before
+
+    def not_after(self):
+        """Return the end of the validity period"""
+        return self.__not_after
+
+    def subject_alternative_names(self):
+        """Return the DNS and IP subject alternative names"""
+        return list(self.__sans)
+
+    def subject_der(self):
+        """Return the DER content of the subject, to compare names"""
+        return self.__subject
+
+    def issuer_der(self):
+        """Return the DER content of the issuer, to compare names"""
+        return self.__issuer
+
+    def signature_algorithm(self):
+        """Return the OID of the signature algorithm"""
+        return self.__signature_algorithm
+
+    def signature(self):
+        """Return the signature of the TBSCertificate"""
+        return self.__signature
+
+    def rsa_public_key(self):
+        """
+        Return the RSA public key as a tuple (modulus, exponent), or None
+        for other key types
+        """
+        return rsa_public_numbers(self.__public_key)
+
+    def public_key_info(self):
+        """Return the DER encoded SubjectPublicKeyInfo"""
+        return self.__public_key_info
@@ -57,9 +57,12 @@ setup(
     include_package_data=True,
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
     install_requires=INSTALL_REQUIREMENTS,
+    extras_require={
+        'pkcs11': ['python-pkcs11'],
+    },
     entry_points={
         'console_scripts': [
-            'chainsmith=chainsmith.commandline:from_yaml',
+            'chainsmith=chainsmith.commandline:main',
         ]
     }
 )
@@ -0,0 +1,75 @@
+"""
+Tests for distributed issuance: a coordinator and workers on localhost.
+"""
+import asyncio
+from subprocess import PIPE
+from threading import Thread
+
+import pytest
+
+from chainsmith import distributed
+from chainsmith.distributed import Coordinator, key_matches_csr, work
+from chainsmith.exceptions import DistributedException
+from chainsmith.metrics import run
+
+TOKEN = 'test-token'
+# Just enough for openssl req, the subject is passed with -subj
+CNF = '[req]\ndistinguished_name = dn\n[dn]\n'
+
+
+@pytest.fixture(name='coordinator')
+def fixture_coordinator(tmp_path, monkeypatch):
+    """A coordinator on an ephemeral port of localhost"""
+    # Smaller keys, so that the tests do not wait for key generation
+    monkeypatch.setattr(distributed, 'KEY_BITS', 2048)
+    coordinator = Coordinator('127.0.0.1:0', str(tmp_path), TOKEN)
+    coordinator.start()
+    yield coordinator
+    coordinator.close()
+
+
+def start_worker(coordinator, token, results):
+    """Run a worker on a thread, and add its result (or error) to results"""
+    def target():
+        try:
+            results.append(work(coordinator.address(), token, 'test'))
+        except DistributedException as error:
+            results.append(error)
+
+    thread = Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_worker_round_trip(coordinator, tmp_path):
+    """A worker creates a key and CSR that the coordinator can use"""
+    cnf_file = tmp_path / 'req.cnf'
+    cnf_file.write_text(CNF)
+    csr_file = tmp_path / 'host1.csr'
+    key_file = tmp_path / 'host1.key.cms'
+    results = []
+    worker = start_worker(coordinator, TOKEN, results)
+    asyncio.run(asyncio.wait_for(coordinator.request_csr(
+        'host1', '/CN=host1', str(cnf_file), str(csr_file), str(key_file)),
+        timeout=60))
+    coordinator.close()
+    worker.join(timeout=10)
+    assert results == [1]
+    key = run(coordinator.decrypt_key_args(str(key_file), '-'), check=True,
+              stdout=PIPE, stderr=PIPE).stdout.decode('utf8')
+    assert key_matches_csr(key, csr_file.read_text())
+
+
+def test_worker_with_wrong_token(coordinator):
+    """A worker without the token of the coordinator gets no jobs"""
+    results = []
+    worker = start_worker(coordinator, 'wrong-token', results)
+    worker.join(timeout=10)
+    assert len(results) == 1
+    assert isinstance(results[0], DistributedException)
+
+
+def test_coordinator_requires_token(tmp_path):
+    """A coordinator does not start without a token"""
+    with pytest.raises(DistributedException):
+        Coordinator('127.0.0.1:0', str(tmp_path), None)
@@ -0,0 +1,74 @@
+"""
+Tests for CA keys on a PKCS#11 token, against a SoftHSM token.
+They are skipped when python-pkcs11 or SoftHSM is not installed.
+"""
+from os import environ
+from os.path import exists, join
+from shutil import which
+import subprocess
+
+import pytest
+
+from chainsmith import hsm
+from chainsmith.audit import StoreAudit
+from chainsmith.hsm import close_pools
+from chainsmith.tls import TlsCA, TlsSubject
+
+pytest.importorskip('pkcs11')
+
+SOFTHSM_LIBRARIES = [
+    '/usr/lib/softhsm/libsofthsm2.so',
+    '/usr/lib64/pkcs11/libsofthsm2.so',
+    '/usr/lib/x86_64-linux-gnu/softhsm/libsofthsm2.so',
+    '/usr/local/lib/softhsm/libsofthsm2.so',
+    '/opt/homebrew/lib/softhsm/libsofthsm2.so',
+]
+TOKEN = 'chainsmith'
+PIN = '1234'
+
+
+def softhsm_library():
+    """Return the path of the SoftHSM module (or None)"""
+    candidates = [environ.get('SOFTHSM2_MODULE')] + SOFTHSM_LIBRARIES
+    return next((path for path in candidates if path and exists(path)),
+                None)
+
+
+@pytest.fixture(name='pkcs11_config')
+def fixture_pkcs11_config(tmp_path, monkeypatch):
+    """The pkcs11 config of a fresh SoftHSM token"""
+    library = softhsm_library()
+    if library is None or not which('softhsm2-util'):
+        pytest.skip('SoftHSM is not installed')
+    tokens = tmp_path / 'tokens'
+    tokens.mkdir()
+    conf = tmp_path / 'softhsm2.conf'
+    conf.write_text(f'directories.tokendir = {tokens}\n'
+                    'objectstore.backend = file\n')
+    monkeypatch.setenv('SOFTHSM2_CONF', str(conf))
+    subprocess.run(['softhsm2-util', '--init-token', '--free', '--label',
+                    TOKEN, '--pin', PIN, '--so-pin', '12345678'],
+                   check=True, stdout=subprocess.PIPE)
+    # Smaller keys, so that the test does not wait for key generation
+    monkeypatch.setattr(hsm, 'KEY_BITS', 2048)
+    yield {'library': library, 'token': TOKEN, 'pin': PIN}
+    close_pools()
+
+
+def test_chain_with_keys_on_token(pkcs11_config, tmp_path):
+    """A root and an intermediate on the token issue a valid chain"""
+    capath = join(tmp_path, 'tls')
+    root = TlsCA(capath, 'root', {'pkcs11': pkcs11_config}, None)
+    root.set_subject(TlsSubject({'C': 'NL', 'ST': 'Utrecht', 'L': 'Utrecht',
+                                 'O': 'Test', 'CN': 'root'}))
+    root.create_ca_cert()
+    on_token = root.create_int('server', {'pkcs11': pkcs11_config})
+    in_store = root.create_int('client', {})
+    on_token.create_cert(['host1.example.com', '10.0.0.1'])
+    in_store.create_cert(['client1'])
+    report = StoreAudit(capath).run()
+    assert report['summary']['errors'] == 0, report['issues']
+    assert report['summary']['certs'] == 2
+    # The keys of CAs on the token are not in the CA store
+    assert not exists(join(capath, 'private', 'cakey.pem'))
+    assert not exists(join(capath, 'int_server', 'private', 'cakey.pem'))